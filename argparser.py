@@ -19,6 +19,20 @@ argparser.add_argument(
     help='/path/to/dir to store txt and log files with scraping results. '
          'Please note you need NOT put a separator (slash or backslash) at the end of the path'
 )
+argparser.add_argument(
+    '--fsync',
+    type=str,
+    choices=('always', 'interval', 'never'),
+    default=settings.TXT_FSYNC_POLICY,
+    help='when the entries written to the txt-store are fsynced: after every write, '
+         'every --fsync-interval milliseconds, or never, leaving it to the OS'
+)
+argparser.add_argument(
+    '--fsync-interval',
+    type=int,
+    default=settings.TXT_FSYNC_INTERVAL,
+    help='milliseconds between the fsyncs of the txt-store with the interval fsync policy'
+)
 argparser.add_argument(
     '--url',
     type=str,
@@ -31,6 +45,58 @@ argparser.add_argument(
     default=settings.POSTS_FOR_PARSING_NUM,
     help='number of posts to parse'
 )
+argparser.add_argument(
+    '--collector-capacity',
+    type=int,
+    default=settings.COLLECTOR_CAPACITY,
+    help='max number of posts kept in the collector at a time. The crawl waits for the collector '
+         'to be drained via webserver when the capacity is reached. With 0 the capacity is unbounded'
+)
+argparser.add_argument(
+    '--collector-window',
+    type=int,
+    default=settings.COLLECTOR_WINDOW,
+    help='number of collected posts kept in RAM, the rest being spilled to files in the target dir. '
+         'With 0 all of the collected posts are kept in RAM'
+)
+argparser.add_argument(
+    '--full-page-loading',
+    action='store_true',
+    help='re-parse the whole page source on every scroll instead of extracting only the newly loaded posts'
+)
+argparser.add_argument(
+    '--persist-profiles',
+    action='store_true',
+    help='keep the parsed user profiles in a json-file in the target dir to reuse them on the next run'
+)
+argparser.add_argument(
+    '--parse-workers',
+    type=int,
+    default=settings.PARSE_WORKERS_NUM,
+    help='number of worker processes to parse html in. With 0 the parsing is done in the main process'
+)
+argparser.add_argument(
+    '--profile-rate',
+    type=float,
+    default=settings.PROFILE_REQUESTS_RATE,
+    help='max number of user profile requests per second'
+)
+argparser.add_argument(
+    '--profile-max-concurrency',
+    type=int,
+    default=settings.PROFILE_MAX_CONCURRENCY,
+    help='max number of user profile requests in flight'
+)
+argparser.add_argument(
+    '--serve-early',
+    action='store_true',
+    help='launch the webserver as soon as the first post is collected instead of waiting for the crawl to end'
+)
+argparser.add_argument(
+    '--autosave',
+    action='store_true',
+    help='save the collected posts with the executor as they come instead of keeping them in the collector'
+)
 argparser.add_argument(
     '--host',
     type=str,
@@ -50,6 +116,33 @@ argparser.add_argument(
     help='name of the webserver running on the given address'
 )
 
+argparser.add_argument(
+    '--server-workers',
+    type=int,
+    default=settings.SERVER_WORKERS,
+    help='number of webserver worker processes, each accepting connections on its own SO_REUSEPORT socket. '
+         'Several workers are only launched once the crawl is over'
+)
+argparser.add_argument(
+    '--backlog',
+    type=int,
+    default=settings.SERVER_BACKLOG,
+    help='size of the queue of connections waiting to be accepted by the webserver'
+)
+argparser.add_argument(
+    '--max-connections',
+    type=int,
+    default=settings.SERVER_MAX_CONNECTIONS,
+    help='number of client connections served at once by a webserver worker, '
+         'the ones above it are refused with 503. Lowered to stay within the open files limit'
+)
+argparser.add_argument(
+    '--idle-timeout',
+    type=float,
+    default=settings.SERVER_IDLE_TIMEOUT,
+    help='seconds an idle keep-alive connection is kept open by the webserver'
+)
+
 argparser.add_argument(
     '--postgres-host',
     type=str,
@@ -84,6 +177,18 @@ argparser.add_argument(
     default=settings.POSTGRES_PASSWORD,
     help='postgres database password'
 )
+argparser.add_argument(
+    '--postgres-pool-min',
+    type=int,
+    default=settings.POSTGRES_POOL_MIN_SIZE,
+    help='number of connections to postgres kept open when idle'
+)
+argparser.add_argument(
+    '--postgres-pool-max',
+    type=int,
+    default=settings.POSTGRES_POOL_MAX_SIZE,
+    help='max number of connections to postgres open at once, per process'
+)
 
 argparser.add_argument(
     '--mongo-host',
@@ -0,0 +1,100 @@
+"""Time the collectors at 100k posts and over.
+
+The script offers the generated posts to a collector, one in ten of them twice, as the crawl
+meets a post again on scrolling, then drains the collector entry by entry, as the webserver does.
+It reports the rate of each stage and the peak of the Python memory allocated by the collector
+while collecting, the posts themselves and the memory-mapped files left out, for the collector
+on a hash index and a deque, for the spilling one, and for the list the collector was built on
+before, checked with `in` and drained with pop(0). The list one takes quadratic time, so it is
+left out past --list-max posts."""
+
+import argparse
+import os
+import sys
+import tempfile
+import tracemalloc
+import uuid
+from time import perf_counter
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collector import ValidDataCollector, SpillingDataCollector
+
+DEFAULT_SIZES = (100_000, 300_000)
+DUPLICATES_EVERY = 10
+SPILL_WINDOW = 1_000
+
+
+class ListCollector:
+    """The collector as it was: a list checked for duplicates with `in` and drained with pop(0)."""
+
+    def __init__(self, posts_for_parsing_num) -> None:
+        self.posts_for_parsing_num = posts_for_parsing_num
+        self._valid_data = []
+
+    def collect(self, data: str) -> None:
+        if data is not None and data not in self._valid_data:
+            self._valid_data.append(data)
+
+    def get_one_entry(self) -> str:
+        return self._valid_data.pop(0)
+
+
+def generate_posts(posts_num: int) -> List[str]:
+    return [f'{uuid.uuid1().hex};https://www.reddit.com/r/bench/comments/{number}/;user{number};1;2;3;'
+            f'2015-03-01;2021-11-01;4;5;bench' for number in range(posts_num)]
+
+
+def offered(posts: List[str]) -> List[str]:
+    return [post for number, post in enumerate(posts)
+            for _ in range(2 if number % DUPLICATES_EVERY == 0 else 1)]
+
+
+def run(make_collector: Callable, posts: List[str]) -> Dict[str, float]:
+    collector = make_collector(len(posts))
+    posts_offered = offered(posts)
+    started_at = perf_counter()
+    for post in posts_offered:
+        collector.collect(post)
+    collect_time = perf_counter() - started_at
+    started_at = perf_counter()
+    for _ in range(len(posts)):
+        collector.get_one_entry()
+    drain_time = perf_counter() - started_at
+
+    collector = make_collector(len(posts))
+    tracemalloc.start()
+    for post in posts_offered:
+        collector.collect(post)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'collect, posts/s': len(posts_offered) / collect_time, 'drain, posts/s': len(posts) / drain_time,
+            'peak, MB': peak / 2 ** 20}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='posts collected')
+    parser.add_argument('--list-max', type=int, default=20_000, help='most posts given to the list collector')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as spill_dir_path:
+        collectors = {
+            'list': ListCollector,
+            'hash+deque': ValidDataCollector,
+            'spilling': lambda posts_num: SpillingDataCollector(posts_num, spill_dir_path, SPILL_WINDOW),
+        }
+        print(f'{"posts":>8}  {"collector":<11}  {"collect, posts/s":>17}  {"drain, posts/s":>15}  {"peak, MB":>9}')
+        for posts_num in [args.list_max] + list(args.sizes):
+            posts = generate_posts(posts_num)
+            for name, make_collector in collectors.items():
+                if name == 'list' and posts_num > args.list_max:
+                    continue
+                results = run(make_collector, posts)
+                print(f'{posts_num:>8}  {name:<11}  {results["collect, posts/s"]:>17,.0f}  '
+                      f'{results["drain, posts/s"]:>15,.0f}  {results["peak, MB"]:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""Load the webserver with many keep-alive connections.
+
+The script starts the webserver of the given source tree in a child process, over an
+in-memory executor, then opens the connections, more of them than FD_SETSIZE by default,
+and has each of them send a series of GET requests. It reports the rate at which
+the connections got accepted and served a first response, and the latency percentiles
+of the requests that followed. To compare the scheduler before and after a change,
+check the older revision out into a worktree and point --tree at it, e.g.
+
+    git worktree add /tmp/webcrawler-before fe4c079~1
+    python benchmarks/keepalive_load.py --tree /tmp/webcrawler-before
+    python benchmarks/keepalive_load.py"""
+
+import argparse
+import asyncio
+import inspect
+import logging
+import math
+import os
+import re
+import resource
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONNECT_CONCURRENCY = 256
+CONNECT_TIMEOUT = 10
+REQUEST_TIMEOUT = 30
+SERVER_START_TIMEOUT = 10
+OPEN_FILES_HEADROOM = 256
+CONTENT_LENGTH_PATTERN = re.compile(rb'(?im)^content-length:\s*(\d+)\s*$')
+
+Stream = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+def raise_open_files_limit(needed: int) -> int:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        soft = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    return soft
+
+
+class InMemoryExecutor:
+    """Keep the posts in a dict, so that the server is timed rather than a storage."""
+    is_process_safe = False
+
+    def __init__(self, posts_num: int) -> None:
+        self._posts = {f'{number:032x}': {'unique_id': f'{number:032x}', 'post_url': f'/r/bench/{number}/'}
+                       for number in range(posts_num)}
+
+    def insert(self, collected_data):
+        return []
+
+    def find(self, unique_id: str = None):
+        if unique_id is not None:
+            return self._posts.get(unique_id)
+        return list(self._posts.values())
+
+    def find_page(self, after: Optional[str] = None, limit: Optional[int] = None):
+        posts = [post for unique_id, post in self._posts.items() if after is None or unique_id > after]
+        return posts[:limit]
+
+    def update(self, data, unique_id: str) -> bool:
+        return False
+
+    def delete(self, unique_id: str) -> bool:
+        return False
+
+
+def serve(tree: str, port: int, connections: int, posts_num: int) -> None:
+    raise_open_files_limit(connections + OPEN_FILES_HEADROOM)
+    sys.path.insert(0, tree)
+    logging.basicConfig(level=logging.WARNING)
+    import webserver
+    from collector import ValidDataCollector
+
+    options = {}
+    if 'max_connections' in inspect.signature(webserver.HTTPServer).parameters:
+        options['max_connections'] = connections + 1
+    collector = ValidDataCollector(posts_for_parsing_num=1)
+    server = webserver.HTTPServer('127.0.0.1', port, 'localhost', InMemoryExecutor(posts_num), collector, **options)
+    server.run_forever()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args: argparse.Namespace, port: int) -> subprocess.Popen:
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', '--tree', args.tree,
+                               '--port', str(port), '--connections', str(args.connections),
+                               '--posts', str(args.posts)])
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.1)
+    server.kill()
+    raise SystemExit(f'The server of {args.tree} did not start listening on port {port}')
+
+
+async def exchange(stream: Stream, request: bytes) -> Tuple[float, int]:
+    reader, writer = stream
+    started_at = perf_counter()
+    writer.write(request)
+    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), REQUEST_TIMEOUT)
+    content_length = CONTENT_LENGTH_PATTERN.search(head)
+    if content_length:
+        await asyncio.wait_for(reader.readexactly(int(content_length.group(1))), REQUEST_TIMEOUT)
+    return perf_counter() - started_at, int(head.split(b' ', 2)[1])
+
+
+async def open_connection(port: int, request: bytes, semaphore: asyncio.Semaphore,
+                          statuses: Counter) -> Optional[Stream]:
+    async with semaphore:
+        try:
+            stream = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            statuses[type(e).__name__] += 1
+            return
+    try:
+        _, status = await exchange(stream, request)
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+        statuses[type(e).__name__] += 1
+        stream[1].close()
+        return
+    statuses[status] += 1
+    return stream
+
+
+async def keep_requesting(stream: Stream, request: bytes, requests_num: int,
+                          latencies: List[float], statuses: Counter) -> None:
+    for _ in range(requests_num):
+        try:
+            latency, status = await exchange(stream, request)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+            statuses[type(e).__name__] += 1
+            return
+        latencies.append(latency)
+        statuses[status] += 1
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+async def run_load(args: argparse.Namespace, port: int) -> Dict[str, float]:
+    request = f'GET {args.path} HTTP/1.1\r\nHost: localhost:{port}\r\n\r\n'.encode('iso-8859-1')
+    connect_statuses, request_statuses = Counter(), Counter()
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    started_at = perf_counter()
+    streams = await asyncio.gather(*(open_connection(port, request, semaphore, connect_statuses)
+                                     for _ in range(args.connections)))
+    accept_time = perf_counter() - started_at
+    streams = [stream for stream in streams if stream is not None]
+
+    latencies = []
+    started_at = perf_counter()
+    await asyncio.gather(*(keep_requesting(stream, request, args.requests, latencies, request_statuses)
+                           for stream in streams))
+    load_time = perf_counter() - started_at
+    for _, writer in streams:
+        writer.close()
+
+    latencies.sort()
+    return {'connections served': len(streams), 'accept rate, conn/s': len(streams) / accept_time,
+            'requests': len(latencies), 'throughput, req/s': len(latencies) / load_time if load_time else 0,
+            'p50, ms': percentile(latencies, 0.5) * 1000, 'p99, ms': percentile(latencies, 0.99) * 1000,
+            'max, ms': (latencies[-1] if latencies else float('nan')) * 1000,
+            'first responses': dict(connect_statuses), 'responses': dict(request_statuses)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tree', default=REPO_ROOT, help='source tree of the webserver to load')
+    parser.add_argument('--connections', type=int, default=2000, help='keep-alive connections to open')
+    parser.add_argument('--requests', type=int, default=20, help='requests sent over each connection')
+    parser.add_argument('--posts', type=int, default=10, help='posts served by the in-memory executor')
+    parser.add_argument('--path', default='/posts/', help='path requested')
+    parser.add_argument('--port', type=int, default=0, help='port of the server, a free one if not given')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.tree = os.path.abspath(args.tree)
+
+    if args.serve:
+        serve(args.tree, args.port, args.connections, args.posts)
+        return
+
+    raise_open_files_limit(args.connections + OPEN_FILES_HEADROOM)
+    port = args.port or free_port()
+    server = start_server(args, port)
+    try:
+        results = asyncio.run(run_load(args, port))
+    finally:
+        server.terminate()
+        server.wait()
+    print(f'{args.tree}: {args.connections} connections x {args.requests} requests to {args.path}')
+    for name, value in results.items():
+        print(f'  {name}: {value:.2f}' if isinstance(value, float) else f'  {name}: {value}')
+
+
+if __name__ == '__main__':
+    main()
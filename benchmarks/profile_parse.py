@@ -0,0 +1,151 @@
+"""Time the extraction of the user details out of the profile pages.
+
+The script runs parse_user_profile, which looks the two nodes needed up in the lxml tree,
+and the full-tree BeautifulSoup parsing it replaced over the profile pages, and reports the
+parse time per profile and how far the resident memory of a fresh process peaks above where
+it was while a page is parsed, which takes Linux to reset the peak. The pages are the .html
+files of --fixtures, e.g. profiles saved from the browser, or else a generated page laid out
+like a reddit profile: a feed of posts, the id card with the cakeday and the json payload
+with the karma."""
+
+import argparse
+import glob
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from statistics import median
+from time import perf_counter
+from typing import Callable, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup
+from parser import parse_user_profile
+
+GENERATED_POSTS_NUM = 100
+REPEATS = 20
+OLD_CAKEDAY = {'elem': 'span', 'attrs': {'id': 'profile--id-card--highlight-tooltip--cakeday'}}
+OLD_KARMA = {'elem': 'script', 'attrs': {'id': 'data'}, 'post': r'"fromPosts":[\d]*',
+             'comment': r'"fromComments":[\d]*', 'total': r'"total":[\d]*'}
+
+
+def generate_profile(posts_num: int = GENERATED_POSTS_NUM) -> bytes:
+    posts = ''.join(
+        f'<div class="Post t3_{number:x}"><div class="_1rZYMD_4xY3gRcSS3p8ODO">{number * 7}</div>'
+        f'<a class="_3jOxDPIQ0KaOWpzvSQo-1s" href="/r/bench/comments/{number:x}/">{number % 30} days ago</a>'
+        f'<h3 class="_eYtD2XCVieq6emjKBH3m">Post title number {number} of the generated profile</h3>'
+        f'<p class="_1qeIAgB0cPwnLhDF9XSiJM">{"Some text of the post. " * 20}</p>'
+        f'<span class="FHCV02u6Cp2zYL0fhQPsO">{number} comments</span></div>'
+        for number in range(posts_num)
+    )
+    payload = {'users': {'models': {'t2_bench': {'karma': {'fromPosts': 4512, 'fromComments': 10873,
+                                                           'fromAwardsGiven': 12, 'fromAwardsReceived': 40,
+                                                           'total': 15437}}}},
+               'posts': {'models': {f't3_{number:x}': {'title': f'Post {number}', 'score': number,
+                                                       'media': {'content': 'x' * 3000}}
+                                    for number in range(posts_num)}}}
+    return (
+        '<!DOCTYPE html><html lang="en"><head><title>bench (u/bench) - Reddit</title>'
+        f'{"<link rel=preload href=/static/chunk.js as=script>" * 50}</head><body><div id="2x-container">'
+        f'<header>{"<a href=/r/popular/>nav</a>" * 40}</header><div class="_31N0dvxfpsO6Ur5AKx4O5d">{posts}</div>'
+        '<div class="_3Im6OD67aKo33nql4FpSp_"><span class="_1hNyZSklmcC7R_IfCUcXmZ">Cake day</span>'
+        '<span id="profile--id-card--highlight-tooltip--cakeday">June 2, 2015</span></div></div>'
+        f'<script id="data">window.___r = {json.dumps(payload)};</script></body></html>'
+    ).encode('utf-8')
+
+
+def get_match(element: Optional[re.Match]) -> Optional[str]:
+    if element is not None:
+        return element.group().split(':')[1]
+
+
+def parse_with_soup(profile_html: bytes) -> Optional[Tuple[str, ...]]:
+    """The extraction as it was: the whole page made into a soup, the karma section searched as a string."""
+    profile_soup = BeautifulSoup(profile_html, features='lxml')
+    card_available = profile_soup.find(OLD_CAKEDAY['elem'], attrs=OLD_CAKEDAY['attrs'])
+    if not card_available:
+        return
+    user_cakeday = card_available.contents[0]
+    karma_section_block = profile_soup.find(OLD_KARMA['elem'], attrs=OLD_KARMA['attrs'])
+    post_karma = get_match(re.search(OLD_KARMA['post'], str(karma_section_block)))
+    comment_karma = get_match(re.search(OLD_KARMA['comment'], str(karma_section_block)))
+    total_karma = get_match(re.search(OLD_KARMA['total'], str(karma_section_block)))
+    if all([post_karma, comment_karma, total_karma]):
+        return post_karma, comment_karma, total_karma, user_cakeday
+
+
+METHODS = {'lxml xpath': parse_user_profile, 'soup': parse_with_soup}
+
+
+def time_per_profile(parse: Callable[[bytes], Optional[Tuple[str, ...]]], profiles: List[bytes]) -> float:
+    timings = []
+    for _ in range(REPEATS):
+        started_at = perf_counter()
+        for profile_html in profiles:
+            parse(profile_html)
+        timings.append((perf_counter() - started_at) / len(profiles))
+    return median(timings)
+
+
+def resident_memory(field: str) -> int:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(f'{field}:'):
+                return int(line.split()[1])
+    raise ValueError(f'No {field} in /proc/self/status')
+
+
+def peak_memory(method: str, profile_path: str) -> float:
+    """Parse the page in a fresh process and take how far its resident memory peaked above where it was, in MB."""
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', method, profile_path],
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout)
+
+
+def measure(method: str, profile_path: str) -> None:
+    with open(profile_path, 'rb') as f:
+        profile_html = f.read()
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    resident_before = resident_memory('VmRSS')
+    METHODS[method](profile_html)
+    print((resident_memory('VmHWM') - resident_before) / 1024)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fixtures', help='folder of the profile pages saved as .html files')
+    parser.add_argument('--measure', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        measure(*args.measure)
+        return
+
+    with tempfile.TemporaryDirectory() as generated_dir_path:
+        if args.fixtures:
+            profile_paths = sorted(glob.glob(os.path.join(args.fixtures, '*.html')))
+        else:
+            profile_paths = [os.path.join(generated_dir_path, 'generated.html')]
+            with open(profile_paths[0], 'wb') as f:
+                f.write(generate_profile())
+        profiles = []
+        for profile_path in profile_paths:
+            with open(profile_path, 'rb') as f:
+                profiles.append(f.read())
+        for profile_html, profile_path in zip(profiles, profile_paths):
+            if parse_user_profile(profile_html) != parse_with_soup(profile_html):
+                raise SystemExit(f'The parsers disagree on {profile_path}')
+
+        print(f'{len(profiles)} profiles, {sum(map(len, profiles)) / len(profiles) / 1024:.0f} KB on average')
+        print(f'{"parser":<12}  {"ms per profile":>15}  {"peak, MB":>9}')
+        for method, parse in METHODS.items():
+            per_profile = time_per_profile(parse, profiles)
+            memory = max(peak_memory(method, profile_path) for profile_path in profile_paths)
+            print(f'{method:<12}  {per_profile * 1000:>15.2f}  {memory:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
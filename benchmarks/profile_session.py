@@ -0,0 +1,114 @@
+"""Time the profile requests over the shared session.
+
+The script starts a local aiohttp server answering every request with a profile-sized page
+and fetches the profiles of the generated posts, a few at a time as the crawl does, once over
+the session of open_profile_session, shared by all the requests, and once over a ClientSession
+opened and closed per post, as the parser did before. It reports the requests per second of
+each and the TCP connections the server accepted, a handshake each. Over the loopback a
+handshake takes no round trip and no TLS, so the gap only grows against reddit."""
+
+import argparse
+import asyncio
+import os
+import sys
+from time import perf_counter
+from typing import Awaitable, Callable, Dict, List, Set, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import ClientSession, web
+from parser import open_profile_session
+from settings import HEADERS, PROFILE_CONNECTIONS_PER_HOST
+
+PAGE_SIZE = 400 * 1024
+
+
+class StubServer:
+    """Serve the same page on every path and keep the peers of the connections it accepted."""
+
+    def __init__(self, page_size: int) -> None:
+        self._page = b'x' * page_size
+        self.peers: Set[Tuple[str, int]] = set()
+        self._runner = None
+        self.port = None
+
+    async def _answer(self, request: web.Request) -> web.Response:
+        self.peers.add(request.transport.get_extra_info('peername'))
+        return web.Response(body=self._page, content_type='text/html')
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/{tail:.*}', self._answer)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
+
+
+async def fetch_over_shared_session(urls: List[str], concurrency: int) -> None:
+    async with open_profile_session() as session:
+        await fetch_all(urls, concurrency, lambda url: fetch(session, url))
+
+
+async def fetch_over_session_per_post(urls: List[str], concurrency: int) -> None:
+    """The requests as they were: a session, and so a connection, for each post."""
+    async def fetch_in_own_session(url: str) -> bytes:
+        async with ClientSession(headers=HEADERS, trust_env=True) as session:
+            return await fetch(session, url)
+    await fetch_all(urls, concurrency, fetch_in_own_session)
+
+
+async def fetch(session: ClientSession, url: str) -> bytes:
+    async with session.get(url) as response:
+        return await response.read()
+
+
+async def fetch_all(urls: List[str], concurrency: int, fetch_one: Callable[[str], Awaitable[bytes]]) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_limited(url: str) -> None:
+        async with semaphore:
+            await fetch_one(url)
+    await asyncio.gather(*(fetch_limited(url) for url in urls))
+
+
+METHODS = {'shared session': fetch_over_shared_session, 'session per post': fetch_over_session_per_post}
+
+
+async def run(posts_num: int, concurrency: int, page_size: int) -> Dict[str, Tuple[float, int]]:
+    server = StubServer(page_size)
+    await server.start()
+    urls = [f'http://127.0.0.1:{server.port}/user/user{number}/' for number in range(posts_num)]
+    results = {}
+    try:
+        for name, fetch_over in METHODS.items():
+            server.peers.clear()
+            started_at = perf_counter()
+            await fetch_over(urls, concurrency)
+            results[name] = (posts_num / (perf_counter() - started_at), len(server.peers))
+    finally:
+        await server.stop()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=2000, help='profiles requested')
+    parser.add_argument('--concurrency', type=int, default=PROFILE_CONNECTIONS_PER_HOST,
+                        help='requests in flight at once')
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE, help='bytes of each profile page')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.posts, args.concurrency, args.page_size))
+    print(f'{args.posts} profiles, {args.concurrency} in flight')
+    print(f'{"session":<17}  {"req/s":>8}  {"connections":>12}')
+    for name, (rate, connections) in results.items():
+        print(f'{name:<17}  {rate:>8,.0f}  {connections:>12}')
+
+
+if __name__ == '__main__':
+    main()
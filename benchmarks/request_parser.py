@@ -0,0 +1,132 @@
+"""Time HTTPServer.form_http_request and the framing of the requests it is given.
+
+The script reports the requests per second of form_http_request alone, over requests framed
+beforehand, and of HTTPRequestParser and form_http_request together, as the webserver runs
+them on a connection. For the requests the old parser could take, it times form_http_request
+as it was as well: the request line read off a BytesIO and the headers parsed with email.parser,
+which took one request per recv."""
+
+import argparse
+import email.message
+import io
+import os
+import sys
+from email.parser import Parser as mail_parser
+from time import perf_counter
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webserver import HTTPRequest, HTTPRequestParser, HTTPServer
+
+MAX_LINE_BINARY_LENGTH = 64 * 1024
+HEADERS = (b'Host: localhost\r\nUser-Agent: PostmanRuntime/7.28.4\r\nAccept: */*\r\n'
+           b'Cache-Control: no-cache\r\nAccept-Encoding: gzip, deflate, br\r\nConnection: keep-alive\r\n')
+POST_BODY = (b'{"unique_id": "5a1f2c9e4b3d11ecb9090242ac120002", "post_url": "https://www.reddit.com/r/x/", '
+             b'"user_name": "someone", "comment_karma": "120", "post_karma": "450", "total_karma": "570"}')
+GET_REQUEST = b'GET /posts/?limit=100 HTTP/1.1\r\n' + HEADERS + b'\r\n'
+PUT_REQUEST = (b'PUT /posts/5a1f2c9e4b3d11ecb9090242ac120002/ HTTP/1.1\r\n' + HEADERS
+               + b'Content-Type: application/json\r\nContent-Length: %d\r\n\r\n' % len(POST_BODY) + POST_BODY)
+CHUNKED_PUT_REQUEST = (b'PUT /posts/5a1f2c9e4b3d11ecb9090242ac120002/ HTTP/1.1\r\n' + HEADERS
+                       + b'Content-Type: application/json\r\nTransfer-Encoding: chunked\r\n\r\n'
+                       + b''.join(b'%x\r\n%s\r\n' % (len(POST_BODY[start:start + 64]), POST_BODY[start:start + 64])
+                                  for start in range(0, len(POST_BODY), 64)) + b'0\r\n\r\n')
+PIPELINE_LENGTH = 16
+WARM_UP_ROUNDS = 1000
+SAMPLES = {
+    'GET': [GET_REQUEST],
+    'PUT, Content-Length': [PUT_REQUEST],
+    'PUT, chunked': [CHUNKED_PUT_REQUEST],
+    f'{PIPELINE_LENGTH} pipelined GETs': [GET_REQUEST * PIPELINE_LENGTH],
+    'GET in 1-byte reads': [GET_REQUEST[number:number + 1] for number in range(len(GET_REQUEST))],
+}
+MAIL_PARSER_SAMPLES = ('GET', 'PUT, Content-Length')
+
+
+def frame(reads: List[bytes]) -> List[tuple]:
+    parser = HTTPRequestParser()
+    raw_requests = []
+    for data in reads:
+        parser.feed(data)
+        while True:
+            raw_request = parser.next_request()
+            if raw_request is None:
+                break
+            raw_requests.append(raw_request)
+    return raw_requests
+
+
+def form_framed(server: HTTPServer, raw_requests: List[tuple]) -> int:
+    for raw_request in raw_requests:
+        if server.form_http_request(*raw_request) is None:
+            raise SystemExit('The request was not formed. Check the Host header.')
+    return len(raw_requests)
+
+
+def frame_and_form(server: HTTPServer, reads: List[bytes]) -> int:
+    parser = HTTPRequestParser()
+    formed = 0
+    for data in reads:
+        parser.feed(data)
+        while True:
+            raw_request = parser.next_request()
+            if raw_request is None:
+                break
+            server.form_http_request(*raw_request)
+            formed += 1
+    return formed
+
+
+def parse_headers_block(file_to_read: io.BytesIO) -> email.message.Message:
+    headers = []
+    while True:
+        next_raw_bytes_line = file_to_read.readline(MAX_LINE_BINARY_LENGTH + 1)
+        if next_raw_bytes_line in (b'\r\n', b'\n', b''):
+            break
+        headers.append(str(next_raw_bytes_line, 'iso-8859-1'))
+    return mail_parser().parsestr(''.join(headers))
+
+
+def form_with_mail_parser(server: HTTPServer, reads: List[bytes]) -> int:
+    """form_http_request as it was: a whole request taken to be in one read."""
+    data = io.BytesIO(reads[0])
+    method, target, http_version = str(data.readline(MAX_LINE_BINARY_LENGTH + 1), 'iso-8859-1').split()
+    headers = parse_headers_block(data)
+    if headers.get('Host') in (server._server_name, f'{server._server_name}:{server._port}'):
+        HTTPRequest(method, target, http_version, dict(headers.items()), data.read())
+    return 1
+
+
+def requests_per_second(form: Callable[[HTTPServer, list], int], server: HTTPServer, sample: list,
+                        duration: float) -> float:
+    for _ in range(WARM_UP_ROUNDS):
+        form(server, sample)
+    formed = 0
+    started_at = perf_counter()
+    while perf_counter() - started_at < duration:
+        for _ in range(100):
+            formed += form(server, sample)
+    return formed / (perf_counter() - started_at)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--duration', type=float, default=1.0, help='seconds spent on each sample')
+    args = parser.parse_args()
+
+    server = HTTPServer('127.0.0.1', 0, 'localhost', executor=None, collector=None)
+    server._server_socket.close()
+    results: Dict[str, List[str]] = {}
+    for name, reads in SAMPLES.items():
+        alone = requests_per_second(form_framed, server, frame(reads), args.duration)
+        framed = requests_per_second(frame_and_form, server, reads, args.duration)
+        old = requests_per_second(form_with_mail_parser, server, reads, args.duration) \
+            if name in MAIL_PARSER_SAMPLES else None
+        results[name] = [f'{alone:,.0f}', f'{framed:,.0f}', f'{old:,.0f}' if old else '-']
+    print(f'{"requests":<22}  {"formed, req/s":>14}  {"framed and formed, req/s":>25}  {"formed as it was, req/s":>24}')
+    for name, (alone, framed, old) in results.items():
+        print(f'{name:<22}  {alone:>14}  {framed:>25}  {old:>24}')
+
+
+if __name__ == '__main__':
+    main()
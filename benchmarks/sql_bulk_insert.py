@@ -0,0 +1,88 @@
+"""Time the inserts of the PostgreSQL executor.
+
+The script writes batches of generated posts through PostgreSQLExecutor.insert, which sends
+the users and the posts as multi-row statements, and through the statement-per-post insert
+it replaced, and reports the rows per second of each. The tables are dropped and recreated
+before each run, the same as the executor does on start. Any PostgreSQL server will do;
+the credentials default to the ones of the .env file, e.g.
+
+    docker run --rm -d -p 5432:5432 -e POSTGRES_PASSWORD=bench postgres
+    python benchmarks/sql_bulk_insert.py --host localhost --port 5432 --user postgres --password bench \\
+        --database postgres"""
+
+import argparse
+import os
+import sys
+import uuid
+from time import perf_counter
+from typing import Callable, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settings
+from crud_executors.sql_executor import Credentials, PostgreSQLExecutor, SQLConnector
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+POSTS_PER_USER = 5
+
+
+def generate_posts(posts_num: int) -> List[str]:
+    """Lines laid out as utils.pattern_keys, a few posts per user, as a crawl collects them."""
+    run_tag = uuid.uuid4().hex[:6]
+    return [
+        f'{uuid.uuid1().hex};https://www.reddit.com/r/bench/comments/{number}/;'
+        f'u{run_tag}_{number // POSTS_PER_USER};{number % 999};{number % 9999};{number % 99999};'
+        f'2015-03-{number % 28 + 1:02d};2021-11-{number % 28 + 1:02d};{number % 500};{number % 9000};bench'
+        for number in range(posts_num)
+    ]
+
+
+def insert_in_bulk(executor: PostgreSQLExecutor, posts: List[str]) -> int:
+    inserted_ids = executor.insert(posts)
+    return 1 if isinstance(inserted_ids, str) else len(inserted_ids)
+
+
+def insert_row_by_row(executor: PostgreSQLExecutor, posts: List[str]) -> int:
+    """The insert as it was before the bulk one: a statement per post, in one transaction."""
+    from utils import inline_values_to_dict
+    queries = [executor._query_builder.insert_to_users_and_posts(inline_values_to_dict(post)) for post in posts]
+    return len(executor._do(queries, multiple=True))
+
+
+METHODS = {'bulk': insert_in_bulk, 'row-by-row': insert_row_by_row}
+
+
+def time_insert(executor: PostgreSQLExecutor, insert: Callable[[PostgreSQLExecutor, List[str]], int],
+                posts_num: int) -> float:
+    executor._drop_outdated_tables()
+    executor._create_new_tables()
+    posts = generate_posts(posts_num)
+    started_at = perf_counter()
+    inserted_num = insert(executor, posts)
+    elapsed = perf_counter() - started_at
+    if inserted_num != posts_num:
+        raise SystemExit(f'{inserted_num} of {posts_num} posts inserted. Check the server log.')
+    return posts_num / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default=settings.POSTGRES_HOST)
+    parser.add_argument('--port', default=settings.POSTGRES_PORT)
+    parser.add_argument('--database', default=settings.POSTGRES_DATABASE)
+    parser.add_argument('--user', default=settings.POSTGRES_DB_USER)
+    parser.add_argument('--password', default=settings.POSTGRES_PASSWORD)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='posts per batch')
+    parser.add_argument('--methods', nargs='+', choices=METHODS, default=list(METHODS), help='inserts to time')
+    args = parser.parse_args()
+
+    credentials = Credentials(args.host, args.port, args.database, args.user, args.password)
+    executor = PostgreSQLExecutor(SQLConnector(credentials, min_size=1, max_size=1))
+    print(f'{"posts":>8}  ' + '  '.join(f'{method + ", rows/s":>20}' for method in args.methods))
+    for posts_num in args.sizes:
+        rates = [time_insert(executor, METHODS[method], posts_num) for method in args.methods]
+        print(f'{posts_num:>8}  ' + '  '.join(f'{rate:>20,.0f}' for rate in rates))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,308 @@
 """Collect and keep temporarily parsed data.
 
-The module allows to append to a list, checking for duplicates, and keep parsed data
-to be later on manipulated via webserver with corresponding executor tools."""
+The module allows to append to a queue, checking for duplicates, and keep parsed data
+to be later on manipulated via webserver with corresponding executor tools.
+Duplicates are told by the post url, looked up in a hash index. A collector of bounded
+capacity makes the producers await until the webserver drains some of the entries.
+The spilling collector keeps only a small window of entries in RAM, while the rest are
+appended to segment files on disk and read back memory-mapped, and the post urls seen are
+told by a Bloom filter of fixed size kept in a file. The shared collector hands the entries
+out to the forked webserver workers."""
 
-from typing import List
+import asyncio
+import hashlib
+import logging
+import math
+import mmap
+import multiprocessing
+import os
+import threading
+import utils
+from collections import deque
+from itertools import count
+from typing import Iterator, List, Optional, Tuple
+
+POST_URL_INDEX = utils.pattern_keys.index('post_url')
+SPACE_WAIT_TIMEOUT = 1
+SPILL_SEGMENT_SIZE = 16 * 1024 * 1024
+SEEN_FILTER_ERROR_RATE = 1e-6
+SEEN_FILTER_HEADROOM = 2
+
+
+class BloomFilter:
+    """A set of strings of fixed size, laid out in a memory map of the file given or an anonymous one.
+
+    It never forgets a string added, but may claim to hold one it was never given, at about the
+    error rate it is sized for as long as no more than the capacity of strings are added."""
+
+    def __init__(self, capacity: int, error_rate: float, path: Optional[str] = None) -> None:
+        capacity = max(capacity, 1)
+        self._bits_num = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._hashes_num = max(1, round(self._bits_num / capacity * math.log(2)))
+        size = (self._bits_num + 7) // 8
+        if path is None:
+            self._bits = mmap.mmap(-1, size)
+            return
+        with open(path, 'w+b') as f:
+            f.truncate(size)
+            self._bits = mmap.mmap(f.fileno(), size)
+        os.remove(path)
+
+    def _positions(self, item: str) -> Iterator[int]:
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        position, step = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        for _ in range(self._hashes_num):
+            yield position % self._bits_num
+            position += step
+
+    def __contains__(self, item: str) -> bool:
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def add(self, item: str) -> None:
+        bits = self._bits
+        for position in self._positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
 
 
 class ValidDataCollector:
 
-    def __init__(self, posts_for_parsing_num) -> None:
+    def __init__(self, posts_for_parsing_num, capacity: Optional[int] = None) -> None:
         self.posts_for_parsing_num = posts_for_parsing_num
-        self.__valid_data = []
+        self._capacity = capacity
+        self._entries = deque()
+        self._seen = set()
+        self._collected_total = 0
+        self.__space_freed = threading.Condition()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def identity(data: str) -> str:
+        return data.split(';', POST_URL_INDEX + 1)[POST_URL_INDEX]
+
+    def _append(self, data: str) -> None:
+        self._entries.append(data)
+
+    def _popleft(self) -> str:
+        return self._entries.popleft()
+
+    def _pending(self) -> List[str]:
+        return list(self._entries)
+
+    def _clear_pending(self) -> None:
+        self._entries.clear()
+
+    def collect(self, data: str) -> bool:
+        if data is None:
+            return False
+        post_identity = self.identity(data)
+        with self.__space_freed:
+            if post_identity in self._seen:
+                return False
+            self._seen.add(post_identity)
+            self._collected_total += 1
+            self._append(data)
+        return True
+
+    def _wait_for_space(self) -> None:
+        with self.__space_freed:
+            if self.is_saturated:
+                self.__space_freed.wait(SPACE_WAIT_TIMEOUT)
+
+    async def put(self, data: str) -> bool:
+        """Collect the data, awaiting free space if the collector is of bounded capacity."""
+        while self.is_saturated:
+            await asyncio.to_thread(self._wait_for_space)
+        return self.collect(data)
+
+    def get_one_entry(self) -> str:
+        with self.__space_freed:
+            entry = self._popleft()
+            self.__space_freed.notify()
+        return entry
+
+    def clear(self) -> None:
+        with self.__space_freed:
+            self._clear_pending()
+            self.__space_freed.notify_all()
+
+    def drain(self) -> List[str]:
+        """Take all of the entries out at once."""
+        with self.__space_freed:
+            entries = self._pending()
+            self._clear_pending()
+            self.__space_freed.notify_all()
+        return entries
+
+    @property
+    def data(self) -> List[str]:
+        with self.__space_freed:
+            return self._pending()
+
+    @property
+    def collected_total(self) -> int:
+        return self._collected_total
+
+    @property
+    def is_full(self) -> bool:
+        return len(self) == self.posts_for_parsing_num
+
+    @property
+    def is_empty(self) -> bool:
+        return len(self) == 0
+
+    @property
+    def is_saturated(self) -> bool:
+        return bool(self._capacity) and len(self) >= self._capacity
+
+
+class SpillingDataCollector(ValidDataCollector):
+    """Keep the oldest entries in RAM and spill the newer ones to append-only segment files.
+
+    The window is refilled from the oldest segment once drained, and a segment is removed
+    as soon as it is read through. The post urls seen are told by a Bloom filter mapped from
+    a file in the spill dir, sized once for twice the posts number, so the RAM footprint does
+    not grow as the posts are collected. The price is that about one post in a million may be
+    wrongly taken for a duplicate and skipped."""
+
+    def __init__(self, posts_for_parsing_num, spill_dir_path: str, window_size: int,
+                 capacity: Optional[int] = None) -> None:
+        super().__init__(posts_for_parsing_num, capacity)
+        self._seen = BloomFilter(capacity=SEEN_FILTER_HEADROOM * posts_for_parsing_num,
+                                 error_rate=SEEN_FILTER_ERROR_RATE,
+                                 path=f'{spill_dir_path}{os.sep}reddit-collector-{os.getpid()}.seen')
+        self._spill_dir_path = spill_dir_path
+        self._window_size = window_size
+        self._segments = deque()
+        self._segment_numbers = count()
+        self._active_segment = None
+        self._read_offset = 0
+        self._spilled_count = 0
 
     def __len__(self) -> int:
-        return len(self.__valid_data)
+        return len(self._entries) + self._spilled_count
+
+    def _new_segment(self) -> None:
+        path = f'{self._spill_dir_path}{os.sep}reddit-collector-{os.getpid()}-{next(self._segment_numbers)}.spill'
+        self._active_segment = open(path, 'ab')
+        self._segments.append(path)
+        logging.info(f'Collector spills to a new segment {path}')
+
+    def _spill(self, data: str) -> None:
+        if self._active_segment is None or self._active_segment.tell() >= SPILL_SEGMENT_SIZE:
+            if self._active_segment is not None:
+                self._active_segment.close()
+            self._new_segment()
+        self._active_segment.write(data.encode('utf-8') + b'\n')
+        self._spilled_count += 1
 
-    def collect(self, data: str) -> None:
-        if data is not None and data not in self.__valid_data:
-            self.__valid_data.append(data)
+    def _append(self, data: str) -> None:
+        if self._spilled_count or len(self._entries) >= self._window_size:
+            self._spill(data)
+            return
+        self._entries.append(data)
+
+    def _drop_head_segment(self) -> None:
+        path = self._segments.popleft()
+        if self._active_segment is not None and self._active_segment.name == path:
+            self._active_segment.close()
+            self._active_segment = None
+        os.remove(path)
+        self._read_offset = 0
+
+    @staticmethod
+    def _read_lines(path: str, offset: int, limit: Optional[int] = None) -> Tuple[List[str], int]:
+        if os.path.getsize(path) <= offset:
+            return [], offset
+        lines = []
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as segment:
+            while offset < len(segment) and (limit is None or len(lines) < limit):
+                line_end = segment.find(b'\n', offset)
+                lines.append(segment[offset:line_end].decode('utf-8'))
+                offset = line_end + 1
+        return lines, offset
+
+    def _refill_window(self) -> None:
+        if self._active_segment is not None:
+            self._active_segment.flush()
+        while self._segments and len(self._entries) < self._window_size:
+            lines, self._read_offset = self._read_lines(self._segments[0], self._read_offset,
+                                                        self._window_size - len(self._entries))
+            self._entries.extend(lines)
+            self._spilled_count -= len(lines)
+            if not lines or self._read_offset >= os.path.getsize(self._segments[0]):
+                self._drop_head_segment()
+
+    def _popleft(self) -> str:
+        if not self._entries:
+            self._refill_window()
+        return self._entries.popleft()
+
+    def _pending(self) -> List[str]:
+        if self._active_segment is not None:
+            self._active_segment.flush()
+        pending = list(self._entries)
+        read_offset = self._read_offset
+        for path in self._segments:
+            lines, _ = self._read_lines(path, read_offset)
+            pending.extend(lines)
+            read_offset = 0
+        return pending
+
+    def _clear_pending(self) -> None:
+        self._entries.clear()
+        while self._segments:
+            self._drop_head_segment()
+        self._spilled_count = 0
+
+
+class SharedDataCollector:
+    """Hand the collected entries out to the forked webserver workers, one worker per entry.
+
+    The entries are laid out in an anonymous shared memory map before the workers are forked,
+    and the index of the next entry to hand out is a counter shared by all of the workers."""
+
+    def __init__(self, collector: ValidDataCollector) -> None:
+        context = multiprocessing.get_context('fork')
+        entries = [entry.encode('utf-8') for entry in collector.data]
+        collector.clear()
+        self.posts_for_parsing_num = collector.posts_for_parsing_num
+        self._offsets = [0]
+        for entry in entries:
+            self._offsets.append(self._offsets[-1] + len(entry))
+        self._entries = mmap.mmap(-1, max(self._offsets[-1], 1))
+        self._entries.write(b''.join(entries))
+        self._next_index = context.Value('i', 0)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1 - self._next_index.value
+
+    def _read(self, index: int) -> str:
+        return self._entries[self._offsets[index]:self._offsets[index + 1]].decode('utf-8')
 
     def get_one_entry(self) -> str:
-        return self.__valid_data.pop(0)
+        with self._next_index.get_lock():
+            index = self._next_index.value
+            if index >= len(self._offsets) - 1:
+                raise IndexError('get_one_entry from an empty collector')
+            self._next_index.value += 1
+        return self._read(index)
 
     def clear(self) -> None:
-        self.__valid_data.clear()
+        with self._next_index.get_lock():
+            self._next_index.value = len(self._offsets) - 1
+
+    def drain(self) -> List[str]:
+        with self._next_index.get_lock():
+            first_index = self._next_index.value
+            self._next_index.value = len(self._offsets) - 1
+        return [self._read(index) for index in range(first_index, len(self._offsets) - 1)]
 
     @property
     def data(self) -> List[str]:
-        return self.__valid_data
+        return [self._read(index) for index in range(self._next_index.value, len(self._offsets) - 1)]
 
     @property
     def is_full(self) -> bool:
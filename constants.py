@@ -7,6 +7,13 @@ PAGE_LAYOUT = {
     "buttons": "//button[@role='menuitem']"
 }
 
+POST = {
+    "elem": "div",
+    "attrs": {"class": "Post"},
+    "selector": "div.Post",
+    "taken_marker": "data-scraper-taken"
+}
+
 POST_URL = {
     "elem": "a",
     "attrs": {"class": "_3jOxDPIQ0KaOWpzvSQo-1s"}
@@ -39,14 +46,13 @@ CATEGORY = {
 }
 
 CAKEDAY = {
-    "elem": "span",
-    "attrs": {"id": "profile--id-card--highlight-tooltip--cakeday"}
+    "xpath": "//span[@id='profile--id-card--highlight-tooltip--cakeday']/text()"
 }
 
 KARMA = {
-    "elem": "script",
-    "attrs": {"id": "data"},
-    "post": r'"fromPosts":[\d]*',
-    "comment": r'"fromComments":[\d]*',
-    "total": r'"total":[\d]*'
+    "xpath": "//script[@id='data']/text()",
+    "pattern": r'"(fromPosts|fromComments|total)":(\d*)',
+    "post": "fromPosts",
+    "comment": "fromComments",
+    "total": "total"
 }
@@ -10,6 +10,7 @@ from typing import Optional, Union, Any, Dict, List
 
 
 class BaseCrudExecutor(ABC):
+    is_process_safe = True
 
     @abstractmethod
     def insert(self, collected_data: Union[str, List[str]]) -> Union[str, List[str]]:
@@ -19,6 +20,10 @@ class BaseCrudExecutor(ABC):
     def find(self, unique_id: str = None) -> Union[Dict[str, Any], List[Dict[str, Any]], None]:
         pass
 
+    @abstractmethod
+    def find_page(self, after: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        pass
+
     @abstractmethod
     def update(self, data: Dict[str, str], unique_id: str) -> Optional[bool]:
         pass
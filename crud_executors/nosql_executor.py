@@ -25,43 +25,43 @@ class MongoConnector(metaclass=Singleton):
     def __init__(self, host: str = MONGO_HOST, port: int = MONGO_PORT):
         self._host = host
         self._port = port
-        self._client = None
 
     @property
     def client(self) -> pymongo.mongo_client.MongoClient:
+        """A new client for the caller to close, none being kept on the connector shared by the executor threads."""
+        client = None
         try:
-            self._client = MongoClient(host=MONGO_HOST, port=MONGO_PORT, connectTimeoutMS=MAX_CONNECTION_WAIT)
+            client = MongoClient(host=MONGO_HOST, port=MONGO_PORT, connectTimeoutMS=MAX_CONNECTION_WAIT)
         except (Exception, pymongo.errors.ConnectionFailure) as e:
             logging.error(f'Warning from MongoDB. Exception occurred --> {e}.')
-        return self._client
+        return client
 
 
 class ClientSessionDecorator:
+    """Open a client for each call of the query method. The decorator is shared by the calls made
+    from the executor threads at once, so the client and the collections of a call stay local to it."""
 
     def __init__(self, query_method: Callable, connector: MongoConnector = MongoConnector(),
                  db_name: str = MONGO_DB_NAME):
         self._query_builder = QueryBuilder()
         self._query_method = query_method
         self._connector = connector
-        self._results = None
         self._db = db_name
-        self._posts = None
-        self._users = None
 
     def __call__(self, *args, **kwargs):
         with self._connector.client as client:
             db = client[self._db]
-            self._posts = db['posts']
-            self._users = db['users']
-            if self._query_method.__name__ in ('find', 'check_entry'):
-                return self._query_method(self, *args, **kwargs, posts_collection=self._posts)
+            posts_collection = db['posts']
+            users_collection = db['users']
+            if self._query_method.__name__ in ('find', 'find_page', 'check_entry'):
+                return self._query_method(self, *args, **kwargs, posts_collection=posts_collection)
             return self._query_method(self, *args, **kwargs,
-                                      posts_collection=self._posts, users_collection=self._users)
+                                      posts_collection=posts_collection, users_collection=users_collection)
 
     def _check_entry_exists(self, unique_id: str, posts_collection: pymongo.collection.Collection) -> Optional[str]:
-        self._results = posts_collection.aggregate(pipeline=self._query_builder.check_for_user(unique_id))
+        results = posts_collection.aggregate(pipeline=self._query_builder.check_for_user(unique_id))
         try:
-            return list(self._results)[0]["user"]
+            return list(results)[0]["user"]
         except IndexError:
             return
 
@@ -139,6 +139,16 @@ class QueryBuilder:
             return id_matching + lookup_retrieval
         return lookup_retrieval
 
+    def retrieve_page(self, after: Optional[str], limit: int) \
+            -> List[Union[Dict[str, str], Dict[str, Dict[str, str]]]]:
+        page_matching = [
+            {"$sort": {"_id": 1}},
+            {"$limit": limit}
+        ]
+        if after:
+            page_matching.insert(0, {"$match": {"_id": {"$gt": after}}})
+        return page_matching + self.retrieve()
+
     def check_for_user(self, unique_id: str):
         return [
             {
@@ -204,6 +214,12 @@ class MongoExecutor(BaseCrudExecutor):
         search_results = posts_collection.aggregate(pipeline=self._query_builder.retrieve())
         return list(search_results)
 
+    @ClientSessionDecorator
+    def find_page(self, after: Optional[str] = None, limit: int = 100,
+                  posts_collection: pymongo.collection.Collection = None) -> List[Dict[str, str]]:
+        search_results = posts_collection.aggregate(pipeline=self._query_builder.retrieve_page(after, limit))
+        return list(search_results)
+
     @ClientSessionDecorator
     def update(self, new_doc: Dict[str, str], unique_id: str,
                posts_collection: pymongo.collection.Collection,
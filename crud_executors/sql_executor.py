@@ -3,20 +3,35 @@
 Methods of PostreSQL-executor use those of
 SQL-QueryBuilder to form specific queries to database
 and send back info to the Webserver.
+
+The connections are taken from a bounded pool, which keeps them open
+between the queries, checks the long idle ones before handing them out
+and replaces the broken ones.
 """
 import datetime
 import logging
+import os
+import threading
+import time
 import settings
 import utils
 import psycopg2
+import psycopg2.pool
+from psycopg2.extras import execute_values
 from collections import namedtuple
-from typing import List, Dict, Union, Any, Tuple
+from contextlib import contextmanager
+from typing import List, Dict, Union, Any, Tuple, Optional, Iterator
 from .base_crud_executor import BaseCrudExecutor
 from .singleton_connector import Singleton
 
 Credentials = namedtuple('Credentials', ['host', 'port', 'database', 'user', 'password'])
 PSQL_CREDENTIALS = Credentials(settings.POSTGRES_HOST, settings.POSTGRES_PORT, settings.POSTGRES_DATABASE,
                                settings.POSTGRES_DB_USER, settings.POSTGRES_PASSWORD)
+POSTGRES_POOL_MIN_SIZE = settings.POSTGRES_POOL_MIN_SIZE
+POSTGRES_POOL_MAX_SIZE = settings.POSTGRES_POOL_MAX_SIZE
+POSTGRES_POOL_TIMEOUT = settings.POSTGRES_POOL_TIMEOUT
+POSTGRES_HEALTH_CHECK_IDLE = settings.POSTGRES_HEALTH_CHECK_IDLE
+POSTGRES_BULK_PAGE_SIZE = settings.POSTGRES_BULK_PAGE_SIZE
 
 
 class QueryBuilder:
@@ -100,6 +115,28 @@ class QueryBuilder:
         %(comments_number)s, %(votes_number)s, %(user_name)s) RETURNING unique_id;
         """, query_parameters
 
+    @staticmethod
+    def bulk_insert_to_users() -> str:
+        return """INSERT INTO users (user_name, comment_karma, post_karma, total_karma, user_cakeday)
+        VALUES %s ON CONFLICT (user_name) DO NOTHING;"""
+
+    @staticmethod
+    def bulk_insert_to_posts() -> str:
+        return """INSERT INTO posts (unique_id, post_url, post_date, post_category, comments_number,
+        votes_number, user_name) VALUES %s RETURNING unique_id;"""
+
+    @staticmethod
+    def users_row(post_as_dict: Dict[str, str]) -> Tuple[Optional[str], ...]:
+        return (post_as_dict.get("user_name", ""), post_as_dict.get("comment_karma", ""),
+                post_as_dict.get("post_karma", ""), post_as_dict.get("total_karma", ""),
+                post_as_dict.get("user_cakeday"))
+
+    @staticmethod
+    def posts_row(post_as_dict: Dict[str, str]) -> Tuple[Optional[str], ...]:
+        return (post_as_dict.get("unique_id"), post_as_dict.get("post_url", ""), post_as_dict.get("post_date"),
+                post_as_dict.get("post_category", ""), post_as_dict.get("comments_number", ""),
+                post_as_dict.get("votes_number", ""), post_as_dict.get("user_name", ""))
+
     @staticmethod
     def retrieve_from_posts_and_users(unique_id: str = None) -> str:
         general_query = """SELECT 
@@ -111,6 +148,18 @@ class QueryBuilder:
             return f"{general_query} WHERE unique_id = '{unique_id}';"
         return f"{general_query} ORDER BY unique_id;"
 
+    @staticmethod
+    def retrieve_page_from_posts_and_users(after: Optional[str], limit: int) -> Tuple[str, Dict[str, Any]]:
+        general_query = """SELECT 
+            posts.unique_id, posts.post_url, posts.user_name, users.comment_karma, users.post_karma, users.total_karma,
+            users.user_cakeday, posts.post_date, posts.comments_number, posts.votes_number, posts.post_category
+            FROM posts NATURAL JOIN users
+            """
+        query_parameters = {'after': after, 'limit': limit}
+        if after:
+            return f"{general_query} WHERE unique_id > %(after)s ORDER BY unique_id LIMIT %(limit)s;", query_parameters
+        return f"{general_query} ORDER BY unique_id LIMIT %(limit)s;", query_parameters
+
     @staticmethod
     def delete_from_posts(unique_id: str) -> str:
         return f"""WITH deleted_post_info AS (DELETE FROM posts * WHERE unique_id = '{unique_id}' RETURNING user_name) 
@@ -123,52 +172,147 @@ class QueryBuilder:
 
 
 class SQLConnector(metaclass=Singleton):
+    """Hand out the connections to the database out of a bounded thread-safe pool.
+
+    Up to max_size connections are opened, min_size of them beforehand,
+    and kept open once returned to the pool. A connection which has been idle for over POSTGRES_HEALTH_CHECK_IDLE
+    seconds is pinged before being handed out, and a broken one is replaced.
+    The pool belongs to the process which opened it, a forked process starts its own."""
 
-    def __init__(self, credentials: namedtuple = PSQL_CREDENTIALS):
+    def __init__(self, credentials: namedtuple = PSQL_CREDENTIALS, min_size: int = POSTGRES_POOL_MIN_SIZE,
+                 max_size: int = POSTGRES_POOL_MAX_SIZE, timeout: Union[int, float] = POSTGRES_POOL_TIMEOUT):
         self._credentials = credentials._asdict()
-        self._connection = None
+        self._min_size = min_size
+        self._max_size = max(max_size, min_size, 1)
+        self._timeout = timeout
+        self._released = threading.Condition()
+        self._reset()
 
-    def __enter__(self):
-        self._establish_connection()
+    def _reset(self) -> None:
+        self._pid = os.getpid()
+        self._idle: List[Tuple[psycopg2.extensions.connection, float]] = []
+        self._opened_num = 0
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self._close_connection()
+    def _connect(self) -> psycopg2.extensions.connection:
+        return psycopg2.connect(**self._credentials)
 
-    def _establish_connection(self):
+    @staticmethod
+    def _is_healthy(connection: psycopg2.extensions.connection, idle_since: float) -> bool:
+        if connection.closed:
+            return False
+        if time.monotonic() - idle_since < POSTGRES_HEALTH_CHECK_IDLE:
+            return True
         try:
-            self._connection = psycopg2.connect(**self._credentials)
-        except (Exception, psycopg2.DatabaseError) as e:
-            logging.error(e)
-
-    def _close_connection(self):
-        if self._connection:
-            self._connection.commit()
-            self._connection.close()
-
-    @property
-    def cursor(self):
-        return self._connection.cursor()
+            with connection.cursor() as cur:
+                cur.execute('SELECT 1;')
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, connection: psycopg2.extensions.connection) -> None:
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+        with self._released:
+            self._opened_num -= 1
+            self._released.notify()
+
+    def _checkout(self) -> psycopg2.extensions.connection:
+        deadline = time.monotonic() + self._timeout
+        while True:
+            with self._released:
+                if self._pid != os.getpid():
+                    self._reset()
+                while not self._idle and self._opened_num >= self._max_size:
+                    time_left = deadline - time.monotonic()
+                    if time_left <= 0:
+                        raise psycopg2.pool.PoolError(f'No connection got free in {self._timeout} seconds')
+                    self._released.wait(time_left)
+                if self._idle:
+                    connection, idle_since = self._idle.pop()
+                else:
+                    connection, idle_since = None, None
+                    self._opened_num += 1
+            if connection is None:
+                try:
+                    return self._connect()
+                except psycopg2.Error:
+                    with self._released:
+                        self._opened_num -= 1
+                        self._released.notify()
+                    raise
+            if self._is_healthy(connection, idle_since):
+                return connection
+            logging.warning('Broken connection to PostgreSQL replaced.')
+            self._discard(connection)
+
+    def _release(self, connection: psycopg2.extensions.connection) -> None:
+        with self._released:
+            if self._pid != os.getpid():
+                return
+            if connection.closed or len(self._idle) >= self._max_size:
+                self._opened_num -= 1
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._released.notify()
+
+    @contextmanager
+    def connection(self) -> Iterator[psycopg2.extensions.connection]:
+        """Lend a connection for one transaction, committed unless an exception is raised."""
+        connection = self._checkout()
+        try:
+            yield connection
+            connection.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self._discard(connection)
+            raise
+        except BaseException:
+            if not connection.closed:
+                connection.rollback()
+            self._release(connection)
+            raise
+        self._release(connection)
+
+    def fill(self) -> None:
+        """Open the connections up to min_size beforehand."""
+        while True:
+            with self._released:
+                if self._opened_num >= self._min_size:
+                    return
+                self._opened_num += 1
+            try:
+                connection = self._connect()
+            except psycopg2.Error as e:
+                logging.error(f'Failed to connect to PostgreSQL ---> {e}')
+                with self._released:
+                    self._opened_num -= 1
+                return
+            with self._released:
+                self._idle.append((connection, time.monotonic()))
+
+    def close(self) -> None:
+        with self._released:
+            idle, self._idle = self._idle, []
+            self._opened_num -= len(idle)
+        for connection, _ in idle:
+            connection.close()
 
 
 class PostgreSQLExecutor(BaseCrudExecutor):
 
-    def __init__(self, connection: psycopg2._ext.connection = SQLConnector(), query_builder=QueryBuilder()):
-        self._connection = connection
+    def __init__(self, connector: Optional[SQLConnector] = None, query_builder=QueryBuilder()):
+        self._connector = connector or SQLConnector()
         self._query_builder = query_builder
-        self._execution_results = []
+        self._connector.fill()
         self._drop_outdated_tables()
         self._create_new_tables()
 
-    def __enter__(self):
-        self._connection.cursor()
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self._connection.cursor().close()
-
     def _do(self, queries: List[Union[str, Tuple[str, Dict[str, str]]]], fetch=False, multiple=False) \
             -> Union[None, List[str], List[Tuple[str]], List[Tuple[str, datetime.date]]]:
-        with self._connection, self._connection.cursor as cur:
-            self._execution_results.clear()
+        execution_results = []
+        with self._connector.connection() as connection, connection.cursor() as cur:
             for query in queries:
                 try:
                     if isinstance(query, Tuple):
@@ -176,13 +320,15 @@ class PostgreSQLExecutor(BaseCrudExecutor):
                     if isinstance(query, str):
                         cur.execute(query)
                     if multiple:
-                        self._execution_results.append(cur.fetchone()[0])
+                        execution_results.append(cur.fetchone()[0])
                     if fetch:
-                        self._execution_results = cur.fetchall()
+                        execution_results = cur.fetchall()
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    raise
                 except (Exception, psycopg2.ProgrammingError) as e:
                     logging.error(f'Exception occurred --> {e}.')
                     continue
-            return self._execution_results
+        return execution_results
 
     def _drop_outdated_tables(self) -> None:
         query = self._query_builder.drop_tables()
@@ -196,13 +342,32 @@ class PostgreSQLExecutor(BaseCrudExecutor):
         if isinstance(collected_data, str):
             collected_data = [collected_data]
         posts_as_dicts = [utils.inline_values_to_dict(line) for line in collected_data]
-        queries = [self._query_builder.insert_to_users_and_posts(post) for post in posts_as_dicts]
-        self._do(queries, multiple=True)
-        inserted_ids = self._execution_results
+        inserted_ids = self._insert_in_bulk(posts_as_dicts)
         if len(inserted_ids) == 1:
             return inserted_ids[0]
         return inserted_ids
 
+    def _insert_in_bulk(self, posts_as_dicts: List[Dict[str, str]]) -> List[str]:
+        """Insert the posts in one transaction: the users, deduplicated beforehand, in one multi-row
+        statement, then the posts in another, instead of a statement and a round-trip per post."""
+        users = {}
+        for post in posts_as_dicts:
+            users.setdefault(post.get("user_name", ""), post)
+        users_rows = [self._query_builder.users_row(post) for post in users.values()]
+        posts_rows = [self._query_builder.posts_row(post) for post in posts_as_dicts]
+        try:
+            with self._connector.connection() as connection, connection.cursor() as cur:
+                execute_values(cur, self._query_builder.bulk_insert_to_users(), users_rows,
+                               page_size=POSTGRES_BULK_PAGE_SIZE)
+                inserted_rows = execute_values(cur, self._query_builder.bulk_insert_to_posts(), posts_rows,
+                                               page_size=POSTGRES_BULK_PAGE_SIZE, fetch=True)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            raise
+        except (Exception, psycopg2.ProgrammingError) as e:
+            logging.error(f'Exception occurred --> {e}.')
+            return []
+        return [row[0] for row in inserted_rows]
+
     def find(self, unique_id: str = None) -> Union[Dict[str, Any], List[Dict[str, Any]], None]:
         query = self._query_builder.retrieve_from_posts_and_users(unique_id)
         results = self._do([query], fetch=True)
@@ -210,6 +375,11 @@ class PostgreSQLExecutor(BaseCrudExecutor):
             formatted_results = [utils.info_from_sql_db_to_dict(result) for result in results]
             return formatted_results
 
+    def find_page(self, after: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        query = self._query_builder.retrieve_page_from_posts_and_users(after, limit)
+        results = self._do([query], fetch=True)
+        return [utils.info_from_sql_db_to_dict(result) for result in results]
+
     def update(self, data: Dict[str, str], unique_id: str) -> bool:
         upd_query = self._query_builder.insert_to_users_and_posts(data, unique_id)
         results = self._do([upd_query], fetch=True)
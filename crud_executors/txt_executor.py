@@ -1,96 +1,450 @@
 """Executor of CRUD operations upon to a txt instance.
 
-The module gives methods to check if a previous output txt-file exists and
-remove this file (when being instantiated), as well as to touch a new file
-and perform CRUD upon it."""
+The entries are kept in a segmented append-only store in the reddit-store folder
+of the target directory, which outlives the runs. The entries are appended to the
+active segment, which is sealed and zlib-compressed once it reaches its size limit,
+and a new one is started. A manifest lists the segments along with the number of
+live entries and the garbage in each, so that the scans skip the segments with
+nothing live, and the compaction picks the ones worth rewriting.
 
+An update appends a new version of the entry, a delete appends a tombstone,
+a line with the unique_id alone. An in-memory index keeps the segment, the offset
+and the length of the latest version of each entry, so that an entry is read
+straight away: through mmap from the active segment, or out of the decompressed
+sealed one, the last few of which are cached. The pages are cut by unique_id,
+as the database executors do, out of a sorted list of the unique_ids.
+
+The writes go through a persistent buffered handle, a batch of entries making
+one sequential write. How often the written data is fsynced is up to the policy:
+after every write, every so many milliseconds, or never, leaving it to the OS."""
+
+import atexit
+import json
 import logging
+import mmap
 import os
-import re
+import threading
+import time
+import zlib
+import settings
 import utils
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
 from datetime import datetime
-from typing import List, Optional, Union, Dict, Any
+from uuid import UUID
+from typing import List, Optional, Union, Dict, Any, Tuple, Iterator
 from .base_crud_executor import BaseCrudExecutor
 
+TXT_SEGMENT_SIZE = settings.TXT_SEGMENT_SIZE
+TXT_COMPRESSION_LEVEL = settings.TXT_COMPRESSION_LEVEL
+TXT_WRITE_BUFFER_SIZE = settings.TXT_WRITE_BUFFER_SIZE
+TXT_FSYNC_POLICY = settings.TXT_FSYNC_POLICY
+TXT_FSYNC_INTERVAL = settings.TXT_FSYNC_INTERVAL
+FSYNC_POLICIES = ('always', 'interval', 'never')
+STORE_DIR_NAME = 'reddit-store'
+MANIFEST_FILE_NAME = 'manifest.json'
+SEGMENTS_CACHED = 2
+COMPACTION_GARBAGE_RATIO = 0.5
 
-class TxtInstanceManager:
+Location = Tuple[int, int, int]
 
-    def __init__(self, target_dir_path: str) -> None:
-        self.__target_dir_path = target_dir_path
-        self._remove_old_file()
 
-    def _remove_old_file(self) -> None:
-        old_file_exists = re.search('reddit-[0-9]{12}.txt', ''.join(os.listdir(self.__target_dir_path)))
-        if old_file_exists:
-            old_file_name = old_file_exists.group()
-            logging.info(f'Previous txt-file {old_file_name} is being purged.')
-            os.remove(f'{self.__target_dir_path}{os.sep}{old_file_name}')
-            return
-        logging.info(f'Previous txt-file was never detected.')
+class Segment:
+    __slots__ = ('number', 'sealed', 'size', 'live', 'garbage')
 
-    def calculate_filename(self) -> str:
-        logging.info(f'New txt-file is being created --- {datetime.now()}')
-        return f'{self.__target_dir_path}{os.sep}reddit-{datetime.now().strftime("%Y%m%d%H%M")}.txt'
+    def __init__(self, number: int, sealed: bool = False, size: int = 0, live: int = 0, garbage: int = 0) -> None:
+        self.number = number
+        self.sealed = sealed
+        self.size = size
+        self.live = live
+        self.garbage = garbage
 
     @property
-    def filename_calculated(self) -> re.Match:
-        return re.search('reddit-[0-9]{12}.txt', ''.join(os.listdir(self.__target_dir_path)))
+    def file_name(self) -> str:
+        return f'segment-{self.number:06d}.txt' + ('.zlib' if self.sealed else '')
 
     @property
-    def path_to_new_file(self) -> str:
-        return f'{self.__target_dir_path}{os.sep}{self.filename_calculated.group()}'
+    def is_worth_compacting(self) -> bool:
+        return self.sealed and self.size and self.garbage >= self.size * COMPACTION_GARBAGE_RATIO
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'number': self.number, 'file': self.file_name, 'sealed': self.sealed,
+                'size': self.size, 'live': self.live, 'garbage': self.garbage}
+
+
+class TxtInstanceManager:
+    """Keep the segments of the store on the disk, along with the manifest describing them."""
+
+    def __init__(self, target_dir_path: str, segment_size: int = TXT_SEGMENT_SIZE,
+                 compression_level: int = TXT_COMPRESSION_LEVEL, fsync_policy: str = TXT_FSYNC_POLICY,
+                 fsync_interval: int = TXT_FSYNC_INTERVAL) -> None:
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f'Unknown fsync policy {fsync_policy}. Choose one of {", ".join(FSYNC_POLICIES)}')
+        self._store_dir_path = f'{target_dir_path}{os.sep}{STORE_DIR_NAME}'
+        self._segment_size = segment_size
+        self._compression_level = compression_level
+        self._fsync_policy = fsync_policy
+        self._fsync_interval = fsync_interval / 1000
+        self._segments: OrderedDict = OrderedDict()
+        self._decompressed: OrderedDict = OrderedDict()
+        self._active_file = None
+        self._active_mmap = None
+        self._flushed_size = 0
+        self._is_synced = True
+        self._synced_at = time.monotonic()
+        os.makedirs(self._store_dir_path, exist_ok=True)
+        self._load_manifest()
+
+    def segment_path(self, segment: Segment) -> str:
+        return f'{self._store_dir_path}{os.sep}{segment.file_name}'
+
+    @property
+    def manifest_path(self) -> str:
+        return f'{self._store_dir_path}{os.sep}{MANIFEST_FILE_NAME}'
+
+    @property
+    def active_segment(self) -> Segment:
+        return next(reversed(self._segments.values()))
+
+    def _load_manifest(self) -> None:
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+            logging.info(f'Txt-store {self._store_dir_path} is being reopened --- {datetime.now()}')
+        except FileNotFoundError:
+            logging.info(f'New txt-store is being created at {self._store_dir_path} --- {datetime.now()}')
+            manifest = {'segments': []}
+        for segment_info in manifest['segments']:
+            segment = Segment(segment_info['number'], segment_info['sealed'])
+            self._segments[segment.number] = segment
+            if segment.sealed:
+                self._remove_leftover(Segment(segment.number))
+        if not self._segments or self.active_segment.sealed:
+            self._start_segment()
+        self._open_active_segment()
+        self.active_segment.size = self._flushed_size = self._active_file.tell()
+
+    def _open_active_segment(self) -> None:
+        self._active_file = open(self.segment_path(self.active_segment), 'ab', buffering=TXT_WRITE_BUFFER_SIZE)
+        self._flushed_size = 0
+
+    def _remove_leftover(self, segment: Segment) -> None:
+        """Remove the uncompressed copy of a segment, left by a run which stopped while sealing it."""
+        try:
+            os.remove(self.segment_path(segment))
+        except FileNotFoundError:
+            pass
+
+    def save_manifest(self) -> None:
+        manifest = {'segments': [segment.as_dict() for segment in self._segments.values()]}
+        with open(f'{self.manifest_path}.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(f'{self.manifest_path}.tmp', self.manifest_path)
+
+    def _start_segment(self) -> None:
+        number = self.active_segment.number + 1 if self._segments else 1
+        self._segments[number] = Segment(number)
+        self.save_manifest()
+
+    def _rotate(self) -> None:
+        """Seal the active segment, compressing it, and start a new one."""
+        segment = self.active_segment
+        self._active_file.close()
+        if self._active_mmap is not None:
+            self._active_mmap.close()
+            self._active_mmap = None
+        raw_path = self.segment_path(segment)
+        with open(raw_path, 'rb') as f:
+            data = f.read()
+        segment.sealed = True
+        self._write_compressed(segment, data)
+        self._start_segment()
+        os.remove(raw_path)
+        self._open_active_segment()
+        logging.info(f'Txt-store segment {segment.number} sealed, {len(data)} bytes --- {datetime.now()}')
+
+    def _write_compressed(self, segment: Segment, data: bytes) -> None:
+        path = self.segment_path(segment)
+        with open(f'{path}.tmp', 'wb') as f:
+            f.write(zlib.compress(data, self._compression_level))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{path}.tmp', path)
+        self._decompressed.pop(segment.number, None)
+
+    def _read_segment(self, segment: Segment) -> Union[bytes, mmap.mmap]:
+        if not segment.sealed:
+            if not segment.size:
+                return b''
+            if self._flushed_size < segment.size:
+                self._flush()
+            if self._active_mmap is None or len(self._active_mmap) < segment.size:
+                if self._active_mmap is not None:
+                    self._active_mmap.close()
+                with open(self.segment_path(segment), 'rb') as f:
+                    self._active_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._active_mmap
+        data = self._decompressed.get(segment.number)
+        if data is None:
+            with open(self.segment_path(segment), 'rb') as f:
+                data = zlib.decompress(f.read())
+            self._decompressed[segment.number] = data
+            if len(self._decompressed) > SEGMENTS_CACHED:
+                self._decompressed.popitem(last=False)
+        else:
+            self._decompressed.move_to_end(segment.number)
+        return data
+
+    def _append(self, lines: List[bytes]) -> int:
+        """Write the lines in one go to the buffer of the active segment, syncing them as the policy says."""
+        segment = self.active_segment
+        offset = segment.size
+        self._active_file.writelines(lines)
+        segment.size += sum(len(line) for line in lines)
+        self._is_synced = False
+        if self._fsync_policy == 'always':
+            self._sync()
+        elif self._fsync_policy == 'interval' and time.monotonic() - self._synced_at >= self._fsync_interval:
+            self._sync()
+        return offset
+
+    def _flush(self) -> None:
+        self._active_file.flush()
+        self._flushed_size = self.active_segment.size
+
+    def _sync(self) -> None:
+        self._flush()
+        os.fsync(self._active_file.fileno())
+        self._is_synced = True
+        self._synced_at = time.monotonic()
 
 
 class TxtExecutor(BaseCrudExecutor, TxtInstanceManager):
+    is_process_safe = False
+
+    def __init__(self, target_dir_path: str, segment_size: int = TXT_SEGMENT_SIZE,
+                 compression_level: int = TXT_COMPRESSION_LEVEL, fsync_policy: str = TXT_FSYNC_POLICY,
+                 fsync_interval: int = TXT_FSYNC_INTERVAL) -> None:
+        self._lock = threading.RLock()
+        self._index: Dict[str, Location] = {}
+        self._ordered_ids: Optional[List[str]] = None
+        self._compaction = None
+        self._closed = threading.Event()
+        super().__init__(target_dir_path, segment_size, compression_level, fsync_policy, fsync_interval)
+        self._build_index()
+        if self._fsync_policy == 'interval':
+            threading.Thread(target=self._sync_periodically, name='txt-fsync', daemon=True).start()
+        atexit.register(self.close)
+
+    def _sync_periodically(self) -> None:
+        """Sync the data written since the last sync, so that it never waits for a sync longer than the interval,
+        even with no writes to come."""
+        while not self._closed.wait(self._fsync_interval):
+            with self._lock:
+                if not self._is_synced and not self._active_file.closed:
+                    self._sync()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._closed.is_set():
+                return
+            self._closed.set()
+            if self._fsync_policy == 'never':
+                self._flush()
+            else:
+                self._sync()
+            self._active_file.close()
+            self.save_manifest()
+
+    @staticmethod
+    def _scan(data: Union[bytes, mmap.mmap], end: int = None) -> Iterator[Tuple[str, int, int, bool]]:
+        """Yield the unique_id, offset, length and whether it is a tombstone for each line of the data."""
+        offset = 0
+        end = len(data) if end is None else end
+        while offset < end:
+            line_end = data.find(b'\n', offset, end)
+            if line_end == -1:
+                break
+            separator = data.find(b';', offset, line_end)
+            if separator == -1:
+                yield data[offset:line_end].decode('utf-8'), offset, line_end + 1 - offset, True
+            else:
+                yield data[offset:separator].decode('utf-8'), offset, line_end + 1 - offset, False
+            offset = line_end + 1
+
+    def _apply(self, unique_id: str, location: Location, is_tombstone: bool) -> None:
+        """Bring the line to the index and account for the garbage it makes, keeping the sorted
+        unique_ids in step once they are built."""
+        outdated = self._index.pop(unique_id, None)
+        if outdated is not None:
+            outdated_segment = self._segments[outdated[0]]
+            outdated_segment.live -= 1
+            outdated_segment.garbage += outdated[2]
+        segment = self._segments[location[0]]
+        if is_tombstone:
+            segment.garbage += location[2]
+            if outdated is not None and self._ordered_ids is not None:
+                del self._ordered_ids[bisect_left(self._ordered_ids, unique_id)]
+            return
+        segment.live += 1
+        self._index[unique_id] = location
+        if outdated is None and self._ordered_ids is not None:
+            insort(self._ordered_ids, unique_id)
+
+    def _build_index(self) -> None:
+        for segment in self._segments.values():
+            data = self._read_segment(segment)
+            segment.size, segment.live, segment.garbage = len(data), 0, 0
+            for unique_id, offset, length, is_tombstone in self._scan(data):
+                self._apply(unique_id, (segment.number, offset, length), is_tombstone)
+        self.save_manifest()
+        logging.info(f'Index of {len(self._index)} entries built out of {len(self._segments)} segments '
+                     f'--- {datetime.now()}')
 
-    def __init__(self, target_dir_path: str) -> None:
-        super().__init__(target_dir_path)
+    def _read(self, location: Location) -> str:
+        segment_number, offset, length = location
+        data = self._read_segment(self._segments[segment_number])
+        return data[offset:offset + length].decode('utf-8')
 
-    def insert(self, post) -> str:
-        unique_id = post.split(';')[0]
-        if self.filename_calculated:
-            with open(self.path_to_new_file, 'a') as f:
-                f.write(post + '\n')
-                return unique_id
-        with open(self.calculate_filename(), 'w') as f:
-            f.write(post + '\n')
-            return unique_id
+    def _write_versions(self, lines: List[str]) -> List[str]:
+        encoded_lines = [line.encode('utf-8') for line in lines]
+        unique_ids = []
+        with self._lock:
+            segment_number = self.active_segment.number
+            offset = self._append(encoded_lines)
+            for unique_id, line_offset, length, is_tombstone in self._scan(b''.join(encoded_lines)):
+                self._apply(unique_id, (segment_number, offset + line_offset, length), is_tombstone)
+                unique_ids.append(unique_id)
+            if self.active_segment.size >= self._segment_size:
+                self._rotate()
+        self._compact_if_needed()
+        return unique_ids
+
+    def iter_entries(self) -> Iterator[Dict[str, Any]]:
+        """Stream the live entries segment by segment, so that only one segment is held at a time."""
+        for segment in list(self._segments.values()):
+            with self._lock:
+                if not segment.live or segment.number not in self._segments:
+                    continue
+                data = self._read_segment(segment)
+                entries = [
+                    utils.inline_values_to_dict(data[offset:offset + length].decode('utf-8'))
+                    for unique_id, offset, length, is_tombstone in self._scan(data, segment.size)
+                    if not is_tombstone and self._index.get(unique_id) == (segment.number, offset, length)
+                ]
+            yield from entries
+
+    def insert(self, collected_data: Union[str, List[str]]) -> Union[str, List[str]]:
+        posts = [collected_data] if isinstance(collected_data, str) else collected_data
+        inserted_ids = self._write_versions([post.rstrip('\n') + '\n' for post in posts])
+        if len(inserted_ids) == 1:
+            return inserted_ids[0]
+        return inserted_ids
 
     def find(self, unique_id: str = None) -> Union[Dict[str, Any], List[Dict[str, Any]], None]:
-        with open(self.path_to_new_file, 'r') as f:
-            already_written_lines = f.readlines()
         if unique_id is None:
-            return [utils.inline_values_to_dict(line) for line in already_written_lines]
-        for line in already_written_lines:
-            if line.startswith(unique_id):
-                return utils.inline_values_to_dict(line)
+            return list(self.iter_entries())
+        with self._lock:
+            location = self._index.get(unique_id)
+            if location is not None:
+                return utils.inline_values_to_dict(self._read(location))
+
+    @staticmethod
+    def _page_key(after: str) -> str:
+        try:
+            return UUID(after).hex
+        except ValueError:
+            return after
+
+    def find_page(self, after: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """Take the entries with the unique_ids next to the one given, whether or not it is still in the store."""
+        with self._lock:
+            if self._ordered_ids is None:
+                self._ordered_ids = sorted(self._index)
+            first = bisect_right(self._ordered_ids, self._page_key(after)) if after else 0
+            return [utils.inline_values_to_dict(self._read(self._index[unique_id]))
+                    for unique_id in self._ordered_ids[first:first + limit]]
 
     def update(self, data: Dict[str, Any], unique_id: str) -> Optional[bool]:
-        update_performed = False
-        with open(self.path_to_new_file, 'r+') as f:
-            already_written_lines = f.readlines()
-            f.seek(0)
-            for line in already_written_lines:
-                if line.startswith(unique_id):
-                    line = utils.dict_to_values_inline(data)
-                    update_performed = True
-                f.write(line)
-            f.truncate()
-        return update_performed
+        with self._lock:
+            if unique_id not in self._index:
+                return False
+            self._write_versions([utils.dict_to_values_inline({**data, 'unique_id': unique_id})])
+        return True
 
     def delete(self, unique_id: str) -> Optional[bool]:
-        deletion_performed = False
-        with open(self.path_to_new_file, 'r+') as f:
-            already_written_lines = f.readlines()
-            f.seek(0)
-            for line in already_written_lines:
-                if not line.startswith(unique_id):
-                    f.write(line)
-            f.truncate()
-            f.seek(0)
-            if len(f.readlines()) != len(already_written_lines):
-                deletion_performed = True
-        return deletion_performed
-
-    def insert_all_remaining(self, posts: List[str]) -> None:
-        pass
+        with self._lock:
+            if unique_id not in self._index:
+                return False
+            self._write_versions([f'{unique_id}\n'])
+        return True
+
+    def insert_all_remaining(self, posts: List[str]) -> Union[str, List[str]]:
+        return self.insert(posts)
+
+    def _compact_if_needed(self) -> None:
+        with self._lock:
+            if self._compaction is not None:
+                return
+            if not any(segment.is_worth_compacting for segment in self._segments.values()):
+                return
+            self._compaction = threading.Thread(target=self.compact, name='txt-compaction', daemon=True)
+            self._compaction.start()
+
+    def compact(self) -> None:
+        """Rewrite the sealed segments which are mostly garbage, keeping the latest versions of the entries only."""
+        try:
+            with self._lock:
+                segment_numbers = [segment.number for segment in self._segments.values()
+                                   if segment.is_worth_compacting]
+            for segment_number in segment_numbers:
+                self._compact_segment(segment_number)
+        except OSError as e:
+            logging.error(f'Compaction of the txt-store failed ---> {e}')
+        finally:
+            with self._lock:
+                self._compaction = None
+
+    def _compact_segment(self, segment_number: int) -> None:
+        """Copy the live entries of the segment without holding the lock, then swap the segment
+        and move the index over to it, leaving out the entries changed meanwhile.
+
+        The tombstones are kept unless the segment is the oldest one, since the older segments
+        may still hold the versions they cancel. The kept ones are not counted as garbage any more."""
+        with self._lock:
+            segment = self._segments.get(segment_number)
+            if segment is None:
+                return
+            data = bytes(self._read_segment(segment))
+            keeps_tombstones = segment_number != next(iter(self._segments))
+        kept_lines = []
+        moves = []
+        compacted_size = 0
+        for unique_id, offset, length, is_tombstone in self._scan(data):
+            if is_tombstone and not keeps_tombstones:
+                continue
+            if not is_tombstone:
+                if self._index.get(unique_id) != (segment_number, offset, length):
+                    continue
+                moves.append((unique_id, offset, compacted_size, length))
+            kept_lines.append(data[offset:offset + length])
+            compacted_size += length
+
+        with self._lock:
+            reclaimed_size = segment.size - compacted_size
+            if compacted_size:
+                self._write_compressed(segment, b''.join(kept_lines))
+            entries_size = sum(length for _, _, _, length in moves)
+            segment.size, segment.live, segment.garbage = compacted_size, 0, entries_size
+            for unique_id, offset, compacted_offset, length in moves:
+                if self._index.get(unique_id) == (segment_number, offset, length):
+                    self._index[unique_id] = (segment_number, compacted_offset, length)
+                    segment.live += 1
+                    segment.garbage -= length
+            if not compacted_size:
+                del self._segments[segment_number]
+                self._decompressed.pop(segment_number, None)
+                os.remove(self.segment_path(segment))
+            self.save_manifest()
+        logging.info(f'Txt-store segment {segment_number} compacted, {reclaimed_size} bytes reclaimed '
+                     f'--- {datetime.now()}')
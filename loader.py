@@ -5,23 +5,32 @@ Its main task is to load enough raw into to be further refined
 by the parser module."""
 
 import logging
-from typing import List
+from typing import List, Union
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.common.exceptions import WebDriverException, NoSuchElementException
 from bs4 import BeautifulSoup
 from time import time
 from datetime import datetime
-from constants import PAGE_LAYOUT
+from constants import PAGE_LAYOUT, POST
+from metrics import crawl_stage_seconds
 
 MAX_WAIT_TIME = 30
 
+TAKE_NEW_POSTS_SCRIPT = """
+const [selector, marker, limit] = arguments;
+const posts = Array.from(document.querySelectorAll(`${selector}:not([${marker}])`)).slice(0, limit);
+posts.forEach(post => post.setAttribute(marker, ''));
+return posts.map(post => post.outerHTML);
+"""
+
 
 class Loader:
 
-    def __init__(self, page_to_scrape: str, webdriver_path: str) -> None:
+    def __init__(self, page_to_scrape: str, webdriver_path: str, incremental: bool = True) -> None:
         self._page_to_scrape = page_to_scrape
         self._webdriver_path = webdriver_path
+        self._incremental = incremental
         self._driver = None
         self._loading_start_index = 0
 
@@ -57,22 +66,79 @@ class Loader:
         except NoSuchElementException as e:
             logging.error(e)
 
-    def load_posts(self, posts_to_load_count: int) -> List[BeautifulSoup]:
+    def load_posts(self, posts_to_load_count: int, raw: bool = False) -> List[Union[str, BeautifulSoup]]:
+        """Load posts either as soups, or as raw html to be parsed out of the event loop."""
+        if self._incremental:
+            posts_html = self._load_new_posts(posts_to_load_count)
+            if raw:
+                return posts_html
+            with crawl_stage_seconds.time(stage='soup_parse'):
+                fragment = BeautifulSoup(''.join(posts_html), features="lxml")
+                return fragment.findAll(POST["elem"], attrs=POST["attrs"])
+        posts = self._load_posts_from_page_source(posts_to_load_count)
+        if raw:
+            return [str(post) for post in posts]
+        return posts
+
+    def _scroll_down(self) -> None:
+        try:
+            scroll_down = "window.scrollBy(0,3000);"
+            with crawl_stage_seconds.time(stage='scroll'):
+                self._driver.execute_script(scroll_down)
+        except WebDriverException as e:
+            logging.error(e)
+
+    def _take_new_posts_html(self, posts_to_take_count: int) -> List[str]:
+        try:
+            with crawl_stage_seconds.time(stage='take_new_posts'):
+                return self._driver.execute_script(TAKE_NEW_POSTS_SCRIPT, POST["selector"],
+                                                   POST["taken_marker"], posts_to_take_count)
+        except WebDriverException as e:
+            logging.error(e)
+            return []
+
+    def _load_new_posts(self, posts_to_load_count: int) -> List[str]:
+        """Hand out only those posts that were not taken on the previous passes.
+
+        The posts already handed out are tagged in the DOM by the injected script,
+        so every pass transfers the newly rendered posts only."""
+
+        logging.info(f'Incrementally loading dynamic content of the webpage {self._page_to_scrape} '
+                     f'--- {datetime.now()}')
+        start_time = time()
+        posts = []
+
+        while True:
+            self._scroll_down()
+            posts.extend(self._take_new_posts_html(posts_to_load_count - len(posts)))
+            time_spent = time() - start_time
+            if len(posts) >= posts_to_load_count:
+                logging.info(f'Loading of dynamic content finished --- {datetime.now()}.'
+                             f'Collected data on {len(posts)} for {time_spent} seconds.')
+                break
+            if time_spent > MAX_WAIT_TIME:
+                logging.warning(f'Max waiting time exceeded. Collected data on {len(posts)} '
+                                f'for {MAX_WAIT_TIME} seconds.')
+                break
+
+        self._loading_start_index += len(posts)
+
+        return posts
+
+    def _load_posts_from_page_source(self, posts_to_load_count: int) -> List[BeautifulSoup]:
 
         logging.info(f'Loading dynamic content of the webpage {self._page_to_scrape} '
                      f'--- {datetime.now()}')
         start_time = time()
 
         while True:
-            try:
-                scroll_down = "window.scrollBy(0,3000);"
-                self._driver.execute_script(scroll_down)
-            except WebDriverException as e:
-                logging.error(e)
-            content = self._driver.page_source
-            soup = BeautifulSoup(content, features="lxml")
-            posts = soup.findAll('div', attrs={"class": "Post"},
-                                 limit=self._loading_start_index + posts_to_load_count)[self._loading_start_index:]
+            self._scroll_down()
+            with crawl_stage_seconds.time(stage='page_source'):
+                content = self._driver.page_source
+            with crawl_stage_seconds.time(stage='soup_parse'):
+                soup = BeautifulSoup(content, features="lxml")
+                posts = soup.findAll(POST["elem"], attrs=POST["attrs"],
+                                     limit=self._loading_start_index + posts_to_load_count)[self._loading_start_index:]
             time_spent = time() - start_time
             if len(posts) == posts_to_load_count:
                 logging.info(f'Loading of dynamic content finished --- {datetime.now()}.'
@@ -12,9 +12,12 @@ from time import time
 from datetime import datetime
 from argparser import argparser
 from loader import Loader
-from collector import ValidDataCollector
+from collector import ValidDataCollector, SpillingDataCollector
 from webserver import HTTPServer
 from manager import Manager
+from metrics import instrument_executor
+from profile_cache import ProfileCache
+from request_controller import RequestController
 from crud_executors import (
     base_crud_executor, sql_executor, nosql_executor, txt_executor
 )
@@ -23,12 +26,14 @@ from crud_executors import (
 class ExecutorType:
 
     @staticmethod
-    def txt(target_dir: str) -> base_crud_executor.BaseCrudExecutor:
-        return txt_executor.TxtExecutor(target_dir)
+    def txt(target_dir: str, fsync_policy: str, fsync_interval: int) -> base_crud_executor.BaseCrudExecutor:
+        return txt_executor.TxtExecutor(target_dir, fsync_policy=fsync_policy, fsync_interval=fsync_interval)
 
     @staticmethod
-    def sql() -> base_crud_executor.BaseCrudExecutor:
-        return sql_executor.PostgreSQLExecutor()
+    def sql(credentials: sql_executor.Credentials, pool_min_size: int,
+            pool_max_size: int) -> base_crud_executor.BaseCrudExecutor:
+        connector = sql_executor.SQLConnector(credentials, min_size=pool_min_size, max_size=pool_max_size)
+        return sql_executor.PostgreSQLExecutor(connector)
 
     @staticmethod
     def nosql() -> base_crud_executor.BaseCrudExecutor:
@@ -37,16 +42,36 @@ class ExecutorType:
 
 if __name__ == '__main__':
     args = argparser.parse_args()
+    if args.server_workers > 1 and (args.serve_early or args.collector_capacity):
+        argparser.error('--serve-early and --collector-capacity need the webserver to run along with the crawl, '
+                        'which is only possible with a single server worker')
     logging.basicConfig(filename=f'{args.target_dir_path}{os.sep}reddit-scraper.log',
                         filemode='w', level=logging.INFO)
 
-    current_executor = ExecutorType().nosql()
+    current_executor = instrument_executor(ExecutorType().nosql())
 
-    current_loader = Loader(webdriver_path=args.chromedriver_path, page_to_scrape=args.url)
-    current_collector = ValidDataCollector(posts_for_parsing_num=args.number)
+    current_loader = Loader(webdriver_path=args.chromedriver_path, page_to_scrape=args.url,
+                            incremental=not args.full_page_loading)
+    if args.collector_window:
+        current_collector = SpillingDataCollector(posts_for_parsing_num=args.number,
+                                                  spill_dir_path=args.target_dir_path,
+                                                  window_size=args.collector_window,
+                                                  capacity=args.collector_capacity)
+    else:
+        current_collector = ValidDataCollector(posts_for_parsing_num=args.number, capacity=args.collector_capacity)
     current_server = HTTPServer(host=args.host, port=args.port, server_name=args.server,
-                                executor=current_executor, collector=current_collector)
-    manager = Manager(loader=current_loader, collector=current_collector, server=current_server)
+                                executor=current_executor, collector=current_collector,
+                                workers=args.server_workers, backlog=args.backlog,
+                                response_cache=not args.autosave, max_connections=args.max_connections,
+                                idle_timeout=args.idle_timeout)
+    profiles_file_path = f'{args.target_dir_path}{os.sep}reddit-profiles.json' if args.persist_profiles else None
+    current_profile_cache = ProfileCache(persistence_path=profiles_file_path)
+    current_request_controller = RequestController(rate=args.profile_rate,
+                                                   max_concurrency=args.profile_max_concurrency)
+    manager = Manager(loader=current_loader, collector=current_collector, server=current_server,
+                      profile_cache=current_profile_cache, parse_workers=args.parse_workers,
+                      request_controller=current_request_controller, serve_early=args.serve_early,
+                      persistence_executor=current_executor if args.autosave else None)
 
     start_time = datetime.now()
     logging.info(f'Reddit-scraper launched --- {start_time}. CRUD-executor: {current_executor}')
@@ -54,5 +79,6 @@ if __name__ == '__main__':
     try:
         asyncio.run(manager.run())
     except KeyboardInterrupt:
+        current_server.flush_queued_posts()
         logging.info(f'Program terminated --- {datetime.now()}. '
                      f'Duration: {time() - start_time.timestamp()} seconds.')
@@ -1,40 +1,71 @@
 """Order the instructions.
 
 The module helps manage the methods supplied by the main operating modules:
-loader -> parser -> collector -> webserver feat executor."""
+loader -> parser -> collector -> webserver feat executor.
+
+The crawl runs as a streaming pipeline of stages linked with bounded queues:
+loader -> parser workers -> collector -> (optionally) persistence. The stages overlap,
+and a full queue holds back the stage feeding it."""
 
 import logging
 import asyncio
+import threading
 import settings
+from collections import Counter
 from datetime import datetime
 from time import time
-from typing import List
+from typing import Optional
 from loader import Loader
-from parser import Parser
+from aiohttp import ClientSession
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from parser import Parser, open_profile_session
 from collector import ValidDataCollector
+from profile_cache import ProfileCache
+from request_controller import RequestController
 from webserver import HTTPServer
+from crud_executors.base_crud_executor import BaseCrudExecutor
 
 TOTAL_MAX_WAIT_TIME = settings.TOTAL_MAX_WAIT_TIME
+PIPELINE_QUEUE_SIZE = settings.PIPELINE_QUEUE_SIZE
+PIPELINE_PARSERS_NUM = settings.PIPELINE_PARSERS_NUM
+PIPELINE_PERSIST_BATCH = settings.PIPELINE_PERSIST_BATCH
+PIPELINE_REPORT_INTERVAL = settings.PIPELINE_REPORT_INTERVAL
+
+END_OF_STREAM = object()
 
 
 class Manager:
 
-    def __init__(self, loader: Loader, collector: ValidDataCollector, server: HTTPServer):
+    def __init__(self, loader: Loader, collector: ValidDataCollector, server: HTTPServer,
+                 profile_cache: ProfileCache = None, parse_workers: int = 0,
+                 request_controller: RequestController = None, serve_early: bool = False,
+                 persistence_executor: Optional[BaseCrudExecutor] = None):
         self._loader = loader
         self._collector = collector
         self._server = server
-
-    def get_posts_to_parse(self) -> List:
-        posts_to_load_count = self._collector.posts_for_parsing_num - len(self._collector)
-        return self._loader.load_posts(posts_to_load_count)
-
-    @staticmethod
-    async def parse_posts(posts_to_parse: List) -> List:
-        return await asyncio.gather(*(Parser(post).get_all_info() for post in posts_to_parse))
-
-    def collect_valid_info(self, results: List) -> None:
-        for result in results:
-            self._collector.collect(result)
+        self._profile_cache = profile_cache if profile_cache is not None else ProfileCache()
+        self._parse_workers = parse_workers
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        self._request_controller = request_controller if request_controller is not None else RequestController()
+        self._serve_early = serve_early
+        self._persistence_executor = persistence_executor
+        self._server_thread: Optional[threading.Thread] = None
+        self._stage_counts = Counter()
+        self._in_flight = 0
+        self._progress = None
+        self._crawl_started_at = None
+
+    @property
+    def _target_reached(self) -> bool:
+        return self._stage_counts['collected'] >= self._collector.posts_for_parsing_num
+
+    def _open_process_pool(self):
+        if self._parse_workers > 0:
+            self._process_pool = ProcessPoolExecutor(max_workers=self._parse_workers)
+            logging.info(f'Parsing is handed to {self._parse_workers} worker processes.')
+            return self._process_pool
+        return nullcontext()
 
     async def start_server(self):
         try:
@@ -42,26 +73,133 @@ class Manager:
         except KeyboardInterrupt:
             logging.info('Server stopped with KeyBoard')
 
-    async def run(self) -> None:
-        with self._loader:
-
-            start_time = time()
-
-            while not self._collector.is_full:
-                posts_to_parse = self.get_posts_to_parse()
-                parsing_results = await self.parse_posts(posts_to_parse)
-                self.collect_valid_info(parsing_results)
-                logging.info(f'{len(self._collector)} posts in collector')
-
-                time_spent = time() - start_time
-                if time_spent > TOTAL_MAX_WAIT_TIME:
-                    logging.warning(f'Maximum wait time threshold of '
-                                    f'{TOTAL_MAX_WAIT_TIME} exceeded.'
-                                    f'--- {datetime.now()}.')
-                    break
-            logging.info(f'Collector is filled with valid parsed data. '
-                         f'Collected info on {len(self._collector)}')
+    def _start_server_in_background(self) -> None:
+        logging.info(f'Server is being launched while the crawl goes on. --- {datetime.now()}.')
+        self._server_thread = threading.Thread(target=self._server.run_forever, name='webserver', daemon=True)
+        self._server_thread.start()
 
+    async def run(self) -> None:
+        with self._loader, self._open_process_pool():
+            async with open_profile_session() as session:
+                await self._crawl(session)
+        self._process_pool = None
+        logging.info(f'Profile cache stats: {self._profile_cache.stats}')
+        logging.info(f'Profile requests stats: {self._request_controller.stats}')
+        self._profile_cache.save()
+
+        if self._server_thread is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._server_thread.join)
+            return
         logging.info(f'Server is being launched. --- {datetime.now()}.')
         await self.start_server()
 
+    async def _crawl(self, session: ClientSession) -> None:
+        posts_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        results_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        persistence_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        self._progress = asyncio.Event()
+        self._crawl_started_at = time()
+
+        parsers = [asyncio.create_task(self._parse_stage(session, posts_queue, results_queue))
+                   for _ in range(PIPELINE_PARSERS_NUM)]
+        collecting = asyncio.create_task(self._collect_stage(results_queue, persistence_queue))
+        persisting = asyncio.create_task(self._persist_stage(persistence_queue))
+        reporting = asyncio.create_task(self._report_stage(posts_queue, results_queue, persistence_queue))
+
+        try:
+            await asyncio.wait_for(self._load_stage(posts_queue), timeout=TOTAL_MAX_WAIT_TIME)
+        except asyncio.TimeoutError:
+            logging.warning(f'Maximum wait time threshold of '
+                            f'{TOTAL_MAX_WAIT_TIME} exceeded.'
+                            f'--- {datetime.now()}.')
+
+        for _ in parsers:
+            await posts_queue.put(END_OF_STREAM)
+        await asyncio.gather(*parsers)
+        await results_queue.put(END_OF_STREAM)
+        await collecting
+        await persistence_queue.put(END_OF_STREAM)
+        await persisting
+        reporting.cancel()
+
+        self._report_progress(posts_queue, results_queue, persistence_queue)
+        logging.info(f'Collector is filled with valid parsed data. '
+                     f'Collected info on {self._stage_counts["collected"]}')
+
+    async def _load_stage(self, posts_queue: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        while not self._target_reached:
+            posts_to_load_count = (self._collector.posts_for_parsing_num
+                                   - self._stage_counts['collected'] - self._in_flight)
+            if posts_to_load_count <= 0:
+                self._progress.clear()
+                await self._progress.wait()
+                continue
+            posts = await loop.run_in_executor(None, self._loader.load_posts,
+                                               posts_to_load_count, self._process_pool is not None)
+            self._stage_counts['loaded'] += len(posts)
+            for post in posts:
+                self._in_flight += 1
+                await posts_queue.put(post)
+
+    async def _parse_stage(self, session: ClientSession, posts_queue: asyncio.Queue,
+                           results_queue: asyncio.Queue) -> None:
+        while True:
+            post = await posts_queue.get()
+            if post is END_OF_STREAM:
+                return
+            try:
+                result = await Parser(post, session, self._profile_cache, self._process_pool,
+                                      self._request_controller).get_all_info()
+            except Exception as e:
+                logging.error(f'Failed to parse post ---> {e}')
+                result = None
+            self._stage_counts['parsed'] += 1
+            await results_queue.put(result)
+
+    async def _collect_stage(self, results_queue: asyncio.Queue, persistence_queue: asyncio.Queue) -> None:
+        while True:
+            result = await results_queue.get()
+            if result is END_OF_STREAM:
+                return
+            self._in_flight -= 1
+            if self._collector.is_saturated and self._server_thread is None and not self._server.is_prefork:
+                logging.info('Collector capacity reached. Drain it via webserver to let the crawl go on.')
+                self._start_server_in_background()
+            if await self._collector.put(result):
+                self._stage_counts['collected'] += 1
+                if self._persistence_executor is not None:
+                    await persistence_queue.put(self._collector.get_one_entry())
+                if self._serve_early and self._server_thread is None and not self._server.is_prefork:
+                    self._start_server_in_background()
+            self._progress.set()
+
+    async def _persist_stage(self, persistence_queue: asyncio.Queue) -> None:
+        if self._persistence_executor is None:
+            return
+        loop = asyncio.get_running_loop()
+        stream_ended = False
+        while not stream_ended:
+            batch = [await persistence_queue.get()]
+            while not persistence_queue.empty() and len(batch) < PIPELINE_PERSIST_BATCH:
+                batch.append(persistence_queue.get_nowait())
+            if batch[-1] is END_OF_STREAM:
+                stream_ended = True
+                batch.pop()
+            if batch:
+                await loop.run_in_executor(None, self._persistence_executor.insert, batch)
+                self._stage_counts['persisted'] += len(batch)
+
+    async def _report_stage(self, *queues: asyncio.Queue) -> None:
+        while True:
+            await asyncio.sleep(PIPELINE_REPORT_INTERVAL)
+            self._report_progress(*queues)
+
+    def _report_progress(self, posts_queue: asyncio.Queue, results_queue: asyncio.Queue,
+                         persistence_queue: asyncio.Queue) -> None:
+        time_spent = max(time() - self._crawl_started_at, 1e-9)
+        throughput = ', '.join(f'{stage} {self._stage_counts[stage]} ({self._stage_counts[stage] / time_spent:.2f}/s)'
+                               for stage in ('loaded', 'parsed', 'collected', 'persisted'))
+        logging.info(f'Pipeline: {throughput}. '
+                     f'Queue depths: posts {posts_queue.qsize()}, results {results_queue.qsize()}, '
+                     f'persistence {persistence_queue.qsize()} --- {datetime.now()}')
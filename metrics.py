@@ -0,0 +1,220 @@
+"""Collect the runtime metrics of the scraper and the webserver.
+
+The module keeps a registry of counters, gauges and fixed-bucket histograms,
+labelled by route, executor method, crawl stage and the like, and renders
+them in the Prometheus text format to be served by the webserver at /metrics.
+Recording a value costs a bisect and an update under a lock, so the metrics
+are meant to stay on in production. Each process keeps its own registry."""
+
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LabelValues = Tuple[str, ...]
+
+
+def format_labels(label_names: Tuple[str, ...], label_values: LabelValues, extra: str = '') -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape_label_value(value: Any) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    metric_type = ''
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> None:
+        self._name = name
+        self._documentation = documentation
+        self._label_names = label_names
+        self._lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    def _label_values(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self._label_names)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self._name} {self._documentation}', f'# TYPE {self._name} {self.metric_type}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(self._label_values(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self._name}{format_labels(self._label_names, key)} {format_number(value)}'
+                for key, value in values]
+
+
+class Gauge(Metric):
+    """A value set as it changes, or read from the function given, right when the metrics are rendered."""
+    metric_type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (),
+                 function: Optional[Callable[[], float]] = None) -> None:
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[LabelValues, float] = {}
+        self._function = function
+
+    def set(self, value: float, **labels: Any) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    def samples(self) -> List[str]:
+        if self._function is not None:
+            return [f'{self._name} {format_number(self._function())}']
+        with self._lock:
+            values = list(self._values.items())
+        return [f'{self._name}{format_labels(self._label_names, key)} {format_number(value)}'
+                for key, value in values]
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation, label_names)
+        self._buckets = tuple(sorted(buckets))
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._label_values(labels)
+        bucket_index = bisect_left(self._buckets, value)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self._buckets) + 1)
+                self._sums[key] = 0.0
+            counts[bucket_index] += 1
+            self._sums[key] += value
+
+    @contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        started_at = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started_at, **labels)
+
+    def count(self, **labels: Any) -> int:
+        return sum(self._counts.get(self._label_values(labels), ()))
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            series = [(key, list(counts), self._sums[key]) for key, counts in self._counts.items()]
+        lines = []
+        for key, counts, total in series:
+            cumulative = 0
+            for upper_bound, count in zip(self._buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = format_labels(self._label_names, key, f'le="{format_number(upper_bound)}"')
+                lines.append(f'{self._name}_bucket{labels} {cumulative}')
+            labels = format_labels(self._label_names, key)
+            lines.append(f'{self._name}_sum{labels} {format_number(total)}')
+            lines.append(f'{self._name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Any:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: Tuple[str, ...] = (),
+              function: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._register(Gauge(name, documentation, label_names, function))
+
+    def histogram(self, name: str, documentation: str, label_names: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = MetricsRegistry()
+
+executor_calls_seconds = registry.histogram(
+    'scraper_executor_call_seconds', 'Time spent in the CRUD-executor methods.', ('method',))
+executor_errors_total = registry.counter(
+    'scraper_executor_errors_total', 'CRUD-executor calls that raised.', ('method',))
+crawl_stage_seconds = registry.histogram(
+    'scraper_crawl_stage_seconds', 'Time spent in the crawl stages.', ('stage',))
+
+EXECUTOR_METHODS = ('insert', 'find', 'find_page', 'update', 'delete')
+
+
+def instrument_executor(executor: Any) -> Any:
+    """Time the CRUD-methods of the executor, shadowing them with timed ones on the instance."""
+    for method_name in EXECUTOR_METHODS:
+        method = getattr(executor, method_name, None)
+        if method is not None:
+            setattr(executor, method_name, timed_call(method, method_name))
+    return executor
+
+
+def timed_call(function: Callable, method_name: str) -> Callable:
+    def call(*args, **kwargs):
+        started_at = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            executor_errors_total.inc(method=method_name)
+            raise
+        finally:
+            executor_calls_seconds.observe(perf_counter() - started_at, method=method_name)
+    return call
@@ -6,86 +6,162 @@ import utils
 import re
 import uuid
 import asyncio
-from aiohttp import ClientSession
+from aiohttp import ClientSession, TCPConnector
 from bs4 import BeautifulSoup
-from typing import Union, Optional, Tuple
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from lxml import etree, html as lxml_html
+from typing import Union, Optional, Tuple, Callable, Any
 from datetime import date, timedelta
 from constants import *
+from metrics import crawl_stage_seconds
+from profile_cache import ProfileCache
+from request_controller import RequestController
 
 HEADERS = settings.HEADERS
 TARGET_DIR_PATH = settings.TARGET_DIR_PATH
+PROFILE_CONNECTIONS_LIMIT = settings.PROFILE_CONNECTIONS_LIMIT
+PROFILE_CONNECTIONS_PER_HOST = settings.PROFILE_CONNECTIONS_PER_HOST
+PROFILE_KEEPALIVE_TIMEOUT = settings.PROFILE_KEEPALIVE_TIMEOUT
+PROFILE_DNS_CACHE_TTL = settings.PROFILE_DNS_CACHE_TTL
+
+CAKEDAY_XPATH = etree.XPath(CAKEDAY["xpath"])
+KARMA_XPATH = etree.XPath(KARMA["xpath"])
+KARMA_PATTERN = re.compile(KARMA["pattern"])
+KARMA_KEYS = (KARMA["post"], KARMA["comment"], KARMA["total"])
+
+PostFields = namedtuple('PostFields', ['post_url', 'user_name', 'user_link', 'post_date',
+                                       'comments_number', 'votes_number', 'post_category'])
+
+
+def open_profile_session() -> ClientSession:
+    """Open the session shared by all the profile requests of a crawl run.
+
+    Must be called from within a running event loop and closed by the caller."""
+    connector = TCPConnector(limit=PROFILE_CONNECTIONS_LIMIT,
+                             limit_per_host=PROFILE_CONNECTIONS_PER_HOST,
+                             keepalive_timeout=PROFILE_KEEPALIVE_TIMEOUT,
+                             ttl_dns_cache=PROFILE_DNS_CACHE_TTL)
+    return ClientSession(connector=connector, headers=HEADERS, trust_env=True)
+
+
+def parse_user_profile(profile_html: bytes) -> Optional[Tuple[str, ...]]:
+    """Pick the karma triple and the cakeday out of a raw user profile page.
+
+    Only the two needed nodes are looked up in the lxml tree, and the karma
+    fields are read from the text of the json-payload in a single regex pass."""
+    try:
+        profile_tree = lxml_html.fromstring(profile_html)
+    except (etree.ParserError, ValueError):
+        return
+    cakeday_found = CAKEDAY_XPATH(profile_tree)
+    if not cakeday_found:
+        return
+    karma_section = ''.join(KARMA_XPATH(profile_tree))
+    karma = utils.get_first_matches(KARMA_PATTERN, karma_section, KARMA_KEYS)
+    post_karma, comment_karma, total_karma = (karma.get(key) for key in KARMA_KEYS)
+    if all([post_karma, comment_karma, total_karma]):
+        return post_karma, comment_karma, total_karma, str(cakeday_found[0])
+
+
+def get_post_url(post: BeautifulSoup) -> str:
+    return utils.get_link(post.find(POST_URL["elem"], attrs=POST_URL["attrs"]))
+
+
+def get_post_date(post: BeautifulSoup) -> str:
+    published_days_ago = utils.get_contents(post.find(POST_DATE["elem"], attrs=POST_DATE["attrs"]))
+    return str(date.today() - timedelta(days=int(published_days_ago)))
+
+
+def get_user_name(post: BeautifulSoup) -> str:
+    return utils.get_name(post.find(USER_NAME["elem"], attrs=USER_NAME["attrs"]))
+
+
+def get_user_link(post: BeautifulSoup) -> str:
+    return utils.get_link(post.find(USER_NAME["elem"], attrs=USER_NAME["attrs"]))
+
+
+def get_comments_number(post: BeautifulSoup) -> str:
+    comments_section = post.find(COMMENTS["elem"], attrs=COMMENTS["attrs"])
+    comments_subsection_exists = comments_section.find(COMMENTS["elem"], attrs=COMMENTS["sub_attrs"])
+    if comments_subsection_exists:
+        return utils.get_subcontents(comments_subsection_exists)
+    return utils.get_contents(comments_section)
+
+
+def get_votes_number(post: BeautifulSoup) -> str:
+    return utils.get_subcontents(post.find(VOTES["elem"], attrs=VOTES["attrs"]))
+
+
+def get_post_category(post: BeautifulSoup) -> str:
+    return utils.get_category(post.find(CATEGORY["elem"], attrs=CATEGORY["attrs"]))
+
+
+def parse_post(post: Union[str, BeautifulSoup]) -> PostFields:
+    """Pick the fields out of a listing post, given either as a soup or as raw html.
+
+    Returns a plain tuple, so the function may as well run in a worker process."""
+    if isinstance(post, str):
+        post = BeautifulSoup(post, features='lxml')
+    return PostFields(get_post_url(post), get_user_name(post), get_user_link(post), get_post_date(post),
+                      get_comments_number(post), get_votes_number(post), get_post_category(post))
 
 
 class Parser:
 
-    def __init__(self, post: BeautifulSoup) -> None:
+    def __init__(self, post: Union[str, BeautifulSoup], session: ClientSession,
+                 profile_cache: Optional[ProfileCache] = None,
+                 process_pool: Optional[ProcessPoolExecutor] = None,
+                 request_controller: Optional[RequestController] = None) -> None:
         self._post = post
+        self._session = session
+        self._profile_cache = profile_cache
+        self._process_pool = process_pool
+        self._request_controller = request_controller
 
     @staticmethod
     async def get_unique_id() -> str:
         return uuid.uuid1().hex
 
-    async def get_post_url(self) -> str:
-        return utils.get_link(self._post.find(POST_URL["elem"], attrs=POST_URL["attrs"]))
-
-    async def get_post_date(self) -> str:
-        published_days_ago = utils.get_contents(self._post.find(POST_DATE["elem"], attrs=POST_DATE["attrs"]))
-        return str(date.today() - timedelta(days=int(published_days_ago)))
-
-    async def get_user_name(self) -> str:
-        return utils.get_name(self._post.find(USER_NAME["elem"], attrs=USER_NAME["attrs"]))
-
-    async def get_comments_number(self) -> str:
-        comments_section = self._post.find(COMMENTS["elem"], attrs=COMMENTS["attrs"])
-        comments_subsection_exists = comments_section.find(COMMENTS["elem"], attrs=COMMENTS["sub_attrs"])
-        if comments_subsection_exists:
-            return utils.get_subcontents(comments_subsection_exists)
-        return utils.get_contents(comments_section)
-
-    async def get_votes_number(self) -> str:
-        return utils.get_subcontents(self._post.find(VOTES["elem"], attrs=VOTES["attrs"]))
-
-    async def get_post_category(self) -> str:
-        return utils.get_category(self._post.find(CATEGORY["elem"], attrs=CATEGORY["attrs"]))
-
-    async def __get_user_profile_soup(self) -> BeautifulSoup:
-        user_link_available = utils.get_link(self._post.find(USER_NAME["elem"], attrs=USER_NAME["attrs"]))
-        if user_link_available:
-            user_url = f'https://www.reddit.com{user_link_available}'
-            async with ClientSession(headers=HEADERS, trust_env=True) as session:
-                user_response = await session.request(method="GET", url=user_url)
-                html = await user_response.read()
-            return BeautifulSoup(html, features='lxml')
-
-    async def get_user_details(self) -> Optional[Tuple[str]]:
-        user_profile_available = await self.__get_user_profile_soup()
-        if user_profile_available:
-            card_available = user_profile_available.find(CAKEDAY["elem"], attrs=CAKEDAY["attrs"])
-            if not card_available:
-                logging.warning(f'Failed to reach page https://www.reddit.com'
-                                f'{utils.get_link(self._post.find(USER_NAME["elem"], attrs=USER_NAME["attrs"]))}')
-                return
-            user_cakeday = utils.get_subcontents(card_available)
-            karma_section_block = user_profile_available.find(KARMA["elem"], attrs=KARMA["attrs"])
-            post_karma = utils.get_match(re.search(KARMA["post"], str(karma_section_block)))
-            comment_karma = utils.get_match(re.search(KARMA["comment"], str(karma_section_block)))
-            total_karma = utils.get_match(re.search(KARMA["total"], str(karma_section_block)))
-            if all([post_karma, comment_karma, total_karma]):
-                return post_karma, comment_karma, total_karma, user_cakeday
+    async def _run_cpu_bound(self, func: Callable, *args: Any) -> Any:
+        if self._process_pool is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._process_pool, func, *args)
+
+    async def __get_user_profile_html(self, user_link: str) -> Optional[bytes]:
+        user_url = f'https://www.reddit.com{user_link}'
+        with crawl_stage_seconds.time(stage='profile_fetch'):
+            if self._request_controller is not None:
+                return await self._request_controller.fetch(self._session, user_url)
+            async with self._session.get(user_url) as user_response:
+                return await user_response.read()
+
+    async def __fetch_user_details(self, user_link: str) -> Optional[Tuple[str]]:
+        user_profile_html = await self.__get_user_profile_html(user_link)
+        if user_profile_html is None:
+            return
+        with crawl_stage_seconds.time(stage='profile_parse'):
+            user_details = await self._run_cpu_bound(parse_user_profile, user_profile_html)
+        if user_details is None:
+            logging.warning(f'Failed to reach page https://www.reddit.com{user_link}')
+        return user_details
+
+    async def get_user_details(self, user_link: Optional[str]) -> Optional[Tuple[str]]:
+        if not user_link:
+            return
+        if self._profile_cache is None:
+            return await self.__fetch_user_details(user_link)
+        return await self._profile_cache.get_or_fetch(user_link, lambda: self.__fetch_user_details(user_link))
 
     async def get_all_info(self) -> Union[str, None]:
 
-        unique_id = self.get_unique_id()
-        post_url = self.get_post_url()
-        user_name = self.get_user_name()
-        user_details = self.get_user_details()
-        post_date = self.get_post_date()
-        comments_number = self.get_comments_number()
-        votes_number = self.get_votes_number()
-        post_category = self.get_post_category()
-
-        collected_info = await asyncio.gather(unique_id, post_url, user_name, user_details,
-                                              post_date, comments_number, votes_number, post_category)
+        unique_id = await self.get_unique_id()
+        post_fields = await self._run_cpu_bound(parse_post, self._post)
+        user_details = await self.get_user_details(post_fields.user_link)
+
+        collected_info = (unique_id, post_fields.post_url, post_fields.user_name, user_details,
+                          post_fields.post_date, post_fields.comments_number, post_fields.votes_number,
+                          post_fields.post_category)
         valid_info = []
         for i in collected_info:
             if isinstance(i, str):
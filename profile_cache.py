@@ -0,0 +1,115 @@
+"""Cache the details of already visited user profiles.
+
+The module keeps the karma triple and cakeday of the users met during the crawl,
+so that an author of several posts is downloaded and parsed only once.
+Concurrent lookups of the same user share one in-flight fetch. The cache may be
+persisted to a json-file to let the next run start warm."""
+
+import asyncio
+import json
+import logging
+import os
+import settings
+from collections import OrderedDict
+from datetime import datetime
+from time import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+PROFILE_CACHE_SIZE = settings.PROFILE_CACHE_SIZE
+PROFILE_CACHE_TTL = settings.PROFILE_CACHE_TTL
+
+UserDetails = Tuple[str, str, str, str]
+
+
+class ProfileCache:
+
+    def __init__(self, max_size: int = PROFILE_CACHE_SIZE, ttl: float = PROFILE_CACHE_TTL,
+                 persistence_path: Optional[str] = None) -> None:
+        self._max_size = max_size
+        self._ttl = ttl
+        self._persistence_path = persistence_path
+        self._entries: OrderedDict = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        if persistence_path:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _get_fresh(self, user_link: str) -> Optional[UserDetails]:
+        entry = self._entries.get(user_link)
+        if entry is None:
+            return
+        stored_at, details = entry
+        if time() - stored_at > self._ttl:
+            del self._entries[user_link]
+            return
+        self._entries.move_to_end(user_link)
+        return details
+
+    def _put(self, user_link: str, details: UserDetails, stored_at: float = None) -> None:
+        self._entries[user_link] = (stored_at or time(), details)
+        self._entries.move_to_end(user_link)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    async def get_or_fetch(self, user_link: str,
+                           fetch: Callable[[], Awaitable[Optional[UserDetails]]]) -> Optional[UserDetails]:
+        details = self._get_fresh(user_link)
+        if details is not None:
+            self.hits += 1
+            return details
+
+        in_flight = self._in_flight.get(user_link)
+        if in_flight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(in_flight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[user_link] = future
+        details = None
+        try:
+            details = await fetch()
+        finally:
+            del self._in_flight[user_link]
+            future.set_result(details)
+        if details is not None:
+            self._put(user_link, details)
+        return details
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced, 'size': len(self)}
+
+    def load(self) -> None:
+        if not os.path.exists(self._persistence_path):
+            logging.info(f'Profile cache file {self._persistence_path} was never detected.')
+            return
+        try:
+            with open(self._persistence_path, 'r') as f:
+                persisted_entries = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f'Failed to load profile cache ---> {e}')
+            return
+        now = time()
+        for user_link, (stored_at, details) in persisted_entries.items():
+            if now - stored_at <= self._ttl:
+                self._put(user_link, tuple(details), stored_at)
+        logging.info(f'Profile cache warmed up with {len(self)} users --- {datetime.now()}')
+
+    def save(self) -> None:
+        if not self._persistence_path:
+            return
+        temporary_path = f'{self._persistence_path}.tmp'
+        try:
+            with open(temporary_path, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(temporary_path, self._persistence_path)
+        except OSError as e:
+            logging.error(f'Failed to persist profile cache ---> {e}')
+            return
+        logging.info(f'Profile cache of {len(self)} users persisted --- {datetime.now()}')
@@ -0,0 +1,169 @@
+"""Pace the requests to the user profiles.
+
+The module keeps the crawl polite and productive at the same time: the requests are
+let out through a token bucket, the number of requests in flight is tuned AIMD-style
+from the observed latency and error rate, and throttled or failed requests are retried
+with exponential backoff and jitter, honoring the Retry-After header if it is sent."""
+
+import asyncio
+import logging
+import random
+import settings
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from time import monotonic, time
+from typing import Dict, Optional
+from aiohttp import ClientError, ClientSession
+
+PROFILE_REQUESTS_RATE = settings.PROFILE_REQUESTS_RATE
+PROFILE_REQUESTS_BURST = settings.PROFILE_REQUESTS_BURST
+PROFILE_MIN_CONCURRENCY = settings.PROFILE_MIN_CONCURRENCY
+PROFILE_MAX_CONCURRENCY = settings.PROFILE_MAX_CONCURRENCY
+PROFILE_MAX_RETRIES = settings.PROFILE_MAX_RETRIES
+PROFILE_BACKOFF_BASE = settings.PROFILE_BACKOFF_BASE
+PROFILE_BACKOFF_CAP = settings.PROFILE_BACKOFF_CAP
+PROFILE_LATENCY_TARGET = settings.PROFILE_LATENCY_TARGET
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+CONCURRENCY_DECREASE_FACTOR = 0.5
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = monotonic()
+        self._paused_until = 0.0
+
+    def pause(self, delay: float) -> None:
+        self._paused_until = max(self._paused_until, monotonic() + delay)
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+    async def acquire(self) -> None:
+        while True:
+            pause_left = self._paused_until - monotonic()
+            if pause_left > 0:
+                await asyncio.sleep(pause_left)
+                continue
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+class RequestController:
+
+    def __init__(self, rate: float = PROFILE_REQUESTS_RATE, burst: int = PROFILE_REQUESTS_BURST,
+                 min_concurrency: int = PROFILE_MIN_CONCURRENCY, max_concurrency: int = PROFILE_MAX_CONCURRENCY,
+                 max_retries: int = PROFILE_MAX_RETRIES, latency_target: float = PROFILE_LATENCY_TARGET) -> None:
+        self._bucket = TokenBucket(rate, burst)
+        self._min_concurrency = min_concurrency
+        self._max_concurrency = max_concurrency
+        self._concurrency_limit = float(min_concurrency)
+        self._max_retries = max_retries
+        self._latency_target = latency_target
+        self._in_flight = 0
+        self._slot_freed = None
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failures = 0
+
+    @property
+    def concurrency_limit(self) -> int:
+        return int(self._concurrency_limit)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'requests': self.requests, 'retries': self.retries, 'throttled': self.throttled,
+                'failures': self.failures, 'concurrency_limit': self.concurrency_limit}
+
+    async def _acquire_slot(self) -> None:
+        if self._slot_freed is None:
+            self._slot_freed = asyncio.Condition()
+        async with self._slot_freed:
+            await self._slot_freed.wait_for(lambda: self._in_flight < self.concurrency_limit)
+            self._in_flight += 1
+
+    async def _release_slot(self) -> None:
+        async with self._slot_freed:
+            self._in_flight -= 1
+            self._slot_freed.notify_all()
+
+    def _increase_concurrency(self) -> None:
+        self._concurrency_limit = min(self._max_concurrency,
+                                      self._concurrency_limit + 1 / self._concurrency_limit)
+
+    def _decrease_concurrency(self) -> None:
+        self._concurrency_limit = max(self._min_concurrency,
+                                      self._concurrency_limit * CONCURRENCY_DECREASE_FACTOR)
+
+    @staticmethod
+    def _backoff_delay(attempt: int) -> float:
+        return random.uniform(0, min(PROFILE_BACKOFF_CAP, PROFILE_BACKOFF_BASE * 2 ** attempt))
+
+    @staticmethod
+    def _parse_retry_after(retry_after: Optional[str]) -> Optional[float]:
+        if not retry_after:
+            return
+        if retry_after.isdigit():
+            return min(float(retry_after), PROFILE_BACKOFF_CAP)
+        try:
+            retry_at = parsedate_to_datetime(retry_after).timestamp()
+        except (TypeError, ValueError):
+            return
+        return min(max(retry_at - time(), 0.0), PROFILE_BACKOFF_CAP)
+
+    async def fetch(self, session: ClientSession, url: str) -> Optional[bytes]:
+        for attempt in range(self._max_retries + 1):
+            await self._bucket.acquire()
+            await self._acquire_slot()
+            self.requests += 1
+            status, retry_after, body = None, None, None
+            started_at = monotonic()
+            try:
+                async with session.get(url) as response:
+                    status = response.status
+                    retry_after = response.headers.get('Retry-After')
+                    if status < 400:
+                        body = await response.read()
+            except (ClientError, asyncio.TimeoutError) as e:
+                logging.warning(f'Request to {url} failed ---> {e}')
+            finally:
+                await self._release_slot()
+            latency = monotonic() - started_at
+
+            if status is not None and status < 400:
+                if latency > self._latency_target:
+                    self._decrease_concurrency()
+                else:
+                    self._increase_concurrency()
+                return body
+
+            if status is not None and status not in RETRY_STATUSES:
+                logging.warning(f'Request to {url} answered with {status}. Not retried.')
+                return
+
+            self._decrease_concurrency()
+            delay = self._parse_retry_after(retry_after)
+            if status == 429:
+                self.throttled += 1
+                if delay is not None:
+                    self._bucket.pause(delay)
+            if delay is None:
+                delay = self._backoff_delay(attempt)
+            if attempt < self._max_retries:
+                self.retries += 1
+                logging.info(f'Retrying {url} in {delay:.2f} seconds after status {status}. '
+                             f'Concurrency limit is {self.concurrency_limit} --- {datetime.now()}')
+                await asyncio.sleep(delay)
+
+        self.failures += 1
+        logging.warning(f'Gave up on {url} after {self._max_retries + 1} attempts.')
@@ -14,17 +14,63 @@ WEBDRIVER_PATH = os.getenv("WEBDRIVER_PATH")
 TARGET_DIR_PATH = os.getenv("TARGET_DIR_PATH")
 PAGE_TO_SCRAPE = "https://www.reddit.com/top/?t=month"
 POSTS_FOR_PARSING_NUM = 5
+COLLECTOR_CAPACITY = 0
+COLLECTOR_WINDOW = 0
 TOTAL_MAX_WAIT_TIME = 300
+PARSE_WORKERS_NUM = 0
+
+TXT_SEGMENT_SIZE = 4 * 1024 * 1024
+TXT_COMPRESSION_LEVEL = 6
+TXT_WRITE_BUFFER_SIZE = 1024 * 1024
+TXT_FSYNC_POLICY = 'interval'
+TXT_FSYNC_INTERVAL = 1000
+
+PIPELINE_QUEUE_SIZE = 50
+PIPELINE_PARSERS_NUM = 20
+PIPELINE_PERSIST_BATCH = 50
+PIPELINE_REPORT_INTERVAL = 10
+
+PROFILE_CONNECTIONS_LIMIT = 100
+PROFILE_CONNECTIONS_PER_HOST = 20
+PROFILE_KEEPALIVE_TIMEOUT = 30
+PROFILE_DNS_CACHE_TTL = 300
+PROFILE_CACHE_SIZE = 10_000
+PROFILE_CACHE_TTL = 24 * 60 * 60
+PROFILE_REQUESTS_RATE = 10
+PROFILE_REQUESTS_BURST = 20
+PROFILE_MIN_CONCURRENCY = 1
+PROFILE_MAX_CONCURRENCY = PROFILE_CONNECTIONS_PER_HOST
+PROFILE_MAX_RETRIES = 4
+PROFILE_BACKOFF_BASE = 0.5
+PROFILE_BACKOFF_CAP = 30
+PROFILE_LATENCY_TARGET = 2.0
 
 HOST = '127.0.0.1'
 PORT = 8087
 SERVER_NAME = 'reddit-scraper'
+SERVER_EXECUTOR_THREADS = 8
+SERVER_WORKERS = 1
+SERVER_BACKLOG = 128
+SERVER_MAX_CONNECTIONS = 1024
+SERVER_IDLE_TIMEOUT = 60
+SERVER_READ_TIMEOUT = 30
+SERVER_WRITE_TIMEOUT = 30
+PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+WRITE_BATCH_SIZE = 50
+WRITE_FLUSH_INTERVAL = 0.5
+WRITE_MAX_ATTEMPTS = 5
 
 POSTGRES_HOST = os.getenv('POSTGRES_HOST')
 POSTGRES_PORT = os.getenv('POSTGRES_PORT')
 POSTGRES_DATABASE = os.getenv('POSTGRES_DATABASE')
 POSTGRES_DB_USER = os.getenv('POSTGRES_DB_USER')
 POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
+POSTGRES_POOL_MIN_SIZE = 1
+POSTGRES_POOL_MAX_SIZE = SERVER_EXECUTOR_THREADS + 2
+POSTGRES_POOL_TIMEOUT = 30
+POSTGRES_HEALTH_CHECK_IDLE = 30
+POSTGRES_BULK_PAGE_SIZE = 1000
 
 MONGO_HOST = os.getenv("MONGO_HOST")
 MONGO_PORT = os.getenv("MONGO_PORT")
@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def drive(coro):
+    """Run the coroutine of the webserver to its end, with no scheduler loop."""
+    try:
+        while True:
+            coro.send(None)
+    except StopIteration as e:
+        return e.value
+
+
+@pytest.fixture
+def run(monkeypatch):
+    """Have the scheduler of the webserver make the blocking calls in place, and drive the coroutines given."""
+    import webserver
+
+    async def run_in_thread(func, *args):
+        return func(*args)
+    monkeypatch.setattr(webserver.scheduler, 'run_in_thread', run_in_thread)
+    return drive
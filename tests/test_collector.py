@@ -0,0 +1,26 @@
+import utils
+from collector import POST_URL_INDEX, BloomFilter, SpillingDataCollector
+
+
+def make_entry(number: int) -> str:
+    values = ['x'] * len(utils.pattern_keys)
+    values[POST_URL_INDEX] = f'https://www.reddit.com/r/a/comments/{number}/'
+    return ';'.join(values)
+
+
+def test_bloom_filter_remembers_what_it_was_given():
+    seen = BloomFilter(capacity=10_000, error_rate=1e-6)
+    for number in range(10_000):
+        seen.add(str(number))
+    assert all(str(number) in seen for number in range(10_000))
+    assert sum(str(number) in seen for number in range(10_000, 20_000)) <= 1
+
+
+def test_spilling_collector_skips_duplicates_and_hands_out_all_entries(tmp_path):
+    collector = SpillingDataCollector(posts_for_parsing_num=500, spill_dir_path=str(tmp_path), window_size=10)
+    assert all(collector.collect(make_entry(number)) for number in range(500))
+    assert not any(collector.collect(make_entry(number)) for number in range(0, 500, 3))
+    assert collector.collected_total == 500
+    assert collector.is_full
+    assert [collector.get_one_entry() for _ in range(500)] == [make_entry(number) for number in range(500)]
+    assert list(tmp_path.iterdir()) == []
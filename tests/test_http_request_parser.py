@@ -0,0 +1,104 @@
+import pytest
+
+from webserver import MAX_BODY_LENGTH, MAX_HEAD_LENGTH, BadRequest, HTTPRequestParser
+
+HEAD = b'POST /posts/ HTTP/1.1\r\nHost: localhost:8087\r\n'
+
+
+def parse(data: bytes):
+    parser = HTTPRequestParser()
+    parser.feed(data)
+    return parser.next_request()
+
+
+def test_sized_body():
+    method, target, http_version, headers, body = parse(HEAD + b'Content-Length: 5\r\n\r\nhello')
+    assert (method, target, http_version, body) == ('POST', '/posts/', 'HTTP/1.1', b'hello')
+
+
+def test_request_fed_in_pieces_and_pipelined():
+    parser = HTTPRequestParser()
+    data = HEAD + b'Content-Length: 2\r\n\r\nab' + HEAD + b'Content-Length: 1\r\n\r\nc'
+    bodies = []
+    for number in range(len(data)):
+        parser.feed(data[number:number + 1])
+        request = parser.next_request()
+        if request is not None:
+            bodies.append(request[-1])
+    assert bodies == [b'ab', b'c']
+    assert not parser.has_pending_data
+
+
+def test_chunked_requests_with_trailers_fed_byte_by_byte():
+    parser = HTTPRequestParser()
+    chunked = HEAD + b'Transfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n0\r\nExpires: never\r\n\r\n'
+    data = chunked + HEAD + b'Content-Length: 1\r\n\r\nd' + chunked
+    bodies = []
+    for number in range(len(data)):
+        parser.feed(data[number:number + 1])
+        request = parser.next_request()
+        if request is not None:
+            bodies.append(request[-1])
+    assert bodies == [b'abc', b'd', b'abc']
+    assert not parser.has_pending_data
+
+
+@pytest.mark.parametrize('terminator', [b'', b'\r\n\r\n'])
+def test_head_past_the_limit_is_rejected(terminator):
+    head = HEAD + b'X-Padding: ' + b'x' * MAX_HEAD_LENGTH + terminator
+    with pytest.raises(BadRequest, match='head length'):
+        parse(head)
+
+
+def test_head_fed_in_pieces_up_to_the_limit_is_framed():
+    parser = HTTPRequestParser()
+    head = HEAD + b'X-Padding: ' + b'x' * (MAX_HEAD_LENGTH - len(HEAD) - 20) + b'\r\n\r\n'
+    for start in range(0, len(head), 7):
+        parser.feed(head[start:start + 7])
+        request = parser.next_request()
+    assert request[-1] == b''
+
+
+def test_chunked_trailer_past_the_limit_is_rejected():
+    with pytest.raises(BadRequest, match='trailer length'):
+        parse(HEAD + b'Transfer-Encoding: chunked\r\n\r\n0\r\nX-Padding: ' + b'x' * MAX_HEAD_LENGTH)
+
+
+def test_chunked_body():
+    request = parse(HEAD + b'Transfer-Encoding: chunked\r\n\r\n5;name=value\r\nhello\r\n1\r\n!\r\n0\r\n\r\n')
+    assert request[-1] == b'hello!'
+
+
+def test_incomplete_chunk_waits_for_more_data():
+    parser = HTTPRequestParser()
+    parser.feed(HEAD + b'Transfer-Encoding: chunked\r\n\r\nA\r\n01234')
+    assert parser.next_request() is None
+    parser.feed(b'56789\r\n0\r\n\r\n')
+    assert parser.next_request()[-1] == b'0123456789'
+
+
+@pytest.mark.parametrize('chunk_size', [b'-10', b'+10', b'-0', b'0x10', b'1_0', b' 10', b'', b'zz'])
+def test_improper_chunk_size_is_rejected(chunk_size):
+    with pytest.raises(BadRequest):
+        parse(HEAD + b'Transfer-Encoding: chunked\r\n\r\n' + chunk_size + b'\r\n0123456789abcdef\r\n0\r\n\r\n')
+
+
+def test_chunk_size_past_the_body_limit_is_rejected_before_the_data():
+    with pytest.raises(BadRequest):
+        parse(HEAD + b'Transfer-Encoding: chunked\r\n\r\n' + b'%x\r\n' % (MAX_BODY_LENGTH + 1))
+
+
+def test_chunk_not_followed_by_crlf_is_rejected():
+    with pytest.raises(BadRequest):
+        parse(HEAD + b'Transfer-Encoding: chunked\r\n\r\n2\r\nabc\r\n0\r\n\r\n')
+
+
+@pytest.mark.parametrize('content_length', ['²'.encode('utf-8'), b'\xb2', b'-1', b'+1', b'1_0', b'0x1', b''])
+def test_improper_content_length_is_rejected(content_length):
+    with pytest.raises(BadRequest):
+        parse(HEAD + b'Content-Length: ' + content_length + b'\r\n\r\nx')
+
+
+def test_content_length_past_the_body_limit_is_rejected():
+    with pytest.raises(BadRequest):
+        parse(HEAD + b'Content-Length: %d\r\n\r\n' % (MAX_BODY_LENGTH + 1))
@@ -0,0 +1,188 @@
+"""Run the RequestController against a local aiohttp stub server that answers with
+scripted statuses, Retry-After headers and delays."""
+
+import asyncio
+from email.utils import formatdate
+from time import monotonic, time
+
+import pytest
+from aiohttp import ClientSession, web
+
+import request_controller
+from request_controller import RequestController
+
+
+class StubServer:
+    """Answers GET /profile with the next (status, headers, delay) of the script, 200 once it runs out."""
+
+    def __init__(self, script=(), delay: float = 0.0) -> None:
+        self.script = list(script)
+        self.delay = delay
+        self.hits = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._runner = None
+        self.url = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.hits += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            status, headers, delay = self.script.pop(0) if self.script else (200, {}, self.delay)
+            if delay:
+                await asyncio.sleep(delay)
+            return web.Response(status=status, headers=headers, body=b'profile')
+        finally:
+            self.in_flight -= 1
+
+    async def __aenter__(self) -> 'StubServer':
+        app = web.Application()
+        app.router.add_get('/profile', self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f'http://127.0.0.1:{port}/profile'
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self._runner.cleanup()
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(request_controller, 'PROFILE_BACKOFF_BASE', 0.01)
+    monkeypatch.setattr(request_controller, 'PROFILE_BACKOFF_CAP', 2)
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def make_controller(**kwargs) -> RequestController:
+    options = {'rate': 1000, 'burst': 1000, 'min_concurrency': 1, 'max_concurrency': 8,
+               'max_retries': 3, 'latency_target': 1.0}
+    options.update(kwargs)
+    return RequestController(**options)
+
+
+def test_success_returns_body():
+    async def scenario():
+        controller = make_controller()
+        async with StubServer() as server, ClientSession() as session:
+            body = await controller.fetch(session, server.url)
+        return controller, server, body
+
+    controller, server, body = run(scenario())
+    assert body == b'profile'
+    assert server.hits == 1
+    assert controller.stats['retries'] == 0
+
+
+def test_429_honors_retry_after_seconds():
+    async def scenario():
+        controller = make_controller()
+        async with StubServer([(429, {'Retry-After': '1'}, 0)]) as server, ClientSession() as session:
+            started_at = monotonic()
+            body = await controller.fetch(session, server.url)
+            return controller, server, body, monotonic() - started_at
+
+    controller, server, body, elapsed = run(scenario())
+    assert body == b'profile'
+    assert server.hits == 2
+    assert controller.throttled == 1
+    assert controller.retries == 1
+    assert elapsed >= 0.9
+
+
+def test_retry_after_pauses_every_request_sharing_the_bucket():
+    async def scenario():
+        controller = make_controller(min_concurrency=4)
+        async with StubServer([(429, {'Retry-After': '1'}, 0)]) as server, ClientSession() as session:
+            first = asyncio.ensure_future(controller.fetch(session, server.url))
+            await asyncio.sleep(0.2)
+            started_at = monotonic()
+            await controller.fetch(session, server.url)
+            waited = monotonic() - started_at
+            await first
+            return waited
+
+    assert run(scenario()) >= 0.6
+
+
+def test_retry_after_http_date():
+    delay = RequestController._parse_retry_after(formatdate(time() + 1, usegmt=True))
+    assert 0 <= delay <= 1
+    assert RequestController._parse_retry_after(formatdate(time() - 60, usegmt=True)) == 0
+    assert RequestController._parse_retry_after('not a date') is None
+    assert RequestController._parse_retry_after('120') == request_controller.PROFILE_BACKOFF_CAP
+
+
+def test_server_errors_back_off_and_then_succeed():
+    async def scenario():
+        controller = make_controller()
+        async with StubServer([(503, {}, 0), (500, {}, 0)]) as server, ClientSession() as session:
+            body = await controller.fetch(session, server.url)
+        return controller, server, body
+
+    controller, server, body = run(scenario())
+    assert body == b'profile'
+    assert server.hits == 3
+    assert controller.retries == 2
+    assert controller.throttled == 0
+
+
+def test_gives_up_after_max_retries():
+    async def scenario():
+        controller = make_controller(max_retries=2)
+        async with StubServer([(503, {}, 0)] * 5) as server, ClientSession() as session:
+            body = await controller.fetch(session, server.url)
+        return controller, server, body
+
+    controller, server, body = run(scenario())
+    assert body is None
+    assert server.hits == 3
+    assert controller.failures == 1
+
+
+def test_client_errors_are_not_retried():
+    async def scenario():
+        controller = make_controller()
+        async with StubServer([(404, {}, 0)]) as server, ClientSession() as session:
+            body = await controller.fetch(session, server.url)
+        return controller, server, body
+
+    controller, server, body = run(scenario())
+    assert body is None
+    assert server.hits == 1
+    assert controller.retries == 0
+
+
+def test_concurrency_grows_on_fast_answers_and_halves_on_slow_ones():
+    async def scenario():
+        controller = make_controller(latency_target=0.1)
+        async with StubServer() as server, ClientSession() as session:
+            for _ in range(20):
+                await controller.fetch(session, server.url)
+            grown = controller.concurrency_limit
+            server.delay = 0.2
+            await controller.fetch(session, server.url)
+            return grown, controller.concurrency_limit
+
+    grown, shrunk = run(scenario())
+    assert grown > 1
+    assert shrunk < grown
+
+
+def test_requests_in_flight_stay_within_the_limit():
+    async def scenario():
+        controller = make_controller(min_concurrency=3, max_concurrency=3)
+        async with StubServer(delay=0.05) as server, ClientSession() as session:
+            await asyncio.gather(*(controller.fetch(session, server.url) for _ in range(15)))
+        return server
+
+    server = run(scenario())
+    assert server.hits == 15
+    assert server.max_in_flight <= 3
@@ -0,0 +1,117 @@
+import json
+import uuid
+
+import pytest
+
+from collector import ValidDataCollector
+from webserver import HTTPRequest, HTTPServer, ResponseCache
+
+
+def record(unique_id: str, title: str = 'post') -> dict:
+    return {'unique_id': unique_id, 'title': title}
+
+
+class Executor:
+    """Keep the posts in a dict, calling on_find in the middle of each lookup, as a write landing meanwhile."""
+    is_process_safe = False
+
+    def __init__(self, posts):
+        self.posts = {post['unique_id']: post for post in posts}
+        self.on_find = None
+
+    def find(self, unique_id=None):
+        if self.on_find is not None:
+            on_find, self.on_find = self.on_find, None
+            on_find()
+        if unique_id is not None:
+            return self.posts.get(uuid.UUID(unique_id).hex)
+        return list(self.posts.values())
+
+
+@pytest.fixture
+def server(run):
+    first = uuid.uuid4().hex
+    server = HTTPServer('127.0.0.1', 0, 'localhost', Executor([record(first)]), ValidDataCollector(10))
+    yield server
+    server._server_socket.close()
+
+
+def get_all(server: HTTPServer, run):
+    request = HTTPRequest('GET', '/posts/', 'HTTP/1.1', {'host': 'localhost'}, b'')
+    response = run(server.retrieve_all_written_posts(request))
+    return response.status, json.loads(response.body_sent) if response.body_sent else None
+
+
+def test_refill_keeps_the_record_of_a_key_not_written_since_the_lookup():
+    a, b = uuid.uuid4().hex, uuid.uuid4().hex
+    cache = ResponseCache()
+    cache.fill([record(a)], cache.generation)
+    cache.updated(a)
+    generation = cache.generation
+    cache.added(b)
+    cache.refill(a, record(a, 'updated'), generation)
+
+    assert cache.stale_ids == [b]
+    assert cache.listing() == (None, None)
+    cache.refill(b, record(b), cache.generation)
+    body, etag = cache.listing()
+    assert json.loads(body) == [record(a, 'updated'), record(b)]
+
+
+def test_refill_drops_the_record_of_a_key_written_again_during_the_lookup():
+    a = uuid.uuid4().hex
+    cache = ResponseCache()
+    cache.fill([record(a)], cache.generation)
+    cache.updated(a)
+    generation = cache.generation
+    cache.updated(a)
+    cache.refill(a, record(a, 'outdated'), generation)
+
+    assert cache.stale_ids == [a]
+    cache.refill(a, record(a, 'latest'), cache.generation)
+    assert json.loads(cache.listing()[0]) == [record(a, 'latest')]
+
+
+def test_deleted_key_is_not_brought_back_by_a_lookup():
+    a = uuid.uuid4().hex
+    cache = ResponseCache()
+    cache.fill([record(a)], cache.generation)
+    cache.updated(a)
+    generation = cache.generation
+    cache.deleted(a)
+    cache.refill(a, record(a), generation)
+
+    assert cache.stale_ids == []
+    assert cache.listing() == (None, None)
+
+
+def test_listing_takes_in_a_post_written_during_the_warm_up(server, run):
+    executor = server._executor
+    server._response_cache.fill(list(executor.posts.values()), server._response_cache.generation)
+    first, = executor.posts
+    executor.posts[first] = record(first, 'updated')
+    server._response_cache.updated(first)
+    second = uuid.uuid4().hex
+
+    def write_second():
+        executor.posts[second] = record(second)
+        server._response_cache.added(second)
+    executor.on_find = write_second
+
+    assert get_all(server, run) == (200, [record(first, 'updated'), record(second)])
+    assert get_all(server, run) == (200, [record(first, 'updated'), record(second)])
+    assert server._response_cache.stale_ids == []
+
+
+def test_cold_listing_serves_the_posts_written_during_the_warm_up(server, run):
+    executor = server._executor
+    first, = executor.posts
+    second = uuid.uuid4().hex
+
+    def write_second():
+        executor.posts[second] = record(second)
+        server._response_cache.added(second)
+    executor.on_find = write_second
+
+    assert get_all(server, run) == (200, [record(first), record(second)])
+    assert get_all(server, run) == (200, [record(first), record(second)])
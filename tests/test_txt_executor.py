@@ -0,0 +1,78 @@
+import uuid
+
+import pytest
+
+import utils
+from crud_executors.txt_executor import TxtExecutor
+
+
+def make_post(unique_id: str, post_url: str = 'url') -> str:
+    return ';'.join([unique_id, post_url] + ['x'] * (len(utils.pattern_keys) - 2))
+
+
+def page_through(executor: TxtExecutor, limit: int, after: str = None):
+    unique_ids = []
+    while True:
+        page = executor.find_page(after, limit)
+        unique_ids.extend(post['unique_id'] for post in page)
+        if len(page) < limit:
+            return unique_ids
+        after = page[-1]['unique_id']
+
+
+@pytest.fixture
+def executor(tmp_path):
+    executor = TxtExecutor(str(tmp_path), segment_size=2048, fsync_policy='never')
+    yield executor
+    executor.close()
+
+
+@pytest.fixture
+def unique_ids(executor):
+    unique_ids = [uuid.uuid4().hex for _ in range(60)]
+    executor.insert([make_post(unique_id) for unique_id in unique_ids])
+    return sorted(unique_ids)
+
+
+def test_pages_follow_the_unique_id_order(executor, unique_ids):
+    assert page_through(executor, 7) == unique_ids
+    assert [post['unique_id'] for post in executor.find_page(None, 5)] == unique_ids[:5]
+
+
+def test_page_after_a_deleted_cursor(executor, unique_ids):
+    page = executor.find_page(None, 1)
+    assert executor.delete(page[0]['unique_id'])
+    assert [post['unique_id'] for post in executor.find_page(page[0]['unique_id'], 100)] == unique_ids[1:]
+
+
+def test_page_after_a_cursor_in_another_uuid_form(executor, unique_ids):
+    cursor = str(uuid.UUID(unique_ids[9])).upper()
+    assert [post['unique_id'] for post in executor.find_page(cursor, 3)] == unique_ids[10:13]
+
+
+def test_updates_neither_skip_nor_repeat_entries_between_pages(executor, unique_ids):
+    first_page = executor.find_page(None, 10)
+    for unique_id in unique_ids[:20:3]:
+        assert executor.update({'post_url': 'updated'}, unique_id)
+    rest = page_through(executor, 10, first_page[-1]['unique_id'])
+    assert [post['unique_id'] for post in first_page] + rest == unique_ids
+
+
+def test_inserts_and_deletes_keep_the_order_after_the_first_page(executor, unique_ids):
+    executor.find_page(None, 1)
+    new_unique_id = uuid.uuid4().hex
+    executor.insert(make_post(new_unique_id))
+    executor.delete(unique_ids[30])
+    expected = sorted(set(unique_ids + [new_unique_id]) - {unique_ids[30]})
+    assert page_through(executor, 9) == expected
+
+
+def test_order_survives_reopening_the_store(tmp_path, executor, unique_ids):
+    executor.update({'post_url': 'updated'}, unique_ids[0])
+    executor.close()
+    reopened = TxtExecutor(str(tmp_path), segment_size=2048, fsync_policy='never')
+    try:
+        assert page_through(reopened, 11) == unique_ids
+        assert reopened.find(unique_ids[0])['post_url'] == 'updated'
+    finally:
+        reopened.close()
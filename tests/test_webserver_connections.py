@@ -0,0 +1,111 @@
+"""Run the webserver in a child process, since the scheduler is global to the module,
+and so is the open files limit to the process."""
+
+import os
+import subprocess
+import sys
+import textwrap
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVER_SCRIPT = textwrap.dedent('''
+    import resource, socket, sys, threading, time
+    sys.path.insert(0, sys.argv[1])
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (64, hard))
+    import webserver
+    from collector import ValidDataCollector
+
+    class Executor:
+        is_process_safe = False
+
+        def find(self, unique_id=None):
+            return []
+
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = webserver.HTTPServer('127.0.0.1', port, 'localhost', Executor(), ValidDataCollector(1),
+                                  max_connections=1024)
+    print('cap', server._max_connections)
+    threading.Thread(target=server.run_forever, daemon=True).start()
+
+    def get_metrics(client):
+        client.settimeout(5)
+        client.sendall(f'GET /metrics HTTP/1.1\\r\\nHost: localhost:{port}\\r\\n\\r\\n'.encode())
+        return client.recv(65536).split(b'\\r\\n', 1)[0].decode()
+
+    fillers = []
+    while True:
+        try:
+            fillers.append(open('/dev/null'))
+        except OSError:
+            break
+    fillers.pop().close()
+    client = socket.create_connection(('127.0.0.1', port))
+    time.sleep(0.5)
+    for filler in fillers:
+        filler.close()
+    print('after emfile', get_metrics(client))
+    print('new client', get_metrics(socket.create_connection(('127.0.0.1', port))))
+    print('errors', webserver.accept_errors_total.value())
+''')
+
+SLOW_READER_SCRIPT = textwrap.dedent('''
+    import socket, sys, threading, time, uuid
+    sys.path.insert(0, sys.argv[1])
+    import webserver
+    from collector import ValidDataCollector
+    webserver.SERVER_WRITE_TIMEOUT = 1
+    accept = webserver.scheduler.accept
+
+    async def accept_with_small_send_buffer(sock):
+        client_socket, address = await accept(sock)
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16384)
+        return client_socket, address
+    webserver.scheduler.accept = accept_with_small_send_buffer
+
+    class Executor:
+        is_process_safe = False
+        posts = [{'unique_id': uuid.uuid4().hex, 'padding': 'x' * 1024} for _ in range(20000)]
+
+        def find(self, unique_id=None):
+            return self.posts
+
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = webserver.HTTPServer('127.0.0.1', port, 'localhost', Executor(), ValidDataCollector(1))
+    threading.Thread(target=server.run_forever, daemon=True).start()
+
+    client = socket.socket()
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16384)
+    client.connect(('127.0.0.1', port))
+    client.sendall(f'GET /posts/ HTTP/1.1\\r\\nHost: localhost:{port}\\r\\n\\r\\n'.encode())
+    started_at = time.time()
+    while time.time() - started_at < 10 and not webserver.connections_reaped_total.value(reason='write'):
+        client.recv(16384)
+        time.sleep(0.05)
+    print('reaped', webserver.connections_reaped_total.value(reason='write'), round(time.time() - started_at))
+    print('open', server._connections_num)
+''')
+
+def test_server_keeps_accepting_after_running_out_of_descriptors():
+    result = subprocess.run([sys.executable, '-c', SERVER_SCRIPT, REPO_ROOT],
+                            capture_output=True, text=True, timeout=30)
+    lines = result.stdout.splitlines()
+    assert lines[0] == f'cap {64 - 32}', result.stderr
+    assert lines[1] == 'after emfile HTTP/1.1 200 OK', result.stderr
+    assert lines[2] == 'new client HTTP/1.1 200 OK', result.stderr
+    assert float(lines[3].split()[1]) >= 1
+
+
+def test_client_taking_the_response_a_little_at_a_time_is_reaped_at_the_write_deadline():
+    """The client reads 320 KB/s of a 20 MB listing, keeping each wait for the socket to drain short."""
+    result = subprocess.run([sys.executable, '-c', SLOW_READER_SCRIPT, REPO_ROOT],
+                            capture_output=True, text=True, timeout=30)
+    lines = result.stdout.splitlines()
+    _, reaped, seconds = lines[0].split()
+    assert float(reaped) == 1, result.stderr
+    assert int(seconds) < 5
+    assert lines[1] == 'open 0', result.stderr
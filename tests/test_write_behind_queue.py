@@ -0,0 +1,112 @@
+import uuid
+
+import pytest
+
+import webserver
+from webserver import WriteBehindQueue
+
+
+def post() -> str:
+    return f'{uuid.uuid1().hex};https://www.reddit.com/r/x/comments/1/;someone;1;2;3;2015-03-01;2021-11-01;4;5;x'
+
+
+class Executor:
+    """Insert the posts into a dict. The batches listed in swallow fail the way the sql executor fails:
+    the error is logged and no unique_ids are returned."""
+
+    def __init__(self, swallow=()):
+        self.posts = {}
+        self.swallow = list(swallow)
+        self.calls = 0
+
+    def insert(self, collected_data):
+        self.calls += 1
+        if self.calls in self.swallow:
+            return []
+        for line in collected_data:
+            self.posts[line.split(';')[0]] = line
+        unique_ids = [str(uuid.UUID(line.split(';')[0])) for line in collected_data]
+        return unique_ids[0] if len(unique_ids) == 1 else unique_ids
+
+
+@pytest.fixture
+def queue_for(monkeypatch):
+    monkeypatch.setattr(webserver.scheduler, 'call_soon', lambda func, delayed=0: func._coro.close())
+
+    def make_queue(executor, **options):
+        written = []
+        queue = WriteBehindQueue(executor, on_written=written.append, batch_size=100, **options)
+        return queue, written
+    return make_queue
+
+
+def test_batch_the_executor_swallowed_is_queued_again(queue_for, run, caplog):
+    executor = Executor(swallow=[1])
+    queue, written = queue_for(executor)
+    posts = [post(), post()]
+    queue.enqueue(posts)
+
+    run(queue.flush())
+    assert queue.depth == 2
+    assert executor.posts == {}
+    assert '2 posts of the batch failed to be written' in caplog.text
+
+    run(queue.flush())
+    assert queue.depth == 0
+    assert list(executor.posts.values()) == posts
+    assert [uuid.UUID(unique_id).hex for unique_id in written] == [line.split(';')[0] for line in posts]
+
+
+def test_post_failing_every_attempt_is_dropped_with_an_error(queue_for, run, caplog):
+    executor = Executor(swallow=[1, 2, 3])
+    queue, written = queue_for(executor, max_attempts=3)
+    dropped_before = webserver.posts_dropped_total.value()
+    queue.enqueue([post()])
+
+    for _ in range(3):
+        run(queue.flush())
+    assert queue.depth == 0
+    assert written == []
+    assert webserver.posts_dropped_total.value() == dropped_before + 1
+    assert 'failed to be written 3 times. Dropped' in caplog.text
+
+
+def test_flush_on_shutdown_retries_the_swallowed_batch(queue_for):
+    executor = Executor(swallow=[1])
+    queue, written = queue_for(executor)
+    posts = [post(), post()]
+    queue.enqueue(posts)
+
+    queue.flush_now()
+    assert queue.depth == 0
+    assert list(executor.posts.values()) == posts
+
+
+def test_flush_called_during_a_flush_returns_once_the_posts_queued_before_it_are_written(queue_for, monkeypatch):
+    async def run_in_thread(func, *args):
+        await webserver.scheduler.switch()
+        return func(*args)
+    monkeypatch.setattr(webserver.scheduler, 'run_in_thread', run_in_thread)
+    woken = []
+    monkeypatch.setattr(webserver.scheduler, 'add_to_tasks_ready', woken.append)
+    executor = Executor()
+    queue, _ = queue_for(executor)
+    first, second = post(), post()
+
+    queue.enqueue([first])
+    running = queue.flush()
+    running.send(None)
+    queue.enqueue([second])
+    webserver.scheduler.set_current('reader')
+    waiting = queue.flush()
+    waiting.send(None)
+    webserver.scheduler.set_current(None)
+    assert executor.posts == {}
+
+    running.send(None)
+    with pytest.raises(StopIteration):
+        running.send(None)
+    assert woken == ['reader']
+    with pytest.raises(StopIteration):
+        waiting.send(None)
+    assert list(executor.posts.values()) == [first, second]
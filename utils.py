@@ -36,9 +36,16 @@ def get_subcontents(element: Optional[BeautifulSoup]) -> Optional[str]:
     return element is not None and element.contents[0]
 
 
-def get_match(element: Optional[re.Match]) -> Optional[str]:
-    if element is not None:
-        return element.group().split(':')[1]
+def get_first_matches(pattern: re.Pattern, text: str, keys: Tuple[str, ...]) -> Dict[str, str]:
+    """Scan the text once, keeping the value of the first match of each of the keys."""
+    first_matches = {}
+    for match in pattern.finditer(text):
+        key, value = match.groups()
+        if key not in first_matches:
+            first_matches[key] = value
+            if len(first_matches) == len(keys):
+                break
+    return first_matches
 
 
 def inline_values_to_dict(line: str) -> Dict:
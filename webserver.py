@@ -5,38 +5,105 @@ The request sent to localhost are parsed by the webserver corresponding method.
 The crud-commands in the request are performed with an executor (txt, sql, nosql)
 with the responses formed and sent back to the client."""
 
-import io
 import time
 import collections
+import hashlib
 import heapq
-import select
+import itertools
+import selectors
 import utils
 import logging
-import email.message
 import re
+import os
+import signal
 import socket
 import json
+import settings
+from metrics import registry, PROMETHEUS_CONTENT_TYPE
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from uuid import UUID
-from typing import List, Any, Coroutine, Union, Callable, Optional
-from email.parser import Parser as mail_parser
-from urllib.parse import urlparse
+from typing import List, Any, Coroutine, Union, Callable, Optional, Dict, Tuple, AsyncIterator
+from urllib.parse import urlparse, parse_qs
 from crud_executors import base_crud_executor
-from collector import ValidDataCollector
+from collector import ValidDataCollector, SharedDataCollector
+try:
+    import resource
+except ImportError:
+    resource = None
 
-MAX_BYTES = 10_000
+MAX_BYTES = 64 * 1024
 MAX_LINE_BINARY_LENGTH = 64 * 1024
 MAX_HEADERS_LINES = 50
+MAX_HEAD_LENGTH = 32 * 1024
+RESCAN_LENGTH = 1024
+MAX_BODY_LENGTH = 10 * 1024 * 1024
+BODILESS_STATUSES = (204, 304)
+PAGE_LIMIT = settings.PAGE_LIMIT
+MAX_PAGE_LIMIT = settings.MAX_PAGE_LIMIT
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+SERVER_EXECUTOR_THREADS = settings.SERVER_EXECUTOR_THREADS
+SERVER_WORKERS = settings.SERVER_WORKERS
+SERVER_BACKLOG = settings.SERVER_BACKLOG
+WORKER_MIN_LIFETIME = 1
+WRITE_BATCH_SIZE = settings.WRITE_BATCH_SIZE
+WRITE_FLUSH_INTERVAL = settings.WRITE_FLUSH_INTERVAL
+WRITE_MAX_ATTEMPTS = settings.WRITE_MAX_ATTEMPTS
+SERVER_MAX_CONNECTIONS = settings.SERVER_MAX_CONNECTIONS
+SERVER_IDLE_TIMEOUT = settings.SERVER_IDLE_TIMEOUT
+SERVER_READ_TIMEOUT = settings.SERVER_READ_TIMEOUT
+SERVER_WRITE_TIMEOUT = settings.SERVER_WRITE_TIMEOUT
+TIMERS_CANCELLED_MAX = 1024
+ACCEPT_RETRY_DELAY = 0.1
+OPEN_FILES_HEADROOM = 32
+
+http_request_seconds = registry.histogram(
+    'webserver_request_seconds', 'Time spent handling the HTTP requests.', ('method', 'route'))
+http_responses_total = registry.counter(
+    'webserver_responses_total', 'HTTP responses sent.', ('method', 'route', 'status'))
+write_flush_seconds = registry.histogram(
+    'webserver_write_flush_seconds', 'Time spent writing a batch of queued posts.')
+posts_written_total = registry.counter(
+    'webserver_posts_written_total', 'Posts written out of the write-behind queue.')
+posts_dropped_total = registry.counter(
+    'webserver_posts_dropped_total', 'Queued posts given up on after the executor failed to write them.')
+write_queue_depth = registry.gauge(
+    'webserver_write_queue_depth', 'Posts queued to be written.')
+connections_open = registry.gauge(
+    'webserver_connections_open', 'Client connections being served.')
+connections_reaped_total = registry.counter(
+    'webserver_connections_reaped_total', 'Client connections closed for missing their deadlines.', ('reason',))
+connections_shed_total = registry.counter(
+    'webserver_connections_shed_total', 'Client connections refused with 503 for the server being saturated.')
+accept_errors_total = registry.counter(
+    'webserver_accept_errors_total', 'Failures to accept a client connection, such as running out of descriptors.')
+scheduler_tasks_ready = registry.gauge(
+    'webserver_scheduler_tasks_ready', 'Tasks in the ready queue of the scheduler.')
+scheduler_tasks_delayed = registry.gauge(
+    'webserver_scheduler_tasks_delayed', 'Tasks waiting for their delay to pass.')
+scheduler_tasks_waiting = registry.gauge(
+    'webserver_scheduler_tasks_waiting', 'Tasks waiting for their sockets to get ready.')
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+SEND_BUFFERS_MAX = 1024
+WAITER_SLOTS = {selectors.EVENT_READ: 0, selectors.EVENT_WRITE: 1}
+
+
+class BadRequest(Exception):
+    pass
 
 
 class HTTPRequest:
     def __init__(self, method: str, target: str, http_version: str,
-                 headers: email.message.Message, file_to_read: io.BytesIO):
+                 headers: Dict[str, str], body: bytes):
         self._method = method
         self._target = target
         self._version = http_version
         self._headers = headers
-        self._file_to_read = file_to_read
+        self._body = body
+        url = urlparse(target)
+        self._path = url.path
+        self._query_string = url.query
+        self._query = None
 
     @property
     def method(self):
@@ -44,23 +111,238 @@ class HTTPRequest:
 
     @property
     def path(self):
-        url = urlparse(self._target)
-        return url.path
+        return self._path
+
+    @property
+    def query(self) -> Dict[str, List[str]]:
+        if self._query is None:
+            self._query = parse_qs(self._query_string)
+        return self._query
+
+    @property
+    def headers(self):
+        return self._headers
 
     @property
     def body(self):
-        body_size = self._headers.get('Content-Length')
-        if body_size:
-            return self._file_to_read.read(int(body_size))
+        return self._body
+
+    @property
+    def keep_alive(self) -> bool:
+        connection = self._headers.get('connection', '').lower()
+        if self._version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+RawRequest = Tuple[str, str, str, Dict[str, str], bytes]
+
+
+class HTTPRequestParser:
+    """Frame HTTP/1.1 requests out of the bytes received on a connection.
+
+    The bytes are accumulated between the reads, so a request may come in pieces,
+    and several pipelined requests may come in one read. The bodies are framed
+    either by Content-Length or by chunked transfer-encoding. A search for the end of
+    the head or of a chunk size line that came up empty over more than RESCAN_LENGTH
+    bytes is carried on, when more bytes arrive, from where it stopped, so a request
+    sent a few bytes at a time is not scanned over and over."""
+    CONTENT_LENGTH = re.compile(r'[0-9]+')
+    CHUNK_SIZE = re.compile(rb'[0-9a-fA-F]+')
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._head = None
+        self._chunked_body = None
+        self._scan_separator = None
+        self._scan_start = 0
+        self._scanned = 0
+
+    def feed(self, data: bytes) -> None:
+        self._buffer += data
+
+    @property
+    def has_pending_data(self) -> bool:
+        return bool(self._buffer) or self._head is not None
+
+    def _find(self, separator: bytes, start: int = 0) -> int:
+        if len(self._buffer) - start <= RESCAN_LENGTH:
+            return self._buffer.find(separator, start)
+        offset = start
+        if self._scan_separator is separator and self._scan_start == start:
+            offset = max(start, self._scanned - len(separator) + 1)
+        position = self._buffer.find(separator, offset)
+        if position == -1:
+            self._scan_separator, self._scan_start, self._scanned = separator, start, len(self._buffer)
+        return position
+
+    def _consume(self, size: int) -> None:
+        del self._buffer[:size]
+        self._scan_separator = None
+
+    def next_request(self) -> Optional[RawRequest]:
+        if self._head is None:
+            head_end = self._find(b'\r\n\r\n')
+            if head_end == -1:
+                if len(self._buffer) > MAX_HEAD_LENGTH:
+                    raise BadRequest('The request head length exceeded')
+                return
+            if head_end > MAX_HEAD_LENGTH:
+                raise BadRequest('The request head length exceeded')
+            self._head = self.parse_head(bytes(self._buffer[:head_end]))
+            self._consume(head_end + 4)
+
+        method, target, http_version, headers = self._head
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            body = self._take_chunked_body()
+        else:
+            body = self._take_sized_body(headers.get('content-length', '0'))
+        if body is None:
+            return
+        self._head = None
+        return method, target, http_version, headers, body
+
+    def _take_sized_body(self, content_length: str) -> Optional[bytes]:
+        if not self.CONTENT_LENGTH.fullmatch(content_length) or int(content_length) > MAX_BODY_LENGTH:
+            raise BadRequest('Improper Content-Length header')
+        body_size = int(content_length)
+        if len(self._buffer) < body_size:
+            return
+        body = bytes(self._buffer[:body_size])
+        self._consume(body_size)
+        return body
+
+    def _take_chunked_body(self) -> Optional[bytes]:
+        if self._chunked_body is None:
+            self._chunked_body = bytearray()
+        while True:
+            size_line_end = self._find(b'\r\n')
+            if size_line_end == -1:
+                if len(self._buffer) > MAX_LINE_BINARY_LENGTH:
+                    raise BadRequest('The chunk size line length exceeded')
+                return
+            chunk_size_field = self._buffer[:size_line_end].split(b';', 1)[0].rstrip(b' \t')
+            if not self.CHUNK_SIZE.fullmatch(chunk_size_field):
+                raise BadRequest('Improper chunk size')
+            chunk_size = int(chunk_size_field, 16)
+            if chunk_size == 0:
+                trailer_end = self._find(b'\r\n\r\n', size_line_end)
+                if trailer_end == -1:
+                    if len(self._buffer) - size_line_end > MAX_HEAD_LENGTH:
+                        raise BadRequest('The chunked trailer length exceeded')
+                    return
+                self._consume(trailer_end + 4)
+                body, self._chunked_body = bytes(self._chunked_body), None
+                return body
+            if len(self._chunked_body) + chunk_size > MAX_BODY_LENGTH:
+                raise BadRequest('The request body length exceeded')
+            chunk_end = size_line_end + 2 + chunk_size
+            if len(self._buffer) < chunk_end + 2:
+                return
+            if self._buffer[chunk_end:chunk_end + 2] != b'\r\n':
+                raise BadRequest('Improper chunk framing')
+            self._chunked_body += self._buffer[size_line_end + 2:chunk_end]
+            self._consume(chunk_end + 2)
+
+    @staticmethod
+    def parse_head(head: bytes) -> Tuple[str, str, str, Dict[str, str]]:
+        request_line, *header_lines = head.decode('iso-8859-1').split('\r\n')
+        words_in_request_line = request_line.split()
+        if len(words_in_request_line) != len(['method', 'target', 'version']):
+            raise BadRequest('Improper request line. Request line should describe method, target, and HTTP-version')
+        if len(header_lines) > MAX_HEADERS_LINES:
+            raise BadRequest(f'Max headers lines number exceeded. Limit is {MAX_HEADERS_LINES}')
+        headers = {}
+        for header_line in header_lines:
+            if len(header_line) > MAX_LINE_BINARY_LENGTH:
+                raise BadRequest('The headers line length exceeded')
+            name, separator, value = header_line.partition(':')
+            if not separator:
+                raise BadRequest(f'Improper header line {header_line}')
+            headers[name.strip().lower()] = value.strip()
+        method, target, http_version = words_in_request_line
+        return method, target, http_version, headers
+
+
+class RouteNode:
+    __slots__ = ('static_children', 'param_children', 'handlers', 'path_pattern')
+
+    def __init__(self):
+        self.static_children: Dict[str, 'RouteNode'] = {}
+        self.param_children: List[Tuple[str, re.Pattern, 'RouteNode']] = []
+        self.handlers: Dict[str, Callable] = {}
+        self.path_pattern: Optional[str] = None
+
+
+class Router:
+    """Map the method and the path of a request to its handler.
+
+    The routes are kept as a tree of path segments. A static segment is looked up
+    in a dict, a parameter one, like {unique_id:uuid}, is matched against the pattern
+    of its type compiled beforehand, so the cost of routing does not grow with the
+    number of routes."""
+
+    PARAM_PATTERNS = {
+        'str': re.compile(r'[\w-]+'),
+        'uuid': re.compile(r'[0-9a-fA-F]{32}'
+                           r'|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'),
+    }
+    PARAM_SEGMENT = re.compile(r'{(\w+)(?::(\w+))?}')
+
+    def __init__(self):
+        self._root = RouteNode()
+
+    @staticmethod
+    def split_path(path: str) -> List[str]:
+        return [segment for segment in path.split('/') if segment]
+
+    def add(self, method: str, path_pattern: str, handler: Callable) -> None:
+        node = self._root
+        for segment in self.split_path(path_pattern):
+            param = self.PARAM_SEGMENT.fullmatch(segment)
+            if not param:
+                node = node.static_children.setdefault(segment, RouteNode())
+                continue
+            name, param_type = param.group(1), param.group(2) or 'str'
+            for child_name, _, child in node.param_children:
+                if child_name == name:
+                    node = child
+                    break
+            else:
+                child = RouteNode()
+                node.param_children.append((name, self.PARAM_PATTERNS[param_type], child))
+                node = child
+        node.handlers[method] = handler
+        node.path_pattern = path_pattern
+
+    def resolve(self, path: str) -> Tuple[Dict[str, Callable], Dict[str, str], Optional[str]]:
+        """Find the handlers of the path by method, along with the path parameters
+        and the pattern of the route. No handlers found means no route for the path."""
+        node = self._root
+        params = {}
+        for segment in self.split_path(path):
+            child = node.static_children.get(segment)
+            if child is None:
+                for name, pattern, param_child in node.param_children:
+                    if pattern.fullmatch(segment):
+                        params[name] = segment
+                        child = param_child
+                        break
+                else:
+                    return {}, {}, None
+            node = child
+        return node.handlers, params, node.path_pattern
 
 
 class HTTPResponse:
     def __init__(self, status: int, reason: str,
-                 headers: List = None, body: bytes = None):
+                 headers: List = None, body: bytes = None,
+                 body_stream: AsyncIterator[bytes] = None):
         self._status = status
         self._reason = reason
         self._headers = headers
         self._body = body
+        self._body_stream = body_stream
 
     @property
     def status(self):
@@ -78,152 +360,613 @@ class HTTPResponse:
     def body_sent(self):
         return self._body
 
+    @property
+    def body_stream(self):
+        return self._body_stream
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    return any(candidate.strip() in ('*', etag) for candidate in if_none_match.split(','))
+
+
+class ResponseCache:
+    """Keep the written posts serialized to json, record by record.
+
+    The listing is assembled by joining the cached fragments, and a strong ETag
+    is computed once per version of the listing. The writes through the webserver
+    mark the affected records stale, and only those are looked up again. A record
+    looked up is taken in only if its key was not written again since the lookup
+    began, and the listing is not served while any record is stale."""
+
+    def __init__(self):
+        self._fragments = collections.OrderedDict()
+        self._stale = {}
+        self._is_complete = False
+        self._generation = 0
+        self._listing = None
+
+    @staticmethod
+    def key(unique_id: Any) -> str:
+        return UUID(str(unique_id)).hex
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def is_complete(self) -> bool:
+        return self._is_complete
+
+    @property
+    def stale_ids(self) -> List[str]:
+        return list(self._stale)
+
+    def _changed(self) -> None:
+        self._generation += 1
+        self._listing = None
+
+    def _mark_stale(self, key: str) -> None:
+        self._fragments[key] = None
+        self._stale[key] = self._generation
+
+    def fill(self, records: List[Dict[str, Any]], generation: int) -> None:
+        if generation != self._generation:
+            return
+        self._fragments = collections.OrderedDict(
+            (self.key(record['unique_id']), json.dumps(record).encode('utf-8')) for record in records
+        )
+        self._stale = {}
+        self._is_complete = True
+        self._listing = None
+
+    def refill(self, unique_id: str, record: Optional[Dict[str, Any]], generation: int) -> None:
+        """Take in the record looked up since the generation given, unless its key was written again meanwhile."""
+        if self._stale.get(unique_id, generation + 1) > generation:
+            return
+        del self._stale[unique_id]
+        if record is None:
+            del self._fragments[unique_id]
+        else:
+            self._fragments[unique_id] = json.dumps(record).encode('utf-8')
+        self._listing = None
+
+    def fragment(self, unique_id: str) -> Optional[bytes]:
+        return self._fragments.get(self.key(unique_id))
+
+    def added(self, unique_id: Any) -> None:
+        self._changed()
+        if self._is_complete:
+            self._mark_stale(self.key(unique_id))
+
+    def updated(self, unique_id: str) -> None:
+        self._changed()
+        key = self.key(unique_id)
+        if key in self._fragments:
+            self._mark_stale(key)
+
+    def deleted(self, unique_id: str) -> None:
+        self._changed()
+        key = self.key(unique_id)
+        self._fragments.pop(key, None)
+        self._stale.pop(key, None)
+
+    def listing(self) -> Tuple[Optional[bytes], Optional[str]]:
+        """The listing with its ETag, or Nones when there is nothing to list or some records are yet to be looked up."""
+        if not self._fragments or self._stale:
+            return None, None
+        if self._listing is None:
+            body = b'[' + b', '.join(self._fragments.values()) + b']'
+            self._listing = body, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        return self._listing
+
+
+class WriteBehindQueue:
+    """Take the posts to be written and insert them into the executor in batches.
+
+    A batch is flushed as soon as WRITE_BATCH_SIZE posts are pending, or once
+    WRITE_FLUSH_INTERVAL seconds passed since the first of them was queued.
+    The unique_id of a post is assigned by the collector, so it is known
+    before the post is actually written. The posts of a batch the executor
+    did not return the unique_ids of are queued again, up to WRITE_MAX_ATTEMPTS
+    times, then dropped with an error logged."""
+
+    def __init__(self, executor: base_crud_executor.BaseCrudExecutor,
+                 on_written: Callable[[Any], None] = None,
+                 batch_size: int = WRITE_BATCH_SIZE, flush_interval: Union[int, float] = WRITE_FLUSH_INTERVAL,
+                 max_attempts: int = WRITE_MAX_ATTEMPTS):
+        self._executor = executor
+        self._on_written = on_written
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_attempts = max_attempts
+        self._pending = collections.deque()
+        self._attempts = {}
+        self._is_flushing = False
+        self._flush_waiters = collections.deque()
+        self._timer_set = False
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    def enqueue(self, posts: List[str]) -> List[str]:
+        self._pending.extend(posts)
+        if len(self._pending) >= self._batch_size:
+            scheduler.add_task(self.flush())
+        else:
+            self._set_timer()
+        return [self.unique_id(post) for post in posts]
+
+    @staticmethod
+    def unique_id(post: str) -> str:
+        return post.split(';')[0]
+
+    def _set_timer(self) -> None:
+        if not self._timer_set:
+            self._timer_set = True
+            scheduler.call_soon(func=Task(self._flush_on_timer()), delayed=self._flush_interval)
+
+    async def _flush_on_timer(self) -> None:
+        self._timer_set = False
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Write the pending posts out. A call made while a flush is going on waits for it
+        to end, then writes out what is still pending, so that the posts queued before
+        the call are written by the time it returns, unless the executor failed."""
+        while self._is_flushing:
+            self._flush_waiters.append(scheduler.get_current())
+            scheduler.set_current(None)
+            await scheduler.switch()
+        self._is_flushing = True
+        try:
+            while self._pending:
+                batch = [self._pending.popleft() for _ in range(min(self._batch_size, len(self._pending)))]
+                started_at = time.perf_counter()
+                try:
+                    unique_ids = await scheduler.run_in_thread(self._executor.insert, batch)
+                except Exception as e:
+                    logging.error(f'Batch of {len(batch)} posts failed to be written, to be retried ---> {e}')
+                    self._pending.extendleft(reversed(batch))
+                    self._set_timer()
+                    return
+                if self._record_flush(batch, unique_ids, time.perf_counter() - started_at):
+                    self._set_timer()
+                    return
+        finally:
+            self._is_flushing = False
+            while self._flush_waiters:
+                scheduler.add_to_tasks_ready(self._flush_waiters.popleft())
+
+    def flush_now(self) -> None:
+        """Write the pending posts out in the calling thread. Used on shutdown, with the scheduler stopped."""
+        while self._pending:
+            batch = [self._pending.popleft() for _ in range(min(self._batch_size, len(self._pending)))]
+            started_at = time.perf_counter()
+            unique_ids = self._executor.insert(batch)
+            self._record_flush(batch, unique_ids, time.perf_counter() - started_at)
+
+    def _record_flush(self, batch: List[str], unique_ids: Union[str, List[str]], latency: float) -> List[str]:
+        """Account for the posts written, and queue again at the front the ones the executor did not return
+        the unique_ids of, for it logs and swallows some of the failures. Return the posts queued again."""
+        if isinstance(unique_ids, str):
+            unique_ids = [unique_ids]
+        posts_retried = []
+        if len(unique_ids) < len(batch):
+            written = {UUID(str(unique_id)).hex for unique_id in unique_ids}
+            posts_retried = self._requeue([post for post in batch if UUID(self.unique_id(post)).hex not in written])
+            batch = [post for post in batch if UUID(self.unique_id(post)).hex in written]
+        if self._attempts:
+            for post in batch:
+                self._attempts.pop(self.unique_id(post), None)
+        if self._on_written is not None:
+            for unique_id in unique_ids:
+                self._on_written(unique_id)
+        write_flush_seconds.observe(latency)
+        posts_written_total.inc(len(batch))
+        logging.info(f'{len(batch)} posts written in {latency:.3f} sec., '
+                     f'{self.depth} still queued --- {datetime.now()}')
+        return posts_retried
+
+    def _requeue(self, posts: List[str]) -> List[str]:
+        posts_retried = []
+        for post in posts:
+            unique_id = self.unique_id(post)
+            attempts = self._attempts.get(unique_id, 0) + 1
+            if attempts < self._max_attempts:
+                self._attempts[unique_id] = attempts
+                posts_retried.append(post)
+                continue
+            self._attempts.pop(unique_id, None)
+            posts_dropped_total.inc()
+            logging.error(f'Post {unique_id} failed to be written {attempts} times. Dropped: {post}')
+        if posts_retried:
+            logging.error(f'{len(posts_retried)} posts of the batch failed to be written, to be retried: '
+                          f'{", ".join(self.unique_id(post) for post in posts_retried)}')
+            self._pending.extendleft(reversed(posts_retried))
+        return posts_retried
+
 
 class HTTPServer:
 
     def __init__(self, host: str, port: int, server_name: str,
                  executor: base_crud_executor.BaseCrudExecutor,
-                 collector: ValidDataCollector):
+                 collector: Union[ValidDataCollector, SharedDataCollector],
+                 workers: int = SERVER_WORKERS, backlog: int = SERVER_BACKLOG,
+                 response_cache: bool = True, max_connections: int = SERVER_MAX_CONNECTIONS,
+                 idle_timeout: Union[int, float] = SERVER_IDLE_TIMEOUT):
         self._host = host
         self._port = port
         self._server_name = server_name
         self._executor = executor
         self._collector = collector
+        self._workers = workers
+        self._backlog = backlog
+        self._max_connections = self.cap_connections(max_connections)
+        self._idle_timeout = idle_timeout
+        self._connections_num = 0
         self._server_socket = None
-        self._set_server_socket()
+        if self._workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+            logging.warning('SO_REUSEPORT is not supported on the platform. Falling back to a single worker.')
+            self._workers = 1
+        if self._workers > 1 and not executor.is_process_safe:
+            logging.warning(f'{type(executor).__name__} keeps its state in the process memory, '
+                            f'so it cannot be shared by several workers. Falling back to a single worker.')
+            self._workers = 1
+        self._response_cache = ResponseCache() if response_cache and not self.is_prefork else None
+        self._write_behind = WriteBehindQueue(
+            executor, on_written=self._response_cache.added if self._response_cache is not None else None
+        )
+        write_queue_depth.set_function(lambda: self._write_behind.depth)
+        connections_open.set_function(lambda: self._connections_num)
+        self._set_router()
+        if not self.is_prefork:
+            self._set_server_socket()
+
+    @property
+    def is_prefork(self) -> bool:
+        return self._workers > 1
 
     def _set_server_socket(self) -> None:
         self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, proto=0)
-        self._server_socket.bind((self._host, self._port))
         self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._server_socket.listen(1)
+        if self.is_prefork:
+            self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._server_socket.bind((self._host, self._port))
+        self._server_socket.listen(self._backlog)
 
     def run_forever(self):
-        scheduler.add_task(self._accept_client())
-        scheduler.run()
+        if self.is_prefork:
+            self._supervise_workers()
+            return
+        try:
+            scheduler.add_task(self._accept_client())
+            scheduler.run()
+        finally:
+            self.flush_queued_posts()
+
+    def flush_queued_posts(self) -> None:
+        if self._write_behind.depth:
+            logging.info(f'Flushing {self._write_behind.depth} queued posts on shutdown --- {datetime.now()}')
+            self._write_behind.flush_now()
+
+    def _spawn_worker(self, worker_number: int) -> int:
+        pid = os.fork()
+        if pid:
+            logging.info(f'Webserver worker {worker_number} started with pid {pid} --- {datetime.now()}')
+            return pid
+        exit_code = 0
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            self._set_server_socket()
+            scheduler.add_task(self._accept_client())
+            scheduler.run()
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            logging.error(f'Webserver worker {worker_number} failed ---> {e}')
+            exit_code = 1
+        finally:
+            try:
+                self.flush_queued_posts()
+            except Exception as e:
+                logging.error(f'Webserver worker {worker_number} failed to flush queued posts ---> {e}')
+                exit_code = 1
+            os._exit(exit_code)
+
+    def _supervise_workers(self) -> None:
+        """Fork the workers, each accepting on its own SO_REUSEPORT socket, and restart those that die.
+
+        The collected entries are moved to a collector shared by the workers beforehand,
+        so that each entry is written by one worker only, whichever gets the POST request."""
+        self._collector = SharedDataCollector(self._collector)
+        workers = {}
+        started_at = {}
+        for worker_number in range(self._workers):
+            pid = self._spawn_worker(worker_number)
+            workers[pid], started_at[worker_number] = worker_number, time.time()
+        try:
+            while True:
+                pid, status = os.wait()
+                worker_number = workers.pop(pid, None)
+                if worker_number is None:
+                    continue
+                logging.warning(f'Webserver worker {worker_number} with pid {pid} exited with status {status}. '
+                                f'Restarting --- {datetime.now()}')
+                restart_delay = WORKER_MIN_LIFETIME - (time.time() - started_at[worker_number])
+                if restart_delay > 0:
+                    time.sleep(restart_delay)
+                pid = self._spawn_worker(worker_number)
+                workers[pid], started_at[worker_number] = worker_number, time.time()
+        finally:
+            for pid in workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    @staticmethod
+    def cap_connections(max_connections: int) -> int:
+        """Keep the connections served below the open files limit of the process, leaving room for the files
+        and sockets of the executor, so that the clients over the cap are refused with 503 rather than
+        left in the backlog by the accept failing with EMFILE."""
+        if resource is None:
+            return max_connections
+        open_files_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if open_files_limit == resource.RLIM_INFINITY:
+            return max_connections
+        connections_limit = max(1, open_files_limit - OPEN_FILES_HEADROOM)
+        if max_connections > connections_limit:
+            logging.warning(f'Max connections lowered from {max_connections} to {connections_limit} '
+                            f'to stay within the open files limit of {open_files_limit}.')
+            return connections_limit
+        return max_connections
 
     async def _accept_client(self) -> None:
+        """Accept the clients for as long as the server runs. A failed accept, say for the descriptors
+        running out, is retried after a pause, the connection staying in the backlog meanwhile."""
         while True:
-            client_socket, _ = await scheduler.accept(self._server_socket)
+            try:
+                client_socket, _ = await scheduler.accept(self._server_socket)
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                accept_errors_total.inc()
+                logging.error(f'Accepting a connection failed ---> {e!r}. '
+                              f'Retrying in {ACCEPT_RETRY_DELAY} seconds --- {datetime.now()}')
+                await scheduler.sleep(ACCEPT_RETRY_DELAY)
+                continue
+            client_socket.setblocking(False)
+            if self._connections_num >= self._max_connections:
+                self._shed_load(client_socket)
+                continue
             scheduler.add_task(self._serve_client(client_socket))
 
+    def _shed_load(self, client_socket: socket.socket) -> None:
+        """Refuse the connection with 503 right away, not letting it take a task, when the server is saturated."""
+        connections_shed_total.inc()
+        try:
+            client_socket.send(SERVICE_UNAVAILABLE_RESPONSE)
+        except OSError:
+            pass
+        client_socket.close()
+
     async def _serve_client(self, client_socket: socket.socket) -> None:
-        while True:
-            data = await scheduler.recv(client_socket)
+        """Serve the connection till the client closes it, or till it misses one of the deadlines:
+        the idle one between the requests, the read one for a request to arrive as a whole,
+        which keeps the slowloris clients off, and the write one for the client to take a response."""
+        self._connections_num += 1
+        try:
+            await self._exchange(client_socket)
+        except TimeoutError as e:
+            connections_reaped_total.inc(reason=str(e))
+        except ConnectionError:
+            pass
+        finally:
+            self._connections_num -= 1
+            scheduler.forget(client_socket)
+            client_socket.close()
+
+    async def _exchange(self, client_socket: socket.socket) -> None:
+        request_parser = HTTPRequestParser()
+        request_started_at = None
+        keep_alive = True
+        while keep_alive:
+            if request_parser.has_pending_data:
+                data = await scheduler.recv(client_socket, timeout=max(
+                    request_started_at + SERVER_READ_TIMEOUT - time.time(), 0), timeout_reason='read')
+            else:
+                data = await scheduler.recv(client_socket, timeout=self._idle_timeout, timeout_reason='idle')
             if not data:
                 break
-            http_request = self.form_http_request(io.BytesIO(data))
-            http_response = await self.handle_http_request(http_request)
-            data_to_send = self.get_data_to_send(http_response)
-            await scheduler.send(client_socket, data_to_send)
-
-        client_socket.close()
+            if not request_parser.has_pending_data:
+                request_started_at = time.time()
+            request_parser.feed(data)
+            while keep_alive:
+                try:
+                    raw_request = request_parser.next_request()
+                except BadRequest as e:
+                    logging.error(f'Bad request. {e}')
+                    await self._send(client_socket, self.get_data_to_send(
+                        HTTPResponse(status=400, reason='Bad Request')), time.time() + SERVER_WRITE_TIMEOUT)
+                    keep_alive = False
+                    break
+                if raw_request is None:
+                    break
+                http_request = self.form_http_request(*raw_request)
+                http_response = await self.handle_http_request(http_request)
+                data_to_send = self.get_data_to_send(http_response)
+                write_deadline = time.time() + SERVER_WRITE_TIMEOUT
+                await self._send(client_socket, data_to_send, write_deadline)
+                if http_response.body_stream is not None:
+                    await self._send_chunked(client_socket, http_response.body_stream, write_deadline)
+                keep_alive = http_request is not None and http_request.keep_alive
+                request_started_at = time.time()
 
-    def form_http_request(self, data: io.BytesIO) -> Optional[HTTPRequest]:
-        method, target, http_version = self.parse_request_line(data)
-        headers = self.parse_headers_block(data)
-        host_specified = headers.get('Host')
+    @staticmethod
+    async def _send(client_socket: socket.socket, data: Union[bytes, List[bytes]], deadline: float) -> None:
+        """Send the data, the client being given till the deadline of the whole response to take it."""
+        await scheduler.send(client_socket, data, timeout=max(deadline - time.time(), 0), timeout_reason='write')
+
+    async def _send_chunked(self, client_socket: socket.socket, body_stream: AsyncIterator[bytes],
+                            deadline: float) -> None:
+        async for chunk in body_stream:
+            await self._send(client_socket, [b'%x\r\n' % len(chunk), chunk, b'\r\n'], deadline)
+        await self._send(client_socket, b'0\r\n\r\n', deadline)
+
+    def form_http_request(self, method: str, target: str, http_version: str,
+                          headers: Dict[str, str], body: bytes) -> Optional[HTTPRequest]:
+        host_specified = headers.get('host')
         if host_specified in (self._server_name, f'{self._server_name}:{self._port}'):
-            return HTTPRequest(method, target, http_version, headers, data)
+            return HTTPRequest(method, target, http_version, headers, body)
         logging.error('Bad request. Improper or missing "Host" header')
 
-    @staticmethod
-    def parse_request_line(file_to_read: io.BytesIO) -> List[str]:
-        first_raw_bytes_line = file_to_read.readline(MAX_LINE_BINARY_LENGTH + 1)
-        if len(first_raw_bytes_line) > MAX_LINE_BINARY_LENGTH:
-            raise Exception('The request line length exceeded')
-        decoded_line = str(first_raw_bytes_line, 'iso-8859-1').strip()
-        words_in_request_line = decoded_line.split()
-        if len(words_in_request_line) != len(['method', 'target', 'version']):
-            raise Exception('Improper request line. Request line should describe method, target, and HTTP-version')
-        return words_in_request_line
-
-    @staticmethod
-    def parse_headers_block(file_to_read: io.BytesIO) -> email.message.Message:
-        headers = []
-        while True:
-            next_raw_bytes_line = file_to_read.readline(MAX_LINE_BINARY_LENGTH + 1)
-            if len(next_raw_bytes_line) > MAX_LINE_BINARY_LENGTH:
-                raise Exception('The headers line length exceeded')
-            if next_raw_bytes_line in (b'\r\n', b'\n', b''):
-                break
-            decoded_next_raw_bytes_line = str(next_raw_bytes_line, 'iso-8859-1')
-            headers.append(decoded_next_raw_bytes_line)
-            if len(headers) > MAX_HEADERS_LINES:
-                raise Exception(f'Max headers lines number exceeded. Limit is {MAX_HEADERS_LINES}')
-        return mail_parser().parsestr(''.join(headers))
-
-    async def handle_http_request(self, request: HTTPRequest) -> Union[Callable, HTTPResponse]:
+    def _set_router(self) -> None:
+        self._router = Router()
+        self._router.add('POST', '/posts/', self.write_next_post)
+        self._router.add('POST', '/posts/remaining/', self.write_remaining_posts)
+        self._router.add('GET', '/posts/', self.list_written_posts)
+        self._router.add('GET', '/posts/{unique_id:uuid}/', self.retrieve_post)
+        self._router.add('PUT', '/posts/{unique_id:uuid}/', self.update_post)
+        self._router.add('DELETE', '/posts/{unique_id:uuid}/', self.delete_post)
+        self._router.add('GET', '/metrics', self.export_metrics)
+
+    async def handle_http_request(self, request: HTTPRequest) -> HTTPResponse:
         if not request:
             return HTTPResponse(status=400, reason='Bad Request')
 
-        if self._collector.is_empty and request.method == 'POST':
+        started_at = time.perf_counter()
+        handlers, path_params, path_pattern = self._router.resolve(request.path)
+        route = path_pattern or 'unmatched'
+        http_response = await self._route_http_request(request, handlers, path_params, path_pattern)
+        http_request_seconds.observe(time.perf_counter() - started_at, method=request.method, route=route)
+        http_responses_total.inc(method=request.method, route=route, status=http_response.status)
+        return http_response
+
+    async def _route_http_request(self, request: HTTPRequest, handlers: Dict[str, Callable],
+                                  path_params: Dict[str, str], path_pattern: Optional[str]) -> HTTPResponse:
+        if not handlers:
+            return HTTPResponse(status=404, reason='Not found')
+        handler = handlers.get(request.method)
+        if handler is None:
+            return HTTPResponse(status=405, reason='Method Not Allowed',
+                                headers=[('Allow', ', '.join(handlers)), ('Content-Length', 0)])
+
+        if request.method != 'POST' and path_pattern.startswith('/posts/'):
+            await self._write_behind.flush()
+            if self._collector.is_full:
+                return HTTPResponse(status=404, reason='No written entries yet')
+
+        return await handler(request, **path_params)
+
+    async def export_metrics(self, request: HTTPRequest) -> HTTPResponse:
+        response_body = registry.render().encode('utf-8')
+        headers = [('Content-Type', PROMETHEUS_CONTENT_TYPE), ('Content-Length', len(response_body))]
+        return HTTPResponse(status=200, reason='OK', headers=headers, body=response_body)
+
+    async def write_remaining_posts(self, request: HTTPRequest) -> HTTPResponse:
+        posts_to_append = self._collector.drain()
+        if not posts_to_append:
             return HTTPResponse(status=404, reason='All parsed data exhausted')
-
-        if request.path == '/posts/remaining/' and request.method == 'POST':
-            return self.write_remaining_posts()
-
-        if request.path == '/posts/' and request.method == 'POST':
-            await scheduler.sleep(10)
-            return self.write_next_post()
-
-        if self._collector.is_full:
-            return HTTPResponse(status=404, reason='No written entries yet')
-
-        if request.path == '/posts/' and request.method == 'GET':
-            return self.retrieve_all_written_posts()
-
-        single_post_crud = re.search('/posts/[\w-]+/', request.path)
-        unique_id = request.path.split('/')[2]
-        try:
-            UUID(unique_id)
-        except ValueError:
-            return HTTPResponse(status=404, reason='Inadequate unique_id in uri')
-
-        if single_post_crud and request.method == 'GET':
-            return self.retrieve_post(unique_id)
-
-        if single_post_crud and request.method == 'PUT':
-            return self.update_post(request, unique_id)
-
-        if single_post_crud and request.method == 'DELETE':
-            return self.delete_post(unique_id)
-
-        return HTTPResponse(status=404, reason='Not found')
-
-    def write_remaining_posts(self) -> HTTPResponse:
-        posts_to_append = self._collector.data
-        unique_ids = self._executor.insert(posts_to_append)
+        unique_ids = self._write_behind.enqueue(posts_to_append)
+        await self._write_behind.flush()
         response_body = b', '.join(json.dumps({'unique_id': f'{unique_id}'}).encode('utf-8')
                                    for unique_id in unique_ids)
         headers = utils.form_headers(response_body)
-        self._collector.clear()
         logging.info(f'All remaining data taken out of collector and saved --- {datetime.now()}')
         return HTTPResponse(status=201, reason='Created', headers=headers, body=response_body)
 
-    def write_next_post(self) -> HTTPResponse:
-        post_to_append = self._collector.get_one_entry()
-        unique_id = self._executor.insert(post_to_append)
+    async def write_next_post(self, request: HTTPRequest) -> HTTPResponse:
+        try:
+            post_to_append = self._collector.get_one_entry()
+        except IndexError:
+            return HTTPResponse(status=404, reason='All parsed data exhausted')
+        unique_id, = self._write_behind.enqueue([post_to_append])
         response_body = json.dumps({'unique_id': f'{unique_id}'}).encode('utf-8')
         headers = utils.form_headers(response_body)
         return HTTPResponse(status=201, reason='Created', headers=headers, body=response_body)
 
-    def retrieve_all_written_posts(self) -> HTTPResponse:
-        posts_found = self._executor.find()
+    async def _warm_up_response_cache(self) -> None:
+        cache = self._response_cache
+        if not cache.is_complete:
+            generation = cache.generation
+            posts_found = await scheduler.run_in_thread(self._executor.find)
+            cache.fill(posts_found or [], generation)
+        for unique_id in cache.stale_ids:
+            generation = cache.generation
+            post_found = await scheduler.run_in_thread(self._executor.find, unique_id)
+            cache.refill(unique_id, post_found, generation)
+
+    async def list_written_posts(self, request: HTTPRequest) -> HTTPResponse:
+        query = request.query
+        if 'stream' in query or NDJSON_CONTENT_TYPE in request.headers.get('accept', ''):
+            return self.stream_all_written_posts()
+        if 'after' in query or 'limit' in query:
+            return await self.retrieve_page_of_written_posts(query)
+        return await self.retrieve_all_written_posts(request)
+
+    async def retrieve_all_written_posts(self, request: HTTPRequest) -> HTTPResponse:
+        """Serve the listing out of the response cache. When the posts get written faster than the cache
+        is warmed up, or there are none, the posts are looked up in the executor instead."""
+        if self._response_cache is not None:
+            await self._warm_up_response_cache()
+            response_body, etag = self._response_cache.listing()
+            if response_body is not None:
+                if etag_matches(request.headers.get('if-none-match'), etag):
+                    return HTTPResponse(status=304, reason='Not Modified', headers=[('ETag', etag)])
+                headers = utils.form_headers(response_body) + [('ETag', etag)]
+                return HTTPResponse(status=200, reason='OK', headers=headers, body=response_body)
+            if self._response_cache.is_complete and not self._response_cache.stale_ids:
+                return HTTPResponse(status=404, reason='No written entries yet')
+
+        posts_found = await scheduler.run_in_thread(self._executor.find)
         if posts_found:
             response_body = json.dumps(posts_found).encode('utf-8')
             headers = utils.form_headers(response_body)
             return HTTPResponse(status=200, reason='OK', headers=headers, body=response_body)
+        return HTTPResponse(status=404, reason='No written entries yet')
+
+    async def retrieve_page_of_written_posts(self, query: Dict[str, List[str]]) -> HTTPResponse:
+        after = query.get('after', [None])[0]
+        limit = query.get('limit', [str(PAGE_LIMIT)])[0]
+        if not limit.isdigit() or not 0 < int(limit) <= MAX_PAGE_LIMIT:
+            return HTTPResponse(status=400, reason=f'Limit should be within 1 and {MAX_PAGE_LIMIT}')
+        posts_found = await scheduler.run_in_thread(self._executor.find_page, after, int(limit))
+        response_body = json.dumps(posts_found).encode('utf-8')
+        headers = utils.form_headers(response_body)
+        if len(posts_found) == int(limit):
+            headers.append(('X-Next-After', posts_found[-1]['unique_id']))
+        return HTTPResponse(status=200, reason='OK', headers=headers, body=response_body)
 
-    def retrieve_post(self, unique_id: str) -> HTTPResponse:
-        post_found = self._executor.find(unique_id)
+    def stream_all_written_posts(self) -> HTTPResponse:
+        headers = [('Content-Type', f'{NDJSON_CONTENT_TYPE}; charset=utf-8'), ('Transfer-Encoding', 'chunked')]
+        return HTTPResponse(status=200, reason='OK', headers=headers, body_stream=self._written_posts_pages())
+
+    async def _written_posts_pages(self) -> AsyncIterator[bytes]:
+        after = None
+        while True:
+            posts_found = await scheduler.run_in_thread(self._executor.find_page, after, PAGE_LIMIT)
+            if posts_found:
+                yield b''.join(json.dumps(post).encode('utf-8') + b'\n' for post in posts_found)
+            if len(posts_found) < PAGE_LIMIT:
+                return
+            after = posts_found[-1]['unique_id']
+
+    async def retrieve_post(self, request: HTTPRequest, unique_id: str) -> HTTPResponse:
+        if self._response_cache is not None and self._response_cache.fragment(unique_id):
+            response_body = self._response_cache.fragment(unique_id)
+            headers = utils.form_headers(response_body)
+            return HTTPResponse(status=200, reason='OK', headers=headers, body=response_body)
+        post_found = await scheduler.run_in_thread(self._executor.find, unique_id)
         if post_found:
             response_body = json.dumps(post_found).encode('utf-8')
             headers = utils.form_headers(response_body)
             return HTTPResponse(status=200, reason='OK', headers=headers, body=response_body)
         return HTTPResponse(status=404, reason='Entry not found')
 
-    def update_post(self, request: HTTPRequest, unique_id: str) -> HTTPResponse:
+    async def update_post(self, request: HTTPRequest, unique_id: str) -> HTTPResponse:
         try:
             sent_info = json.loads(request.body.decode('utf-8'))
         except json.JSONDecodeError:
@@ -232,32 +975,42 @@ class HTTPServer:
         if not utils.info_is_valid(sent_info, unique_id):
             return HTTPResponse(status=404, reason='Improper request body')
 
-        update_performed = self._executor.update(sent_info, unique_id)
+        update_performed = await scheduler.run_in_thread(self._executor.update, sent_info, unique_id)
+        if self._response_cache is not None:
+            self._response_cache.updated(unique_id)
         if update_performed:
             return HTTPResponse(status=200, reason='Entry successfully updated')
         return HTTPResponse(status=404, reason='Update failure')
 
-    def delete_post(self, unique_id: str) -> HTTPResponse:
-        deletion_performed = self._executor.delete(unique_id)
+    async def delete_post(self, request: HTTPRequest, unique_id: str) -> HTTPResponse:
+        deletion_performed = await scheduler.run_in_thread(self._executor.delete, unique_id)
+        if self._response_cache is not None:
+            self._response_cache.deleted(unique_id)
         if deletion_performed:
             return HTTPResponse(status=204, reason='Entry deleted')
         return HTTPResponse(status=404, reason='Entry not found')
 
     @staticmethod
-    def get_data_to_send(response: HTTPResponse) -> bytes:
-        data_to_send = b''
-        status_line = f'HTTP/1.1 {response.status} {response.reason}\r\n'.encode('iso-8859-1')
-        data_to_send += status_line
+    def get_data_to_send(response: HTTPResponse) -> List[bytes]:
+        """Form the head of the response, keeping the body a separate buffer so it is never copied."""
+        head_lines = [f'HTTP/1.1 {response.status} {response.reason}\r\n']
         if response.headers_sent:
-            for (key, value) in response.headers_sent:
-                header_line = f'{key}: {value}\r\n'.encode('iso-8859-1')
-                data_to_send += header_line
-        data_to_send += b'\r\n'
+            head_lines.extend(f'{key}: {value}\r\n' for (key, value) in response.headers_sent)
+        if not response.headers_sent and response.status not in BODILESS_STATUSES:
+            head_lines.append('Content-Length: 0\r\n')
+        head_lines.append('\r\n')
+        data_to_send = [''.join(head_lines).encode('iso-8859-1')]
         if response.body_sent:
-            data_to_send += response.body_sent
+            data_to_send.append(response.body_sent)
         return data_to_send
 
 
+SERVICE_UNAVAILABLE_RESPONSE = b''.join(HTTPServer.get_data_to_send(HTTPResponse(
+    status=503, reason='Service Unavailable',
+    headers=[('Retry-After', 1), ('Connection', 'close'), ('Content-Length', 0)]
+)))
+
+
 class QueueClosed(Exception):
     pass
 
@@ -267,15 +1020,49 @@ class Awaitable:
         yield
 
 
+class Timer:
+    """A call scheduled for later, which may be cancelled till it is made."""
+
+    __slots__ = ('_func', '_on_cancel')
+
+    def __init__(self, func: Callable[[], Any], on_cancel: Callable[[], None]):
+        self._func = func
+        self._on_cancel = on_cancel
+
+    @property
+    def cancelled(self) -> bool:
+        return self._func is None
+
+    def cancel(self) -> None:
+        if self._func is not None:
+            self._func = None
+            if self._on_cancel is not None:
+                self._on_cancel()
+
+    def fall_due(self) -> None:
+        """Mark the timer as taken off the heap, so that cancelling it later is not reported."""
+        self._on_cancel = None
+
+    def __call__(self) -> None:
+        if self._func is not None:
+            func, self._func = self._func, None
+            func()
+
+
 class Scheduler:
 
     def __init__(self):
         self._tasks_ready = collections.deque()
         self._tasks_delayed = []
         self._sequence = 0
+        self._timers_cancelled = 0
         self._current = None
-        self._read_waiting = {}
-        self._write_waiting = {}
+        self._selector = selectors.DefaultSelector()
+        self._waiting_num = 0
+        self._thread_pool = None
+        self._wakeup_reader = None
+        self._wakeup_writer = None
+        self._calls_completed = collections.deque()
 
     def set_current(self, task: Optional['Task']) -> None:
         self._current = task
@@ -286,31 +1073,84 @@ class Scheduler:
     def add_to_tasks_ready(self, task: 'Task') -> None:
         self._tasks_ready.append(task)
 
-    def call_soon(self, func: Callable[[...], Any], delayed: Union[int, float] = 0) -> None:
-        ready = not bool(delayed)
+    def call_soon(self, func: Callable[[...], Any], delayed: Union[int, float] = 0) -> Optional[Timer]:
         if delayed:
-            self._sequence += 1
-            deadline = time.time() + delayed
-            heapq.heappush(
-                self._tasks_delayed,
-                (deadline, self._sequence, func)
-            )
-        if ready:
-            self._tasks_ready.append(func)
+            return self.call_later(delayed, func)
+        self._tasks_ready.append(func)
+
+    def call_later(self, delay: Union[int, float], func: Callable[[], Any]) -> Timer:
+        """Schedule the func to be called in delay seconds. The Timer returned lets the call be cancelled."""
+        timer = Timer(func, self._on_timer_cancelled)
+        self._sequence += 1
+        heapq.heappush(
+            self._tasks_delayed,
+            (time.time() + delay, self._sequence, timer)
+        )
+        return timer
+
+    def _on_timer_cancelled(self) -> None:
+        """Cancelled timers are left in the heap to be skipped when due,
+        unless they pile up, then the heap is rebuilt without them."""
+        self._timers_cancelled += 1
+        if self._timers_cancelled > TIMERS_CANCELLED_MAX and self._timers_cancelled > len(self._tasks_delayed) // 2:
+            self._tasks_delayed = [entry for entry in self._tasks_delayed if not entry[2].cancelled]
+            heapq.heapify(self._tasks_delayed)
+            self._timers_cancelled = 0
+
+    def _wait_for(self, fileobj, event: int, func) -> None:
+        """Park the func till the event on the fileobj.
+
+        The registration is kept after the event fires, so that a socket
+        waited for in a loop costs no extra syscalls per wait."""
+        try:
+            key = self._selector.get_key(fileobj)
+        except KeyError:
+            key = self._selector.register(fileobj, event, [None, None])
+        else:
+            if not key.events & event:
+                key = self._selector.modify(fileobj, key.events | event, key.data)
+        key.data[WAITER_SLOTS[event]] = func
+        self._waiting_num += 1
 
     def read_wait(self, fileno, func):
-        self._read_waiting[fileno] = func
+        self._wait_for(fileno, selectors.EVENT_READ, func)
 
     def write_wait(self, fileno, func):
-        self._write_waiting[fileno] = func
+        self._wait_for(fileno, selectors.EVENT_WRITE, func)
+
+    def forget(self, fileobj) -> None:
+        """Drop the registration of the fileobj. Must be called before the fileobj is closed."""
+        try:
+            key = self._selector.unregister(fileobj)
+        except (KeyError, ValueError):
+            return
+        self._waiting_num -= sum(waiter is not None for waiter in key.data)
+
+    def _dispatch(self, key: selectors.SelectorKey, mask: int) -> None:
+        waiters = key.data
+        idle_events = 0
+        for event, slot in WAITER_SLOTS.items():
+            if not mask & event:
+                continue
+            if waiters[slot] is None:
+                idle_events |= event
+                continue
+            self._tasks_ready.append(waiters[slot])
+            waiters[slot] = None
+            self._waiting_num -= 1
+        if idle_events:
+            events_left = key.events & ~idle_events
+            if events_left:
+                self._selector.modify(key.fileobj, events_left, waiters)
+            else:
+                self._selector.unregister(key.fileobj)
 
     def run(self) -> None:
 
         while (
                 self._tasks_ready
                 or self._tasks_delayed
-                or self._read_waiting
-                or self._write_waiting
+                or self._waiting_num
         ):
 
             if not self._tasks_ready:
@@ -321,22 +1161,19 @@ class Scheduler:
                         timeout = 0
                 if not self._tasks_delayed:
                     timeout = None
-                can_read, can_write, _ = select.select(
-                    self._read_waiting,
-                    self._write_waiting,
-                    [],
-                    timeout
-                )
-                for file_descriptor in can_read:
-                    self._tasks_ready.append(self._read_waiting.pop(file_descriptor))
-                for file_descriptor in can_write:
-                    self._tasks_ready.append(self._write_waiting.pop(file_descriptor))
+                for key, mask in self._selector.select(timeout):
+                    self._dispatch(key, mask)
 
                 now = time.time()
                 while self._tasks_delayed:
                     if now < self._tasks_delayed[0][0]:
                         break
-                    self._tasks_ready.append(heapq.heappop(self._tasks_delayed)[2])
+                    timer = heapq.heappop(self._tasks_delayed)[2]
+                    if timer.cancelled:
+                        self._timers_cancelled -= 1
+                        continue
+                    timer.fall_due()
+                    self._tasks_ready.append(timer)
 
             while self._tasks_ready:
                 task = self._tasks_ready.popleft()
@@ -345,13 +1182,65 @@ class Scheduler:
     def add_task(self, coro: Coroutine[Any, Any, Any]) -> None:
         self._tasks_ready.append(Task(coro))
 
+    @property
+    def tasks_ready_num(self) -> int:
+        return len(self._tasks_ready)
+
+    @property
+    def tasks_delayed_num(self) -> int:
+        return len(self._tasks_delayed) - self._timers_cancelled
+
+    @property
+    def waiting_num(self) -> int:
+        return self._waiting_num
+
+    def _set_thread_pool(self) -> None:
+        """Start the worker threads and the wakeup socketpair they signal their completions through.
+
+        Done lazily, so that the pool and the sockets belong to the process that runs the scheduler."""
+        self._thread_pool = ThreadPoolExecutor(max_workers=SERVER_EXECUTOR_THREADS,
+                                               thread_name_prefix='executor')
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self.add_task(self._collect_completed_calls())
+
+    def _on_call_done(self, task: 'Task') -> None:
+        self._calls_completed.append(task)
+        try:
+            self._wakeup_writer.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    async def _collect_completed_calls(self) -> None:
+        while True:
+            self.read_wait(self._wakeup_reader, self._current)
+            self._current = None
+            await self.switch()
+            try:
+                while self._wakeup_reader.recv(MAX_BYTES):
+                    pass
+            except (BlockingIOError, InterruptedError):
+                pass
+            while self._calls_completed:
+                self._tasks_ready.append(self._calls_completed.popleft())
+
+    async def run_in_thread(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Run the blocking func in a worker thread, letting the other tasks go on meanwhile."""
+        if self._thread_pool is None:
+            self._set_thread_pool()
+        task = self._current
+        self._current = None
+        future: Future = self._thread_pool.submit(func, *args)
+        future.add_done_callback(lambda _: self._on_call_done(task))
+        await self.switch()
+        return future.result()
+
     @staticmethod
     def switch() -> Awaitable:
         return Awaitable()
 
     async def sleep(self, delay):
-        print(f'Sleeping {delay} sec. for single post write operation,'
-              f'not blocking the server')
         self.call_soon(
             func=self._current,
             delayed=delay
@@ -359,17 +1248,74 @@ class Scheduler:
         self._current = None
         await self.switch()
 
-    async def recv(self, sock: socket.socket):
-        self.read_wait(sock, self._current)
+    async def _wait_with_timeout(self, sock: socket.socket, event: int,
+                                 timeout: Optional[Union[int, float]], timeout_reason: str) -> None:
+        """Wait for the event on the sock, having TimeoutError thrown into the task if it takes over timeout seconds."""
+        task = self._current
+        self._wait_for(sock, event, task)
         self._current = None
-        await self.switch()
-        return sock.recv(MAX_BYTES)
+        if timeout is None:
+            await self.switch()
+            return
+        timer = self.call_later(timeout, lambda: self._expire_wait(sock, event, task, timeout_reason))
+        try:
+            await self.switch()
+        finally:
+            timer.cancel()
 
-    async def send(self, sock, data):
-        self.write_wait(sock, self._current)
-        self._current = None
-        await self.switch()
-        return sock.send(data)
+    def _expire_wait(self, sock: socket.socket, event: int, task: 'Task', timeout_reason: str) -> None:
+        try:
+            key = self._selector.get_key(sock)
+        except (KeyError, ValueError):
+            return
+        slot = WAITER_SLOTS[event]
+        if key.data[slot] is not task:
+            return
+        key.data[slot] = None
+        self._waiting_num -= 1
+        task.throw(TimeoutError(timeout_reason))
+        self._tasks_ready.append(task)
+
+    async def recv(self, sock: socket.socket, timeout: Optional[Union[int, float]] = None,
+                   timeout_reason: str = 'read') -> bytes:
+        while True:
+            await self._wait_with_timeout(sock, selectors.EVENT_READ, timeout, timeout_reason)
+            try:
+                return sock.recv(MAX_BYTES)
+            except (BlockingIOError, InterruptedError):
+                continue
+
+    async def send(self, sock: socket.socket, data: Union[bytes, List[bytes]],
+                   timeout: Optional[Union[int, float]] = None, timeout_reason: str = 'write') -> int:
+        """Send all the data, given as one buffer or a list of them, with as few syscalls as possible.
+
+        The buffers go out together via sendmsg, the way writev does, and a partial write
+        is carried on with memoryview slices of what is left, so nothing is copied.
+        Write readiness is waited for only while the socket cannot take more,
+        the waits altogether being limited by the timeout, so a client taking
+        a few bytes at a time cannot stretch the send out."""
+        deadline = None if timeout is None else time.time() + timeout
+        buffers = [data] if isinstance(data, (bytes, bytearray, memoryview)) else data
+        pending = collections.deque(memoryview(buffer) for buffer in buffers if len(buffer))
+        bytes_sent_total = 0
+        while pending:
+            try:
+                if HAS_SENDMSG:
+                    bytes_sent = sock.sendmsg(list(itertools.islice(pending, SEND_BUFFERS_MAX)))
+                else:
+                    bytes_sent = sock.send(pending[0])
+            except (BlockingIOError, InterruptedError):
+                await self._wait_with_timeout(sock, selectors.EVENT_WRITE,
+                                              None if deadline is None else max(deadline - time.time(), 0),
+                                              timeout_reason)
+                continue
+            bytes_sent_total += bytes_sent
+            while bytes_sent:
+                if bytes_sent < len(pending[0]):
+                    pending[0] = pending[0][bytes_sent:]
+                    break
+                bytes_sent -= len(pending.popleft())
+        return bytes_sent_total
 
     async def accept(self, sock):
         self.read_wait(sock, self._current)
@@ -379,19 +1325,33 @@ class Scheduler:
 
 
 scheduler = Scheduler()
+scheduler_tasks_ready.set_function(lambda: scheduler.tasks_ready_num)
+scheduler_tasks_delayed.set_function(lambda: scheduler.tasks_delayed_num)
+scheduler_tasks_waiting.set_function(lambda: scheduler.waiting_num)
 
 
 class Task:
 
     def __init__(self, coro: Coroutine[Any, Any, Any]):
         self._coro = coro
+        self._exception = None
+
+    def throw(self, exception: BaseException) -> None:
+        """Have the exception raised inside the coroutine when the task is resumed next."""
+        self._exception = exception
 
     def __call__(self):
         try:
             scheduler.set_current(self)
-            self._coro.send(None)
+            if self._exception is not None:
+                exception, self._exception = self._exception, None
+                self._coro.throw(exception)
+            else:
+                self._coro.send(None)
             if scheduler.get_current():
                 scheduler.add_to_tasks_ready(self)
 
         except (StopIteration,):
             pass
+        except Exception as e:
+            logging.error(f'Task {self._coro.__qualname__} failed ---> {e!r}')